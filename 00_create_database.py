@@ -23,6 +23,8 @@ import time
 import getpass
 import arcpy
 
+import sql_functions
+
 # Import custom variables for National Liveability indicator process
 from _project_setup import *
 
@@ -119,20 +121,11 @@ sql = '''
 conn.execute(sql)
 print('Done.')
  
-print('Creating threshold functions ... '),
-sql = '''
-CREATE OR REPLACE FUNCTION threshold_hard(in int, in int, out int) 
-    RETURNS NULL ON NULL INPUT
-    AS $$ SELECT ($1 < $2)::int $$
-    LANGUAGE SQL;
-
-CREATE OR REPLACE FUNCTION threshold_soft(in int, in int, out double precision) 
-    RETURNS NULL ON NULL INPUT
-    AS $$ SELECT 1 - 1/(1+exp(-5*($1-$2)/($2::float))) $$
-    LANGUAGE SQL;    
-  '''
-engine.execute(sql)
-print('Done.')
+print('Creating function library (threshold, array_min, array_first and count_in_threshold functions; see sql_functions.py) ... '),
+if sql_functions.install(engine):
+    print('Done (version {}).'.format(sql_functions.library_version))
+else:
+    print('Version {} already installed.'.format(sql_functions.library_version))
 
 print('Creating schemas...')
 for schema in schemas:
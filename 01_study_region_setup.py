@@ -89,7 +89,7 @@ command = (
               ' PG:"host={host} port=5432 dbname={db}'
               ' user={user} password = {pwd}" '
               ' "{gpkg}" '
-              ' -lco geometry_name="geom"'.format(host = db_host,
+              ' -lco geometry_name="geom" -lco COLUMN_TYPES=tags=hstore'.format(host = db_host,
                                            db = db,
                                            user = db_user,
                                            pwd = db_pwd,
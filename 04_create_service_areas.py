@@ -2,236 +2,504 @@
 # Purpose: This script creates service areas for a set of input distances
 # Carl Higgs, 2019-20
 
-import arcpy, arcinfo
 import glob
 import time
+import multiprocessing
 import psycopg2 
 import numpy as np
 from shutil import copytree,rmtree,ignore_patterns
 from progressor import progressor
+from bulk_copy import BinaryCopyWriter
 from sqlalchemy import create_engine
+from tqdm import tqdm
 
+import polygon_scheduler
 from script_running_log import script_running_log
 
 # Import custom variables for National Liveability indicator process
 from _project_setup import *
 
+if routing_engine == 'arcpy':
+    import arcpy, arcinfo
+else:
+    import network_routing
+
 # simple timer for log file
 start = time.time()
 script = os.path.basename(sys.argv[0])
 task = 'create service areas ({}) for locations in {} based on road network'.format(', '.join([str(x) for x in service_areas]),full_locale)
-print("Commencing task: {} at {}".format(task,time.strftime("%Y%m%d-%H%M%S")))
 
 schema=point_schema
 
-# ArcGIS environment settings
-arcpy.env.workspace = gdb_path  
-
-# Specify points
-points = sample_point_feature
-denominator = int(arcpy.GetCount_management(points).getOutput(0))
-
-# temp --- using SSD copies to save write/read time and avoid conflicts
-if not os.path.exists(temp):
-    os.makedirs(temp)
-
-
-# initiate postgresql connection
-conn = psycopg2.connect(database=db, user=db_user, password=db_pwd)
-curs = conn.cursor()  
-
 engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
                                                                       pwd  = db_pwd,
                                                                       host = db_host,
                                                                       db   = db), 
                        use_native_hstore=False)
+
+# Network routing engine (routing_engine = 'network')
+# The network and located intersections are loaded once by each worker process, as required
+network = None
+intersections = None
+# Street connectivity (3 plus leg intersections per km2) is recorded for service areas of the 
+# analysis distance as a by-product of the service area search (see 07_street_connectivity.py)
+intersections_table = "network.clean_intersections_12m"
+
+def network_service_areas(task):
+  '''
+    Create service areas for all break distances remaining to be processed for origins in 
+    a polygon (or origin batch), using the in-process network routing engine (ie. without ArcGIS).
+    
+    input: [polygon, batch, batches, list of break distances] (see polygon_scheduler.py)
+    output: Records line buffered service areas to the nh{distance}m table for each break distance
+    
+            A single search bounded at the largest break distance is run from each origin, 
+            recording the distance to the end nodes of each reachable edge (copied to a 
+            staging table using binary COPY).  The reachable fragment of each edge within 
+            every break distance is derived from these in SQL, and these fragments are 
+            unioned and buffered for each origin, as for the dissolved service area lines 
+            using arcpy.
+            
+            If the analysis distance is among the break distances, street connectivity
+            is also recorded: the count of intersections reachable within this distance
+            (evaluated from the same search), per km2 of the buffered service area.
+            
+            Returns 0 on success, 1 on error, 2 if there were no points to process.
+  '''
+  global network, intersections
+  polygon, batch, batches, breaks = task
+  engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
+                                                                    pwd  = db_pwd,
+                                                                    host = db_host,
+                                                                    db   = db), 
+                     use_native_hstore=False)
+  staging_table = 'service_area_edges_{}_{}'.format(polygon, batch)
+  connectivity_table = 'street_connectivity_{}_{}'.format(polygon, batch)
+  sql = ''
+  try:
+    place = "network setup"
+    if network is None:
+        # edges are identified by the feature id recorded on import of the network 
+        network = network_routing.load_network(engine, network_schema = network_schema, edge_id = 'fid')
+    place = "origin selection"
+    # origins in polygon (and batch) without a service area recorded for one or more break distances
+    remaining = ' OR '.join(['''NOT EXISTS (SELECT 1 FROM {schema}.nh{distance}m r WHERE r.{points_id} = p.{points_id})'''.format(schema = schema,
+                                                                                                                                   distance = break_distance,
+                                                                                                                                   points_id = points_id)
+                             for break_distance in breaks])
+    sql = '''p.{polygon_id} = {polygon} AND {batch_filter} AND ({remaining})'''.format(polygon_id = polygon_id,
+                                                                                        polygon = polygon,
+                                                                                        batch_filter = polygon_scheduler.batch_filter(points_id.lower(), batch, batches),
+                                                                                        remaining = remaining)
+    origins = network_routing.locate(engine, network, 
+                                     table = sample_point_feature,
+                                     id = points_id,
+                                     where = sql,
+                                     tolerance = tolerance,
+                                     network_schema = network_schema)
+    if len(origins) == 0:
+        return(2)
+    if distance in breaks and intersections is None:
+        place = "intersection location"
+        intersections = network_routing.LocationIndex(network_routing.locate(engine, network, 
+                                                                             table = intersections_table,
+                                                                             id = 'fid',
+                                                                             tolerance = tolerance,
+                                                                             network_schema = network_schema))
+    place = "network search"
+    # reachable edges are streamed to an unlogged staging table using binary COPY
+    conn = engine.raw_connection()
+    try:
+        curs = conn.cursor()
+        curs.execute('''
+          DROP TABLE IF EXISTS {processing_schema}.{staging_table};
+          CREATE UNLOGGED TABLE {processing_schema}.{staging_table} 
+          (id text, edge bigint, distance_u double precision, distance_v double precision, origin_offset double precision);
+          '''.format(processing_schema = processing_schema,
+                     staging_table = staging_table))
+        writer = BinaryCopyWriter(curs, 
+                                  '{}.{}'.format(processing_schema, staging_table), 
+                                  ['id','edge','distance_u','distance_v','origin_offset'], 
+                                  ['text','int8','float8','float8','float8'])
+        connectivity = []
+        for origin in origins.itertuples():
+            settled = network_routing.search(network, network_routing.origin_seeds(origin), max(breaks))
+            for edge in network_routing.service_area(network, origin, max(breaks), settled):
+                writer.write((str(origin.id),) + edge)
+            if distance in breaks:
+                # street connectivity: count of intersections reachable within distance
+                connectivity.append([origin.id, len(network_routing.reachable(settled, origin, intersections, distance))])
+        writer.close()
+        conn.commit()
+    finally:
+        conn.close()
+    place = "service areas"
+    # the reachable fragment of each edge is derived for all break distances from a single join of the
+    # staging table with the network edges, and the service areas for each break distance are inserted 
+    # into their respective tables in the one statement
+    inserts = ',\n'.join(['''nh{distance}m AS
+          (INSERT INTO {schema}.nh{distance}m
+           SELECT id::{type},
+                  ST_Area(geom) AS area_sqm,
+                  ST_Area(geom)/1000000 AS area_sqkm, 
+                  ST_Area(geom)/10000 AS area_ha,
+                  geom
+             FROM buffered
+            WHERE break_distance = {distance}
+               ON CONFLICT DO NOTHING)'''.format(schema = schema,
+                                                 distance = break_distance,
+                                                 type = points_id_type)
+                          for break_distance in breaks])
+    sql = '''
+      WITH 
+      reached AS
+          (SELECT s.*, e.geom, ST_Length(e.geom) AS length
+             FROM {processing_schema}.{staging_table} s
+             JOIN {network_schema}.edges e ON s.edge = e.fid
+            WHERE ST_Length(e.geom) > 0),
+      fragments AS
+          (SELECT id, b.break_distance,
+                  ST_LineSubstring(geom, 0, LEAST(1, (b.break_distance - distance_u)/length)) AS geom
+             FROM reached, unnest(ARRAY[{breaks}]) b(break_distance)
+            WHERE distance_u < b.break_distance
+           UNION ALL
+           SELECT id, b.break_distance,
+                  ST_LineSubstring(geom, GREATEST(0, 1 - (b.break_distance - distance_v)/length), 1) AS geom
+             FROM reached, unnest(ARRAY[{breaks}]) b(break_distance)
+            WHERE distance_v < b.break_distance
+           UNION ALL
+           SELECT id, b.break_distance,
+                  ST_LineSubstring(geom, 
+                                   GREATEST(0, (origin_offset - b.break_distance)/length), 
+                                   LEAST(1, (origin_offset + b.break_distance)/length)) AS geom
+             FROM reached, unnest(ARRAY[{breaks}]) b(break_distance)
+            WHERE origin_offset IS NOT NULL),
+      buffered AS
+          (SELECT id, 
+                  break_distance,
+                  ST_Buffer(ST_SnapToGrid(ST_Union(geom),{snap_to_grid}),{line_buffer}) AS geom
+             FROM fragments
+            GROUP BY id, break_distance),
+      {inserts}
+      SELECT COUNT(*) FROM buffered;
+      DROP TABLE IF EXISTS {processing_schema}.{staging_table};
+    '''.format(breaks = ','.join([str(x) for x in breaks]),
+               snap_to_grid = snap_to_grid,
+               line_buffer = line_buffer,
+               inserts = inserts,
+               processing_schema = processing_schema,
+               staging_table = staging_table,
+               network_schema = network_schema)
+    engine.execute(sql)
+    if distance in breaks:
+        place = "street connectivity"
+        df = pandas.DataFrame(data = connectivity, columns = [points_id,'intersection_count'])
+        df.to_sql(connectivity_table, con = engine, schema = processing_schema, index = False, if_exists='replace')
+        sql = '''
+          INSERT INTO {schema}.sc_nh{distance}m ({points_id},intersection_count,area_sqkm,sc_nh1600m)
+          SELECT n.{points_id}, 
+                 c.intersection_count,
+                 n.area_sqkm, 
+                 c.intersection_count/n.area_sqkm AS sc_nh1600m
+            FROM {processing_schema}.{connectivity_table} c
+            JOIN {schema}.nh{distance}m n ON c.{points_id} = n.{points_id}
+              ON CONFLICT DO NOTHING;
+          DROP TABLE IF EXISTS {processing_schema}.{connectivity_table};
+        '''.format(schema = schema,
+                   distance = distance,
+                   points_id = points_id,
+                   processing_schema = processing_schema,
+                   connectivity_table = connectivity_table)
+        engine.execute(sql)
+    return(0)
+  except:
+      print('''Error: {}\npolygon: {}\nPlace: {}\nSQL: {}'''.format( sys.exc_info(),polygon,place,sql))  
+      return(1)
+  finally:
+      engine.dispose()
+
+def create_service_area_table(table):
+    createTable_sausageBuffer = '''
+      CREATE TABLE IF NOT EXISTS {point_schema}.{table}
+        ({id} {type} PRIMARY KEY, 
+         area_sqm   double precision,
+         area_sqkm  double precision,
+         area_ha    double precision,
+         geom geometry);  
+      '''.format(point_schema = point_schema,
+                 table = table,
+                 id = points_id.lower(),
+                 type = points_id_type)
+    # create output spatial feature in Postgresql
+    engine.execute(createTable_sausageBuffer)
+
+def record_points_without_service_area(table):
+    # Create summary table of parcel id and area
+    print("    - Creating summary table of points with no 1600m buffer (if any)... "),  
+    sql = '''
+    CREATE TABLE IF NOT EXISTS {validation_schema}.no_nh_1600m AS 
+    SELECT * FROM {sample_point_feature} 
+    WHERE {points_id} NOT IN (SELECT {points_id} FROM {point_schema}.{table});
+    '''.format(sample_point_feature = sample_point_feature,
+               point_schema = point_schema,
+               validation_schema = validation_schema,
+               points_id=points_id,
+               table=table)
+    engine.execute(sql)
+
+# MAIN PROCESS
+if __name__ == '__main__':
+  print("Commencing task: {} at {}".format(task,time.strftime("%Y%m%d-%H%M%S")))
+  # Specify points
+  points = sample_point_feature
+  if routing_engine == 'arcpy':
+    # ArcGIS environment settings
+    arcpy.env.workspace = gdb_path  
+
+    denominator = int(arcpy.GetCount_management(points).getOutput(0))
+
+    # temp --- using SSD copies to save write/read time and avoid conflicts
+    if not os.path.exists(temp):
+        os.makedirs(temp)
+
+
+    # initiate postgresql connection
+    conn = psycopg2.connect(database=db, user=db_user, password=db_pwd)
+    curs = conn.cursor()  
+
  
  
  
-temp_gdb = os.path.join(temp,"scratch_{}".format(db))
-# create project specific folder in temp dir for scratch.gdb, if not exists
-if not os.path.exists(temp_gdb):
-  os.makedirs(temp_gdb)
+    temp_gdb = os.path.join(temp,"scratch_{}".format(db))
+    # create project specific folder in temp dir for scratch.gdb, if not exists
+    if not os.path.exists(temp_gdb):
+      os.makedirs(temp_gdb)
       
-arcpy.env.scratchWorkspace = temp_gdb 
-arcpy.env.qualifiedFieldNames = False  
-arcpy.env.overwriteOutput = True 
-
-arcpy.CheckOutExtension('Network')
-
-arcpy.MakeFeatureLayer_management(points, "points")
-print("Processing service areas...")
-for distance in service_areas:
-    print("    - {}m... ".format(distance)),
-    table = "nh{}m".format(distance)
-    if engine.has_table(table, schema=point_schema):
-        print("Aleady exists; skipping.")
-    else:
-        createTable_sausageBuffer = '''
-          CREATE TABLE IF NOT EXISTS {point_schema}.{table}
-            ({id} {type} PRIMARY KEY, 
-             area_sqm   double precision,
-             area_sqkm  double precision,
-             area_ha    double precision,
-             geom geometry);  
-          '''.format(point_schema = point_schema,
-                     table = table,
-                     id = points_id.lower(),
-                     type = points_id_type)
-        # create output spatial feature in Postgresql
-        engine.execute(createTable_sausageBuffer)
+    arcpy.env.scratchWorkspace = temp_gdb 
+    arcpy.env.qualifiedFieldNames = False  
+    arcpy.env.overwriteOutput = True 
+
+    arcpy.CheckOutExtension('Network')
+
+    arcpy.MakeFeatureLayer_management(points, "points")
+    print("Processing service areas...")
+    for distance in service_areas:
+        print("    - {}m... ".format(distance)),
+        table = "nh{}m".format(distance)
+        if engine.has_table(table, schema=point_schema):
+            print("Aleady exists; skipping.")
+        else:
+            create_service_area_table(table)
         
-        # preparatory set up
-        # Process: Make Service Area Layer
-        outSAResultObject = arcpy.MakeServiceAreaLayer_na(in_network_dataset = in_network_dataset, 
-                                  out_network_analysis_layer = os.path.join(arcpy.env.scratchGDB,"ServiceArea"), 
-                                  impedance_attribute = "Length",  
-                                  travel_from_to = "TRAVEL_FROM", 
-                                  default_break_values = distance, 
-                                  line_type="TRUE_LINES",
-                                  overlap="OVERLAP", 
-                                  polygon_type="NO_POLYS", 
-                                  lines_source_fields="NO_LINES_SOURCE_FIELDS", 
-                                  hierarchy="NO_HIERARCHY")
+            # preparatory set up
+            # Process: Make Service Area Layer
+            outSAResultObject = arcpy.MakeServiceAreaLayer_na(in_network_dataset = in_network_dataset, 
+                                      out_network_analysis_layer = os.path.join(arcpy.env.scratchGDB,"ServiceArea"), 
+                                      impedance_attribute = "Length",  
+                                      travel_from_to = "TRAVEL_FROM", 
+                                      default_break_values = distance, 
+                                      line_type="TRUE_LINES",
+                                      overlap="OVERLAP", 
+                                      polygon_type="NO_POLYS", 
+                                      lines_source_fields="NO_LINES_SOURCE_FIELDS", 
+                                      hierarchy="NO_HIERARCHY")
                                   
-        outNALayer = outSAResultObject.getOutput(0)
+            outNALayer = outSAResultObject.getOutput(0)
         
-        #Get the names of all the sublayers within the service area layer.
-        subLayerNames = arcpy.na.GetNAClassNames(outNALayer)
-        #Store the layer names that we will use later
-        facilitiesLayerName = subLayerNames["Facilities"]
-        linesLayerName = subLayerNames["SALines"]
-        linesSubLayer = arcpy.mapping.ListLayers(outNALayer,linesLayerName)[0]
-        facilitiesSubLayer = arcpy.mapping.ListLayers(outNALayer,facilitiesLayerName)[0] 
-        fcLines  = os.path.join(arcpy.env.scratchGDB,"Lines")
+            #Get the names of all the sublayers within the service area layer.
+            subLayerNames = arcpy.na.GetNAClassNames(outNALayer)
+            #Store the layer names that we will use later
+            facilitiesLayerName = subLayerNames["Facilities"]
+            linesLayerName = subLayerNames["SALines"]
+            linesSubLayer = arcpy.mapping.ListLayers(outNALayer,linesLayerName)[0]
+            facilitiesSubLayer = arcpy.mapping.ListLayers(outNALayer,facilitiesLayerName)[0] 
+            fcLines  = os.path.join(arcpy.env.scratchGDB,"Lines")
         
-        # Process: Add Locations
-        arcpy.AddLocations_na(in_network_analysis_layer = os.path.join(arcpy.env.scratchGDB,"ServiceArea"), 
-                    sub_layer                      = facilitiesLayerName, 
-                    in_table                       = "points", 
-                    field_mappings                 = "Name {} #".format(points_id), 
-                    search_tolerance               = "{} Meters".format(tolerance), 
-                    search_criteria                = "{} SHAPE;{} NONE".format(network_edges,network_junctions), 
-                    append                         = "CLEAR", 
-                    snap_to_position_along_network = "NO_SNAP", 
-                    exclude_restricted_elements    = "INCLUDE",
-                    search_query                   = "{} #;{} #".format(network_edges,network_junctions))
-        place = "after AddLocations"      
+            # Process: Add Locations
+            arcpy.AddLocations_na(in_network_analysis_layer = os.path.join(arcpy.env.scratchGDB,"ServiceArea"), 
+                        sub_layer                      = facilitiesLayerName, 
+                        in_table                       = "points", 
+                        field_mappings                 = "Name {} #".format(points_id), 
+                        search_tolerance               = "{} Meters".format(tolerance), 
+                        search_criteria                = "{} SHAPE;{} NONE".format(network_edges,network_junctions), 
+                        append                         = "CLEAR", 
+                        snap_to_position_along_network = "NO_SNAP", 
+                        exclude_restricted_elements    = "INCLUDE",
+                        search_query                   = "{} #;{} #".format(network_edges,network_junctions))
+            place = "after AddLocations"      
         
-        # Process: Solve
-        arcpy.Solve_na(in_network_analysis_layer = os.path.join(arcpy.env.scratchGDB,"ServiceArea"), ignore_invalids = "SKIP",terminate_on_solve_error = "CONTINUE")
-        place = "after Solve_na"      
+            # Process: Solve
+            arcpy.Solve_na(in_network_analysis_layer = os.path.join(arcpy.env.scratchGDB,"ServiceArea"), ignore_invalids = "SKIP",terminate_on_solve_error = "CONTINUE")
+            place = "after Solve_na"      
         
-        # Dissolve linesLayerName
-        # field_names = [f.name for f in arcpy.ListFields(linesSubLayer)]
+            # Dissolve linesLayerName
+            # field_names = [f.name for f in arcpy.ListFields(linesSubLayer)]
         
-        arcpy.Dissolve_management(in_features=linesSubLayer, 
-                                  out_feature_class=fcLines, 
-                                  dissolve_field="FacilityID", 
-                                  statistics_fields="", 
-                                  multi_part="MULTI_PART", 
-                                  unsplit_lines="DISSOLVE_LINES")
-        place = "after Dissolve" 
+            arcpy.Dissolve_management(in_features=linesSubLayer, 
+                                      out_feature_class=fcLines, 
+                                      dissolve_field="FacilityID", 
+                                      statistics_fields="", 
+                                      multi_part="MULTI_PART", 
+                                      unsplit_lines="DISSOLVE_LINES")
+            place = "after Dissolve" 
         
-        # Process: Join Field
-        arcpy.MakeFeatureLayer_management(fcLines, "tempLayer")  
-        place = "after MakeFeatureLayer of TempLayer" 
+            # Process: Join Field
+            arcpy.MakeFeatureLayer_management(fcLines, "tempLayer")  
+            place = "after MakeFeatureLayer of TempLayer" 
         
-        arcpy.AddJoin_management(in_layer_or_view = "tempLayer", 
-                                 in_field    = "FacilityID", 
-                                 join_table  = facilitiesSubLayer,
-                                 join_field  = "ObjectId")
-        place = "after AddJoin" 
+            arcpy.AddJoin_management(in_layer_or_view = "tempLayer", 
+                                     in_field    = "FacilityID", 
+                                     join_table  = facilitiesSubLayer,
+                                     join_field  = "ObjectId")
+            place = "after AddJoin" 
         
-        # write output line features within chunk to Postgresql spatial feature
-        # Need to parse WKT output slightly (Postgresql doesn't take this M-values nonsense)
-        with arcpy.da.SearchCursor("tempLayer",['Facilities.Name','Shape@WKT']) as cursor:
-          for row in cursor:
-            id =  row[0].encode('utf-8')
-            wkt = row[1].encode('utf-8').replace(' NAN','').replace(' M ','')
+            # stream output line features as WKB to an unlogged staging table using binary COPY
+            staging_table = '{}.{}_staging'.format(processing_schema,table)
+            curs.execute('''
+              DROP TABLE IF EXISTS {staging_table};
+              CREATE UNLOGGED TABLE {staging_table} (id text, wkb bytea);
+              '''.format(staging_table = staging_table))
+            writer = BinaryCopyWriter(curs, staging_table, ['id','wkb'], ['text','bytea'])
+            with arcpy.da.SearchCursor("tempLayer",['Facilities.Name','Shape@WKB']) as cursor:
+              for row in cursor:
+                writer.write(row)
+            writer.close()
+            conn.commit()
+            place = "after copy of service area lines to staging table" 
+            # snap, buffer and measure all service areas in one set-based statement (using parallel query),
+            # and swap the result into place as the service area table, in a single transaction
             sql = '''
-                  INSERT INTO {point_schema}.{table} 
-                  SELECT 
-                    '{id}',
-                    b.area_sqm,
-                    b.area_sqm/1000000 AS area_sqkm, 
-                    b.area_sqm/10000 AS area_ha,
-                    b.geom
-                  FROM (SELECT ST_Area(geom) AS area_sqm,
-                               geom
-                          FROM (SELECT ST_Buffer(ST_SnapToGrid(ST_GeometryFromText('{wkt}', 
-                                                                                {srid}),
-                                                            {snap_to_grid}),
-                                              {line_buffer}) AS geom
-                                ) a 
-                         ) b ;
+              SET LOCAL max_parallel_workers_per_gather = {nWorkers};
+              DROP TABLE IF EXISTS {point_schema}.{table}_new;
+              CREATE TABLE {point_schema}.{table}_new AS
+              SELECT {id}, 
+                     b.area_sqm,
+                     b.area_sqm/1000000 AS area_sqkm, 
+                     b.area_sqm/10000 AS area_ha,
+                     b.geom
+                FROM (SELECT {id},
+                             ST_Area(geom) AS area_sqm,
+                             geom
+                        FROM (SELECT id::{type} AS {id},
+                                     ST_Buffer(ST_SnapToGrid(ST_Force2D(ST_GeomFromWKB(wkb, {srid})),
+                                                             {snap_to_grid}),
+                                               {line_buffer}) AS geom
+                                FROM {staging_table}
+                             ) a 
+                     ) b;
+              DROP TABLE {point_schema}.{table};
+              ALTER TABLE {point_schema}.{table}_new RENAME TO {table};
+              ALTER TABLE {point_schema}.{table} ADD PRIMARY KEY ({id});
+              DROP TABLE {staging_table};
             '''.format(point_schema = point_schema,
-                       table        = table,
-                       id           = id                  ,
-                       wkt          = wkt                 ,
-                       srid         = srid                ,
-                       snap_to_grid = snap_to_grid        ,
-                       line_buffer  = line_buffer
-                       )
+                       table         = table,
+                       id            = points_id.lower(),
+                       type          = points_id_type,
+                       staging_table = staging_table,
+                       nWorkers      = nWorkers,
+                       srid          = srid,
+                       snap_to_grid  = snap_to_grid,
+                       line_buffer   = line_buffer)
             curs.execute(sql)
-            place = "after curs.execute insert sausage buffer" 
             conn.commit()
-            place = "after conn.commit for insert sausage buffer" 
-        # clean up  
-        arcpy.Delete_management("tempLayer")
-        arcpy.Delete_management(fcLines)
-        # Create sausage buffer spatial index
-        engine.execute("CREATE INDEX IF NOT EXISTS {table}_gix ON {point_schema}.{table} USING GIST (geom);".format(point_schema = point_schema, table = table))
+            place = "after buffering of service areas" 
+            # clean up  
+            arcpy.Delete_management("tempLayer")
+            arcpy.Delete_management(fcLines)
+            # Create sausage buffer spatial index
+            engine.execute("CREATE INDEX IF NOT EXISTS {table}_gix ON {point_schema}.{table} USING GIST (geom);".format(point_schema = point_schema, table = table))
         
-        if distance==1600:
-            # Create summary table of parcel id and area
-            print("    - Creating summary table of points with no 1600m buffer (if any)... "),  
+            if distance==1600:
+                record_points_without_service_area(table)
+            print("Processed.")
+
+    arcpy.Delete_management("points")
+    arcpy.CheckInExtension('Network')
+
+    conn.close()
+ 
+    try:
+        for gdb in glob.glob(os.path.join(temp,"scratch_{}_*.gdb".format(study_region))):
+          arcpy.Delete_management(gdb)
+    except: 
+        print("FRIENDLY REMINDER!!! Remember to delete temp gdbs to save space!")
+        print("(there may be lock files preventing automatic deletion.)")
+
+  else:
+    print("Processing service areas...")
+    # service areas are processed for all break distances together; a table is only
+    # considered complete once its spatial index has been created, following processing
+    breaks = []
+    for break_distance in service_areas:
+        table = "nh{}m".format(break_distance)
+        sql = '''SELECT to_regclass('{point_schema}.{table}_gix') IS NOT NULL;'''.format(point_schema = point_schema, table = table)
+        if engine.execute(sql).fetchone()[0]:
+            print("    - {}m... Aleady exists; skipping.".format(break_distance))
+        else:
+            create_service_area_table(table)
+            breaks.append(break_distance)
+    if len(breaks) > 0:
+        print("    - {}m (all from a single search per origin)... ".format('m, '.join([str(x) for x in breaks])))
+        # Ensure origins have a current snapping index (rebuilt only if the network or points have changed)
+        network_routing.snap_index(engine, sample_point_feature, points_id, tolerance, network_schema)
+        if distance in breaks:
+            network_routing.snap_index(engine, intersections_table, 'fid', tolerance, network_schema)
             sql = '''
-            CREATE TABLE IF NOT EXISTS {validation_schema}.no_nh_1600m AS 
-            SELECT * FROM {sample_point_feature} 
-            WHERE {points_id} NOT IN (SELECT {points_id} FROM {point_schema}.{table});
-            '''.format(sample_point_feature = sample_point_feature,
-                       point_schema = point_schema,
-                       validation_schema = validation_schema,
-                       points_id=points_id,
-                       table=table)
+              CREATE TABLE IF NOT EXISTS {schema}.sc_nh{distance}m
+              ({id} {type} PRIMARY KEY,
+               intersection_count integer NOT NULL,
+               area_sqkm double precision NOT NULL,
+               sc_nh1600m double precision NOT NULL 
+              ); 
+              '''.format(schema = schema,
+                         distance = distance,
+                         id = points_id.lower(),
+                         type = points_id_type)
             engine.execute(sql)
+        # get list of polygons over which to iterate, ordered by count of points (longest first),
+        # with polygons having more than od_batch_points points split into origin batches
+        iteration_list = [[polygon,batch,batches,breaks] for polygon,batch,batches in polygon_scheduler.polygon_tasks(engine, 
+                                                                                                                     polygon_id, 
+                                                                                                                     max_points = od_batch_points)]
+        # Parallel processing setting; worker processes are recycled after worker_max_tasks tasks
+        pool = multiprocessing.Pool(processes=nWorkers, maxtasksperchild=worker_max_tasks or None)
+        r = list(tqdm(pool.imap(network_service_areas, iteration_list), total=len(iteration_list), unit='polygon'))
+        pool.close()
+        # a table is only marked complete (indexed) once every polygon has been processed without error;
+        # otherwise, polygons which failed are processed again on re-running this script
+        failed = sorted(set([task[0] for task,result in zip(iteration_list,r) if result not in (0,2)]))
+        failed = [str(polygon) for polygon in failed]
+        if len(failed) > 0:
+            sys.exit("Service areas returned errors for polygons {}; please check and re-run.".format(', '.join(failed)))
+        for break_distance in breaks:
+            table = "nh{}m".format(break_distance)
+            # Create sausage buffer spatial index
+            engine.execute("CREATE INDEX IF NOT EXISTS {table}_gix ON {point_schema}.{table} USING GIST (geom);".format(point_schema = point_schema, table = table))
+            if break_distance==1600:
+                record_points_without_service_area(table)
         print("Processed.")
 
-arcpy.Delete_management("points")
-arcpy.CheckInExtension('Network')
+  # Create combined service areas table
+  areas_sql = []
+  from_sql = []
+  for distance in service_areas:
+      table = 'nh{}m'.format(distance)
+      areas_sql = areas_sql+['''{schema}.{table}.area_ha AS {table}_ha'''.format(schema=schema,table=table)]
+      from_sql = from_sql+['''LEFT JOIN {schema}.{table} ON p.{points_id} = {schema}.{table}.{points_id}'''.format(schema=schema,table=table,sample_point_feature=sample_point_feature,points_id=points_id)]
 
-conn.close()
- 
-try:
-    for gdb in glob.glob(os.path.join(temp,"scratch_{}_*.gdb".format(study_region))):
-      arcpy.Delete_management(gdb)
-except: 
-    print("FRIENDLY REMINDER!!! Remember to delete temp gdbs to save space!")
-    print("(there may be lock files preventing automatic deletion.)")
-
-
-# Create combined service areas table
-areas_sql = []
-from_sql = []
-for distance in service_areas:
-    table = 'nh{}m'.format(distance)
-    areas_sql = areas_sql+['''{schema}.{table}.area_ha AS {table}_ha'''.format(schema=schema,table=table)]
-    from_sql = from_sql+['''LEFT JOIN {schema}.{table} ON p.{points_id} = {schema}.{table}.{points_id}'''.format(schema=schema,table=table,sample_point_feature=sample_point_feature,points_id=points_id)]
-
-sql = '''
-CREATE TABLE IF NOT EXISTS {schema}.service_areas AS
-SELECT p.{points_id},
-       {areas_sql}
-FROM {sample_point_feature} p
-{from_sql}
-'''.format(schema = schema,
-           points_id=points_id,
-           sample_point_feature=sample_point_feature,
-           areas_sql=',\n'.join(areas_sql),
-           from_sql=' \n'.join(from_sql))
-engine.execute(sql)
-engine.dispose()
-
-# output to completion log    
-script_running_log(script, task, start, locale)
+  sql = '''
+  CREATE TABLE IF NOT EXISTS {schema}.service_areas AS
+  SELECT p.{points_id},
+         {areas_sql}
+  FROM {sample_point_feature} p
+  {from_sql}
+  '''.format(schema = schema,
+             points_id=points_id,
+             sample_point_feature=sample_point_feature,
+             areas_sql=',\n'.join(areas_sql),
+             from_sql=' \n'.join(from_sql))
+  engine.execute(sql)
+  engine.dispose()
+
+  # output to completion log    
+  script_running_log(script, task, start, locale)
@@ -13,10 +13,20 @@
 #          as it uses the intersection of these spatial database features 
 #          to aggregate dwelling counts within meshblocks intersecting sausage buffers
 #
+#          Dwelling density is calculated for each service area distance for which 
+#          sausage buffers have been created (dd_nh{distance}m), in partitions of sample 
+#          point polygons, using the method specified by dwelling_density_method:
+#            - 'sql': a set-based spatial join in PostgreSQL for each polygon
+#            - 'shapely': an in-Python spatial join using an STRtree of meshblocks
+#          Polygons for which dwelling density has been recorded for all sausage buffers 
+#          are skipped, so the script may be re-run to resume processing.
+#
 # Author:  Carl Higgs 20/03/2017
 
 import time
 import psycopg2
+import numpy as np
+from sqlalchemy import create_engine
 from progressor import progressor
 
 from script_running_log import script_running_log
@@ -33,92 +43,138 @@ task = 'calculate dwelling density (dwellings per hectare)'
 schema = point_schema
 
 meshblock_table = "area_linkage"
-buffer_table = "nh{}m".format(distance)
-dd_table = 'dd_{}'.format(buffer_table)
 
+# Dwelling density tables are created once, and processed in partitions of sample point polygons;
+# polygons with dwelling density already recorded for all of their sausage buffers are skipped, 
+# so that processing may be resumed if interrupted
 createTable_dd = '''
-  DROP TABLE IF EXISTS {schema}.{table};
   CREATE TABLE IF NOT EXISTS {schema}.{table}
   ({id} {type} PRIMARY KEY,
    dwellings integer,
    area_ha double precision,
-   dd_nh1600m double precision
+   {table} double precision
   ); 
-  '''.format(schema = schema,
-             table = dd_table,
-             id  = points_id.lower(),
-             type = points_id_type)
-  
-query_A = '''
-INSERT INTO {schema}.{table} ({id},dwellings,area_ha,dd_nh1600m)
-(SELECT s.{id},  
-        sum(dwelling) AS dwellings,
-        s.area_ha,
-        sum(t.dwelling)/s.area_ha::double precision as dd_nh1600m
+  '''
+
+# SQL method: dwelling density for the sausage buffers of a polygon in a single statement
+query_dd = '''
+INSERT INTO {schema}.{table} ({id},dwellings,area_ha,{table})
+SELECT s.{id},  
+       sum(t.dwelling)::integer AS dwellings,
+       s.area_ha,
+       sum(t.dwelling)/s.area_ha::double precision as {table}
   FROM {schema}.{buffer_table} s
+  JOIN {sample_point_feature} p ON s.{id} = p.{id}
   LEFT JOIN {meshblock_table} t ON ST_intersects(s.geom, t.geom)
-  WHERE s.{id} IN
-'''.format(schema = schema,
-           table = dd_table,
-           id = points_id.lower(),
-           buffer_table = buffer_table,
-           meshblock_table = meshblock_table)
-  
-query_C = '''
-  GROUP BY s.{id},s.area_ha) ON CONFLICT DO NOTHING;
-  '''.format(id = points_id.lower())
-
-#  Size of tuple chunk sent to postgresql 
-sqlChunkify = 500
-    
+ WHERE p.{polygon_id} = {polygon}
+   AND NOT EXISTS (SELECT 1 FROM {schema}.{table} d WHERE d.{id} = s.{id})
+ GROUP BY s.{id},s.area_ha
+    ON CONFLICT DO NOTHING;
+'''
+
+def remaining_polygons(buffer_table,dd_table):
+    ''' Polygons with sausage buffers for which dwelling density has not been recorded '''
+    sql = '''
+      SELECT DISTINCT p.{polygon_id}
+        FROM {schema}.{buffer_table} s
+        JOIN {sample_point_feature} p ON s.{id} = p.{id}
+       WHERE NOT EXISTS (SELECT 1 FROM {schema}.{table} d WHERE d.{id} = s.{id})
+       ORDER BY p.{polygon_id};
+    '''.format(id = points_id.lower(),
+               schema = schema,
+               buffer_table = buffer_table,
+               table = dd_table,
+               sample_point_feature = sample_point_feature,
+               polygon_id = polygon_id)
+    return [x[0] for x in engine.execute(sql)]
+
+def dwelling_density_sql(buffer_table,dd_table):
+    ''' Dwelling density using a spatial join in PostgreSQL, for the sausage buffers of each polygon in turn '''
+    polygons = remaining_polygons(buffer_table,dd_table)
+    denom = len(polygons)
+    for count, polygon in enumerate(polygons, 1):
+        curs.execute(query_dd.format(schema = schema,
+                                     table = dd_table,
+                                     id = points_id.lower(),
+                                     buffer_table = buffer_table,
+                                     sample_point_feature = sample_point_feature,
+                                     meshblock_table = meshblock_table,
+                                     polygon_id = polygon_id,
+                                     polygon = polygon))
+        conn.commit()
+        progressor(count,denom,start,"{}/{} polygons processed".format(count,denom))
+
+def dwelling_density_shapely(buffer_table,dd_table):
+    '''
+    Dwelling density using an in-Python spatial join: meshblocks are indexed once using an STRtree, and 
+    the sausage buffers for each polygon are queried against this using vectorised shapely predicates
+    '''
+    import shapely
+    if int(shapely.__version__.split('.')[0]) < 2:
+        sys.exit("The 'shapely' dwelling density method requires shapely 2.0 or later; please install this, or use the 'sql' method.")
+    sql = '''SELECT dwelling, ST_AsBinary(geom) AS wkb FROM {meshblock_table};'''.format(meshblock_table = meshblock_table)
+    meshblocks = pandas.read_sql(sql, engine)
+    dwellings = meshblocks.dwelling.fillna(0).values.astype(float)
+    tree = shapely.STRtree(shapely.from_wkb(meshblocks.wkb.apply(bytes).values))
+    polygons = remaining_polygons(buffer_table,dd_table)
+    denom = len(polygons)
+    for count, polygon in enumerate(polygons, 1):
+        sql = '''
+          SELECT s.{id}, s.area_ha, ST_AsBinary(s.geom) AS wkb
+            FROM {schema}.{buffer_table} s
+            JOIN {sample_point_feature} p ON s.{id} = p.{id}
+           WHERE p.{polygon_id} = {polygon}
+             AND NOT EXISTS (SELECT 1 FROM {schema}.{table} d WHERE d.{id} = s.{id});
+        '''.format(id = points_id.lower(),
+                   schema = schema,
+                   buffer_table = buffer_table,
+                   table = dd_table,
+                   sample_point_feature = sample_point_feature,
+                   polygon_id = polygon_id,
+                   polygon = polygon)
+        buffers = pandas.read_sql(sql, engine)
+        if len(buffers) > 0:
+            pairs = tree.query(shapely.from_wkb(buffers.wkb.apply(bytes).values), predicate = 'intersects')
+            total = np.bincount(pairs[0], weights = dwellings[pairs[1]], minlength = len(buffers))
+            # as for the SQL method, buffers intersecting no meshblock have null dwellings
+            total[np.bincount(pairs[0], minlength = len(buffers)) == 0] = np.nan
+            df = buffers[[points_id.lower(),'area_ha']].copy()
+            df['dwellings'] = total
+            df[dd_table] = total/df.area_ha
+            df[[points_id.lower(),'dwellings','area_ha',dd_table]].to_sql(dd_table, con = engine, schema = schema, index = False, if_exists = 'append')
+        progressor(count,denom,start,"{}/{} polygons processed".format(count,denom))
+
+engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
+                                                                      pwd  = db_pwd,
+                                                                      host = db_host,
+                                                                      db   = db), 
+                       use_native_hstore=False)
+
 # Connect to postgreSQL server
 conn = psycopg2.connect(database=db, user=db_user, password=db_pwd)
 curs = conn.cursor()
 print("Connection to SQL success {}".format(time.strftime("%Y%m%d-%H%M%S")) )
+print("Dwelling density method: {}".format(dwelling_density_method))
 
-# create dwelling density table
-print("create table {}... ".format(dd_table)),
-subTaskStart = time.time()
-curs.execute(createTable_dd)
-conn.commit()
-print("{:4.2f} mins.".format((time.time() - start)/60))	
- 
 try:   
-  print("fetch list of processed parcels, if any..."), 
-  # (for string match to work, had to select first item of returned tuple)
-  sql = '''
-    SELECT {id}::text 
-      FROM {schema}.{nh_geom} 
-      WHERE {id} NOT IN (SELECT {id} FROM {schema}.dd_nh1600m);
-      '''.format(id = points_id.lower(),
-                 schema = schema,
-                 nh_geom  = buffer_table)
-  curs.execute(sql)
-  point_id_list = [x[0] for x in  list(curs)]
-  print("Done.")
-  
-  if len(point_id_list) > 0:   
-    denom = len(point_id_list)
-    count = 0
-    chunkedPoints = list()
-    
-    print("Processing points...")
-    for point in point_id_list:
-      count += 1
-      chunkedPoints.append(point) 
-      if (count % sqlChunkify == 0) :
-          curs.execute('{} ({}) {}'.format(query_A,','.join("'"+x+"'" for x in chunkedPoints),query_C))
-          conn.commit()
-          chunkedPoints = list()
-          progressor(count,denom,start,"{}/{} points processed".format(count,denom))
-    if(count % sqlChunkify != 0):
-       curs.execute('{} ({}) {}'.format(query_A,','.join("'"+x+"'" for x in chunkedPoints),query_C))
-       conn.commit()
-    
-    progressor(count,denom,start,"{}/{} points processed".format(count,denom))
-  if len(point_id_list) == 0:
-    print("All point ids from the sausage buffer table are already accounted for in the dwelling density table; I think we're done, so no need to re-run this script!")
-  
+  for buffer_distance in service_areas:
+    buffer_table = "nh{}m".format(buffer_distance)
+    dd_table = 'dd_{}'.format(buffer_table)
+    if not engine.has_table(buffer_table, schema = schema):
+        print("{}: sausage buffers have not been created for {}m; skipping.".format(dd_table,buffer_distance))
+        continue
+    print("{}... ".format(dd_table)),
+    subTaskStart = time.time()
+    engine.execute(createTable_dd.format(schema = schema,
+                                         table = dd_table,
+                                         id  = points_id.lower(),
+                                         type = points_id_type))
+    if dwelling_density_method == 'shapely':
+        dwelling_density_shapely(buffer_table,dd_table)
+    else:
+        dwelling_density_sql(buffer_table,dd_table)
+    print("{:4.2f} mins.".format((time.time() - subTaskStart)/60))	
+
 except:
        print("HEY, IT'S AN ERROR:")
        print(sys.exc_info())
@@ -128,4 +184,5 @@ finally:
   script_running_log(script, task, start, locale)
 
   # clean up
-  conn.close()
\ No newline at end of file
+  conn.close()
+  engine.dispose()
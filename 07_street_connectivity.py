@@ -2,6 +2,10 @@
 # Purpose: This script calculates StreetConnectivity (3 plus leg intersections per km2)
 #          It outputs PFI, 3 legIntersections, and street connectivity to an SQL database.
 #          Buffer area is referenced in SQL table nh1600m
+#          Using the network routing engine (routing_engine = 'network'), street connectivity
+#          is recorded as a by-product of the service area search in 04_create_service_areas.py,
+#          counting intersections reachable on the network within 1600m; this script then only
+#          processes points with a service area but no street connectivity record (if any).
 # Author:  Carl Higgs
 
 # import arcpy
@@ -37,9 +37,12 @@ schema = school_schema
 conn = psycopg2.connect(dbname=db, user=db_user, password=db_pwd)
 curs = conn.cursor()  
 
-print("Copy the school destinations from gdb to postgis..."),
+# The school destinations are copied from gdb to postgis (using COPY) in a separate process,
+# while OSM school polygons are prepared in the database; school points are matched to 
+# polygons once both are loaded
+print("Copy the school destinations from gdb to postgis (in background)..."),
 command = (
-        ' ogr2ogr -overwrite -progress -f "PostgreSQL" ' 
+        ' ogr2ogr -overwrite -f "PostgreSQL" --config PG_USE_COPY YES ' 
         ' PG:"host={host} port=5432 dbname={db}  active_schema={schema} '
         ' user={user} password = {pwd}" '
         ' {gdb} "{feature}" '
@@ -52,38 +55,47 @@ command = (
                                      feature = school_destinations) 
         )
 print(command)
-sp.call(command, shell=True)
-print("Done (although, if it didn't work you can use the printed command above to do it manually)")
+school_import = sp.Popen(command, shell=True)
 
-
-
-aos_setup = ['''
-ALTER TABLE {osm_schema}.{osm_prefix}_polygon ALTER COLUMN tags TYPE hstore USING tags::hstore; 
-ALTER TABLE {osm_schema}.{osm_prefix}_point   ALTER COLUMN tags TYPE hstore USING tags::hstore; 
-ALTER TABLE {osm_schema}.{osm_prefix}_line    ALTER COLUMN tags TYPE hstore USING tags::hstore; 
-ALTER TABLE {osm_schema}.{osm_prefix}_roads   ALTER COLUMN tags TYPE hstore USING tags::hstore; 
+# OSM tags are imported as hstore by 01_study_region_setup.py; tables imported as text 
+# (ie. prior to this) are converted here
+sql = '''
+SELECT table_name 
+  FROM information_schema.columns 
+ WHERE table_schema = '{osm_schema}'
+   AND table_name IN ('{osm_prefix}_polygon','{osm_prefix}_point','{osm_prefix}_line','{osm_prefix}_roads')
+   AND column_name = 'tags'
+   AND udt_name != 'hstore';
 '''.format(osm_prefix = osm_prefix,
-           osm_schema = osm_schema),
-''' 
+           osm_schema = osm_schema)
+curs.execute(sql)
+tags_to_convert = [x[0] for x in curs.fetchall()]
+
+osm_school_setup = ['''
+ALTER TABLE {osm_schema}.{table} ALTER COLUMN tags TYPE hstore USING tags::hstore; 
+'''.format(osm_schema = osm_schema,
+           table = table) for table in tags_to_convert] + [''' 
 -- Create table for OSM school polygons
 DROP TABLE IF EXISTS {schema}.school_polys;
 CREATE TABLE {schema}.school_polys AS 
-SELECT * FROM {osm_schema}.{osm_prefix}_polygon p 
+SELECT *, 
+       NULL::jsonb AS school_tags,
+       0 AS school_count
+  FROM {osm_schema}.{osm_prefix}_polygon p 
 WHERE p.amenity IN ('school','college','university') 
    OR p.landuse IN ('school','college','university');
+CREATE INDEX school_polys_gix ON {schema}.school_polys USING GIST (geom);
+ANALYZE {schema}.school_polys;
 '''.format(osm_prefix = osm_prefix,
            osm_schema = osm_schema,
-           schema = schema),
-'''
-ALTER TABLE {schema}.school_polys ADD COLUMN school_tags jsonb;       
-ALTER TABLE {schema}.school_polys ADD COLUMN school_count int;       
-UPDATE {schema}.school_polys o SET school_count = 0;
-'''.format(schema=schema),
-'''
+           schema = schema)]
+
+school_setup = ['''
 UPDATE {schema}.school_polys t1 
    SET school_tags = jsonb(t2.school_tags), school_count = t1.school_count + t2.school_count
 FROM (-- here we aggregate and count the sets of school tags associated with school polygons
-      -- by virtue of those being for their associated schools their closest match within 100m.
+      -- by virtue of those being for their associated schools their closest match within 150m
+      -- (the nearest polygon, found using the spatial index).
       -- School points more than 100m from a polygon will remain unmatched.
       -- The basis for an allowed distance of 100m is that some points may be located at the driveway
       -- from which a school is accessed --- for some schools, this may be several hundred metres 
@@ -96,7 +108,7 @@ FROM (-- here we aggregate and count the sets of school tags associated with sch
       SELECT osm_id,
              count(*) AS school_count,
              jsonb_agg(to_jsonb(t) - 'osm_id'::text  - 'matched_school'::text  - 'school_tags'::text)  AS school_tags
-      FROM (SELECT DISTINCT ON ({school_id})
+      FROM (SELECT 
             CASE 
               WHEN ST_Intersects(schools.geom, osm.geom) THEN 0
               ELSE ST_Distance(schools.geom, ST_ExteriorRing(osm.geom))::int  
@@ -108,10 +120,14 @@ FROM (-- here we aggregate and count the sets of school tags associated with sch
                   LEFT JOIN 
                   (SELECT (jsonb_array_elements(school_tags)->>'{school_id}') AS matched_school FROM {schema}.school_polys) o 
                   ON a.{school_id}::text = o.matched_school,{studyregion} s 
-                  WHERE ST_Intersects(a.geom,s.geom) AND matched_school IS NULL) schools,
-                  {schema}.school_polys osm
-      WHERE ST_DWithin(schools.geom, ST_ExteriorRing(osm.geom), 150) OR ST_Intersects(schools.geom, osm.geom)
-      ORDER BY {school_id},ST_Distance(schools.geom, ST_ExteriorRing(osm.geom))) t
+                  WHERE ST_Intersects(a.geom,s.geom) AND matched_school IS NULL) schools
+            CROSS JOIN LATERAL
+                 (SELECT osm_id, school_tags, geom
+                    FROM {schema}.school_polys osm
+                   -- (ie. within 150m of the polygon's exterior ring, or intersecting it)
+                   WHERE ST_DWithin(schools.geom, osm.geom, 150)
+                   ORDER BY osm.geom <-> schools.geom
+                   LIMIT 1) osm) t
       GROUP BY osm_id) t2
  WHERE t1.osm_id = t2.osm_id;
 '''.format(ext_schools =  os.path.basename(school_destinations),
@@ -166,12 +182,20 @@ UPDATE {schema}.school_polys SET is_school = TRUE;
 ]
 
 
-for sql in aos_setup:
-    start = time.time()
-    print("\nExecuting: {}".format(sql))
-    curs.execute(sql)
-    conn.commit()
-    print("Executed in {} mins".format((time.time()-start)/60))
+def execute(queries):
+    for sql in queries:
+        query_start = time.time()
+        print("\nExecuting: {}".format(sql))
+        curs.execute(sql)
+        conn.commit()
+        print("Executed in {} mins".format((time.time()-query_start)/60))
+
+execute(osm_school_setup)
+print("\nWaiting for school destinations to be copied to postgis..."),
+if school_import.wait() != 0:
+    sys.exit("The school destinations could not be copied to postgis; please check the above command, which may be run manually.")
+print("Done.")
+execute(school_setup)
  
  
 # output to completion log    
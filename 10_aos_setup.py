@@ -3,8 +3,8 @@
 #           -- copies features within study region to project gdb
 #           -- calculates geodesic area in hectares
 #           -- makes temporary line feature from polygons
-#           -- traces vertices at set interval (aos_vertices in config file) -- pseudo entry points
-#           -- creates three subset features of AOS pseudo-entries, at intervals of 20, 30 and 50m from road network
+#           -- generates pseudo entry points every 20m along AOS outlines within 30m of the road network
+#              (see entry_points.py)
 #           -- Preliminary EDA suggests the 30m distance pseudo entry points will be most appropriate to use 
 #              for OD network analysis
 #
@@ -20,6 +20,11 @@ import subprocess as sp     # for executing external commands (e.g. pgsql2shp or
 import arcpy
 import time
 import psycopg2
+from sqlalchemy import create_engine
+from bulk_copy import BinaryCopyWriter
+from entry_points import entry_points_sql
+import tiled_sql
+import union_find
 from script_running_log import script_running_log
 
 # Import custom variables for National Liveability indicator process
@@ -33,11 +38,6 @@ task = 'Prepare Areas of Open Space (AOS)'
 # schema where point indicator output tables will be stored
 schema = open_space_schema
 
-# connect to the PostgreSQL server and ensure privileges are granted for all public tables
-conn = psycopg2.connect(dbname=db, user=db_user, password=db_pwd)
-curs = conn.cursor()  
-
-
 # Define tags for which presence of values is suggestive of some kind of open space 
 # These are defined in the _project_configuration worksheet 'open_space_defs' under the 'possible_os_tags' column.
 
@@ -69,12 +69,58 @@ additional_public_criteria = additional_public_criteria)
     
 os_add_as_tags = ',\n'.join(['"{}"'.format(x.encode('utf')) for x in df_osm["os_add_as_tags"].dropna().tolist()])
 
+# Statements containing a {tile} placeholder are run for each tile of open space features
+# (of aos_tile_size metres) in parallel across nWorkers processes (see tiled_sql.py).  
+# Statements which set a value based on the same value of other features (e.g. the public 
+# access cascade) are run for all features at once, so that results are as for a single statement.
+
+
+# Candidate pairs of open spaces with overlapping bounding boxes (for features o of each tile), 
+# and their spatial relations (see open_space_pairs table definition below)
+open_space_pairs = '''
+INSERT INTO {schema}.open_space_pairs
+SELECT o.os_id AS o_id,
+       x.os_id AS x_id,
+       ST_CoveredBy(o.geom,x.geom) AS covered_by,
+       ST_Within(o.geom,x.geom) AS within,
+       i.intersection_area,
+       i.intersection_length,
+       i.touches
+  FROM {schema}.open_space o
+  JOIN {schema}.open_space x ON o.geom && x.geom
+                            AND o.os_id != x.os_id
+  LEFT JOIN LATERAL 
+       (SELECT ST_Area(g) AS intersection_area,
+               ST_Length(ST_CollectionExtract(g, 2)) AS intersection_length,
+               ST_Touches(o.geom,x.geom) AS touches
+          FROM (SELECT ST_Intersection(o.geom,x.geom) AS g) t
+         WHERE o.linear_feature IS TRUE
+           AND o.min_bounding_circle_diameter < 800) i ON TRUE
+ WHERE o.tile = {{tile}}
+   AND {pair_criteria};
+'''
+
+aos_query = '''
+SELECT cluster_id as aos_id, 
+       jsonb_agg(jsonb_strip_nulls(to_jsonb((SELECT d FROM (SELECT {os_add_as_tags}) d)) 
+         || hstore_to_jsonb(tags) 
+         || jsonb_build_object('school_tags',school_tags) 
+         || jsonb_build_object('tags_line',tags_line)
+         || jsonb_build_object('tags_point',tags_point))) AS attributes,
+       COUNT(1) AS numgeom,
+       ST_Union(geom_public) AS geom_public,
+       ST_Union(geom_not_public) AS geom_not_public,
+       ST_Union(water_geom) AS geom_water,
+       ST_Union(geom) AS geom
+  FROM {schema}.open_space
+ INNER JOIN {schema}.open_space_clusters c USING (os_id)'''.format(os_add_as_tags = os_add_as_tags,schema=schema)
 
 aos_setup = ['''
 -- Create a 'Not Open Space' table
+-- (excluded regions are not unioned; each open space is differenced with the union of those it intersects)
 DROP TABLE IF EXISTS {schema}.not_open_space;
 CREATE TABLE {schema}.not_open_space AS 
-SELECT ST_Union(geom) AS geom FROM {osm_schema}.{osm_prefix}_polygon p 
+SELECT geom FROM {osm_schema}.{osm_prefix}_polygon p 
 WHERE {exclusion_criteria};
 '''.format(osm_prefix = osm_prefix, 
            osm_schema = osm_schema,
@@ -100,12 +146,20 @@ ALTER TABLE {schema}.open_space ADD COLUMN os_id SERIAL PRIMARY KEY;
 CREATE INDEX open_space_idx ON {schema}.open_space USING GIST (geom);
 CREATE INDEX  not_open_space_idx ON {schema}.not_open_space USING GIST (geom);
 '''.format(schema=schema),
+tiled_sql.assign_tiles_sql('{schema}.open_space'.format(schema=schema), aos_tile_size),
 '''
 -- Remove any portions of open space geometry intersecting excluded regions
 UPDATE {schema}.open_space p 
    SET geom = ST_Difference(p.geom,x.geom)
-  FROM {schema}.not_open_space x
- WHERE ST_Intersects(p.geom,x.geom);
+  FROM (SELECT o.os_id, 
+               ST_Union(n.geom) AS geom
+          FROM {schema}.open_space o
+          JOIN {schema}.not_open_space n ON ST_Intersects(o.geom,n.geom)
+         WHERE o.tile = {{tile}}
+         GROUP BY o.os_id) x
+ WHERE p.os_id = x.os_id;
+'''.format(schema=schema),
+'''
 -- Drop any empty geometries (ie. those which were wholly covered by excluded regions)
 DELETE FROM {schema}.open_space WHERE ST_IsEmpty(geom);
 '''.format(schema=schema),
@@ -117,11 +171,14 @@ UPDATE {schema}.open_space SET area_ha = ST_Area(geom)/10000.0;
 '''
 -- Create variable for associated line tags
 ALTER TABLE {schema}.open_space ADD COLUMN tags_line jsonb; 
+'''.format(schema=schema),
+'''
 WITH tags AS ( 
 SELECT o.os_id,
        jsonb_strip_nulls(to_jsonb((SELECT d FROM (SELECT l.amenity,l.leisure,l."natural",l.tourism,l.waterway) d)))AS attributes 
 FROM {osm_schema}.{osm_prefix}_line  l,{schema}.open_space o
-WHERE ST_Intersects (l.geom,o.geom) )
+WHERE ST_Intersects (l.geom,o.geom) 
+  AND o.tile = {{tile}})
 UPDATE {schema}.open_space o SET tags_line = attributes
 FROM (SELECT os_id, 
              jsonb_agg(distinct(attributes)) AS attributes
@@ -138,11 +195,14 @@ WHERE o.os_id = t.os_id
 '''
 -- Create variable for associated point tags
 ALTER TABLE {schema}.open_space ADD COLUMN tags_point jsonb; 
+'''.format(schema=schema),
+'''
 WITH tags AS ( 
 SELECT o.os_id,
        jsonb_strip_nulls(to_jsonb((SELECT d FROM (SELECT l.amenity,l.leisure,l."natural",l.tourism,l.historic) d)))AS attributes 
 FROM {osm_schema}.{osm_prefix}_point l,{schema}.open_space o
-WHERE ST_Intersects (l.geom,o.geom) )
+WHERE ST_Intersects (l.geom,o.geom) 
+  AND o.tile = {{tile}})
 UPDATE {schema}.open_space o SET tags_point = attributes
 FROM (SELECT os_id, 
              jsonb_agg(distinct(attributes)) AS attributes
@@ -188,15 +248,15 @@ UPDATE {schema}.open_space SET water_geom = geom WHERE water_feature = TRUE;
 '''.format(schema=schema),
 '''
 ALTER TABLE {schema}.open_space ADD COLUMN min_bounding_circle_area double precision; 
-UPDATE {schema}.open_space SET min_bounding_circle_area = ST_Area(ST_MinimumBoundingCircle(geom));
-'''.format(schema=schema),
-'''
 ALTER TABLE {schema}.open_space ADD COLUMN min_bounding_circle_diameter double precision; 
-UPDATE {schema}.open_space SET min_bounding_circle_diameter = 2*sqrt(min_bounding_circle_area / pi());
+ALTER TABLE {schema}.open_space ADD COLUMN roundness double precision; 
 '''.format(schema=schema),
 '''
-ALTER TABLE {schema}.open_space ADD COLUMN roundness double precision; 
-UPDATE {schema}.open_space SET roundness = ST_Area(geom)/(ST_Area(ST_MinimumBoundingCircle(geom)));
+UPDATE {schema}.open_space SET min_bounding_circle_area = ST_Area(ST_MinimumBoundingCircle(geom)),
+                               roundness = ST_Area(geom)/(ST_Area(ST_MinimumBoundingCircle(geom)))
+ WHERE tile = {{tile}};
+UPDATE {schema}.open_space SET min_bounding_circle_diameter = 2*sqrt(min_bounding_circle_area / pi())
+ WHERE tile = {{tile}};
 '''.format(schema=schema),
 '''
 -- Create indicator for linear features informed through EDA of OS topology
@@ -209,52 +269,83 @@ WHERE {linear_feature_criteria};
 ---- Create 'Acceptable Linear Feature' indicator
 ALTER TABLE {schema}.open_space ADD COLUMN acceptable_linear_feature boolean;
 UPDATE {schema}.open_space SET acceptable_linear_feature = FALSE WHERE linear_feature = TRUE;
+-- Candidate pairs of open spaces (o,x) with overlapping bounding boxes, for which the spatial 
+-- relations used to set the following indicators are evaluated once
+--   covered_by, within: o is covered by, or within, x
+--   intersection_area, intersection_length, touches: the area, and length of linear components, 
+--     of the intersection of o and x, and whether they touch (evaluated where o is a linear 
+--     feature with minimum bounding circle diameter less than 800m, as only used for these)
+DROP TABLE IF EXISTS {schema}.open_space_pairs;
+CREATE UNLOGGED TABLE {schema}.open_space_pairs 
+(o_id integer NOT NULL,
+ x_id integer NOT NULL,
+ covered_by boolean,
+ within boolean,
+ intersection_area double precision,
+ intersection_length double precision,
+ touches boolean
+);
+'''.format(schema=schema),
+open_space_pairs.format(schema=schema, pair_criteria = 'TRUE'),
+'''
+CREATE INDEX open_space_pairs_o_idx ON {schema}.open_space_pairs (o_id);
+CREATE INDEX open_space_pairs_x_idx ON {schema}.open_space_pairs (x_id);
+ANALYZE {schema}.open_space_pairs;
+'''.format(schema=schema),
+'''
 UPDATE {schema}.open_space o SET acceptable_linear_feature = TRUE
-FROM (SELECT os_id,geom FROM {schema}.open_space WHERE linear_feature = FALSE) nlf
-WHERE o.linear_feature IS TRUE  
+  FROM {schema}.open_space_pairs p
+  JOIN {schema}.open_space nlf ON p.x_id = nlf.os_id
+WHERE p.o_id = o.os_id
+ AND o.linear_feature IS TRUE  
+ AND nlf.linear_feature = FALSE
+ AND o.tile = {{tile}}
  AND  (
       -- acceptable if within a non-linear feature
-      ST_Within(o.geom,nlf.geom)
+      p.within
  OR  (
       -- acceptable if it intersects a non-linear feature if it is not too long 
       -- and it has some reasonably strong relation with a non-linear feature
       o.min_bounding_circle_diameter < 800
       AND (
            -- a considerable proportion of geometry is within the non-linear feature
-          (ST_Intersects(o.geom,nlf.geom)
-          AND
-          (st_area(st_intersection(o.geom,nlf.geom))/st_area(o.geom)) > .2)
+          (p.intersection_area/st_area(o.geom)) > .2
        OR (
            -- acceptable if there is sufficent conjoint distance (> 50m) with a nlf
-          ST_Length(ST_CollectionExtract(ST_Intersection(o.geom,nlf.geom), 2)) > 50
+          p.intersection_length > 50
           AND o.os_id < nlf.os_id 
-          AND ST_Touches(o.geom,nlf.geom))))
+          AND p.touches)))
        );     
+'''.format(schema=schema),
+'''
 -- a feature identified as linear is acceptable as an OS if it is
 --  large enough to contain an OS of sufficient size (0.4 Ha?) 
 -- (suggests it may be an odd shaped park with a lake; something like that)
 -- Still, if it is really big its acceptability should be constrained
 -- hence limit of min bounding circle diameter
 UPDATE {schema}.open_space o SET acceptable_linear_feature = TRUE
-FROM {schema}.open_space alt
-WHERE o.linear_feature IS TRUE      
+FROM {schema}.open_space_pairs p
+WHERE p.o_id = o.os_id
+ AND  o.linear_feature IS TRUE      
+ AND  o.tile = {{tile}}
  AND  o.acceptable_linear_feature IS FALSE    
  AND o.min_bounding_circle_diameter < 800
- AND  o.geom && alt.geom 
-  AND st_area(st_intersection(o.geom,alt.geom))/10000.0 > 0.4
-  AND o.os_id != alt.os_id;
+  AND p.intersection_area/10000.0 > 0.4;
 '''.format(schema=schema),
 '''
 -- Set up OS for distinction based on location within a school
 ALTER TABLE {schema}.open_space ADD COLUMN in_school boolean; 
 UPDATE {schema}.open_space SET in_school = FALSE;
-UPDATE {schema}.open_space SET in_school = TRUE 
-  FROM {school_schema}.school_polys 
- WHERE ST_CoveredBy(open_space.geom,school_polys.geom);
 ALTER TABLE {schema}.open_space ADD COLUMN is_school boolean; 
 UPDATE {schema}.open_space SET is_school = FALSE;
 '''.format(school_schema=school_schema,schema=schema),
 '''
+UPDATE {schema}.open_space SET in_school = TRUE 
+  FROM {school_schema}.school_polys 
+ WHERE ST_CoveredBy(open_space.geom,school_polys.geom)
+   AND open_space.tile = {{tile}};
+'''.format(school_schema=school_schema,schema=schema),
+'''
 -- Insert school polygons in open space, restricting to relevant de-identified subset of tags (ie. no school names, contact details, etc)
 ALTER TABLE {schema}.open_space ADD COLUMN school_tags jsonb; 
 INSERT INTO {schema}.open_space (amenity,area_ha,school_tags,tags,is_school,geom)
@@ -276,6 +367,12 @@ SELECT  amenity,
 FROM {school_schema}.school_polys;
 '''.format(schema=schema,
            school_schema=school_schema),
+tiled_sql.assign_tiles_sql('{schema}.open_space'.format(schema=schema), aos_tile_size),
+# add candidate pairs of open spaces involving school polygons
+open_space_pairs.format(schema=schema, pair_criteria = '(o.is_school IS TRUE OR x.is_school IS TRUE)'),
+'''
+ANALYZE {schema}.open_space_pairs;
+'''.format(schema=schema),
 '''
 -- Remove potentially identifying tags from records
 UPDATE {schema}.open_space SET tags =  tags - {exclude_tags_like_name} - ARRAY[{identifying_tags}]
@@ -303,12 +400,16 @@ UPDATE {schema}.open_space SET public_access = TRUE
  -- Check if area is within an indicated public access area
  ALTER TABLE {schema}.open_space ADD COLUMN within_public boolean;
  UPDATE {schema}.open_space SET within_public = FALSE;
+'''.format(schema=schema),
+ '''
  UPDATE {schema}.open_space o
     SET within_public = TRUE
-   FROM {schema}.open_space x
-  WHERE x.public_access = TRUE
-    AND ST_CoveredBy(o.geom,x.geom)
-    AND o.os_id!=x.os_id;
+   FROM {schema}.open_space_pairs p
+   JOIN {schema}.open_space x ON p.x_id = x.os_id
+  WHERE p.o_id = o.os_id
+    AND x.public_access = TRUE
+    AND o.tile = {{tile}}
+    AND p.covered_by;
 '''.format(schema=schema),
  '''
  -- Check if area is within an indicated not public access area
@@ -316,11 +417,12 @@ UPDATE {schema}.open_space SET public_access = TRUE
  -- this additional check is required to ensure within_public is set to false
  UPDATE {schema}.open_space o 
     SET public_access = FALSE
-   FROM {schema}.open_space x
-  WHERE o.public_access = TRUE
+   FROM {schema}.open_space_pairs p
+   JOIN {schema}.open_space x ON p.x_id = x.os_id
+  WHERE p.o_id = o.os_id
+    AND o.public_access = TRUE
     AND x.public_access = FALSE
-    AND ST_CoveredBy(o.geom,x.geom)
-    AND o.os_id!=x.os_id;
+    AND p.covered_by;
 '''.format(schema=schema),
  '''
  -- If an open space is within or co-extant with a space flagged as not having public access
@@ -328,11 +430,13 @@ UPDATE {schema}.open_space SET public_access = TRUE
  -- then it too should be flagged as not public (ie. public_access = FALSE)
  UPDATE {schema}.open_space o
     SET public_access = FALSE
-   FROM {schema}.open_space x
-  WHERE o.public_access = TRUE 
+   FROM {schema}.open_space_pairs p
+   JOIN {schema}.open_space x ON p.x_id = x.os_id
+  WHERE p.o_id = o.os_id
+    AND o.public_access = TRUE 
     AND x.public_access = FALSE
     AND x.within_public = FALSE
-    AND ST_CoveredBy(o.geom,x.geom);
+    AND p.covered_by;
 '''.format(schema=schema),
 '''
 ALTER TABLE {schema}.open_space ADD COLUMN IF NOT EXISTS geom_public geometry; 
@@ -341,6 +445,60 @@ UPDATE {schema}.open_space SET geom_public = geom WHERE public_access = TRUE;
 UPDATE {schema}.open_space SET geom_not_public = geom WHERE public_access = FALSE;
 '''.format(schema=schema),
 '''
+-- Identify the group within which each open space is clustered to form Areas of Open Space (AOS)
+--   1: public open space (and acceptable not public or linear features within public open space)
+--   2: not public open space, not within public open space
+--   3: public linear features which are not acceptable as open space (not clustered)
+--   4: linear waterways (not clustered)
+-- Open space in (or being) schools is not included in AOS, other than in group 2
+--  (this implicitly includes schools; these could instead be clustered as a further group)
+ALTER TABLE {schema}.open_space ADD COLUMN IF NOT EXISTS cluster_group smallint;
+UPDATE {schema}.open_space 
+   SET cluster_group = CASE 
+         WHEN (public_access IS TRUE
+               OR
+               (public_access IS FALSE
+                AND
+                within_public IS TRUE
+                AND (acceptable_linear_feature IS TRUE
+                     OR 
+                     linear_feature IS FALSE)))
+          AND in_school IS FALSE 
+          AND is_school IS FALSE
+          AND (linear_feature IS FALSE 
+               OR 
+               acceptable_linear_feature IS TRUE)
+          AND linear_waterway IS NULL THEN 1
+         WHEN public_access IS FALSE
+          AND within_public IS FALSE
+          AND linear_waterway IS NULL THEN 2
+         WHEN (linear_feature IS TRUE 
+               AND acceptable_linear_feature IS FALSE
+               AND in_school IS FALSE 
+               AND is_school IS FALSE)
+          AND public_access IS TRUE
+          AND linear_waterway IS NULL THEN 3
+         WHEN linear_waterway IS TRUE THEN 4
+       END;
+-- (candidate pairs used to set the above indicators are no longer required)
+DROP TABLE IF EXISTS {schema}.open_space_pairs;
+-- Pairs of open spaces within the clustering distance of each other, in clustered groups
+DROP TABLE IF EXISTS {schema}.open_space_cluster_pairs;
+CREATE UNLOGGED TABLE {schema}.open_space_cluster_pairs (a integer, b integer);
+'''.format(schema=schema),
+'''
+INSERT INTO {schema}.open_space_cluster_pairs (a, b)
+SELECT a.os_id, b.os_id
+  FROM {schema}.open_space a
+  JOIN {schema}.open_space b ON a.cluster_group = b.cluster_group
+                            AND a.os_id < b.os_id
+                            AND ST_DWithin(a.geom, b.geom, .001)
+ WHERE a.tile = {{tile}}
+   AND a.cluster_group IN (1,2);
+'''.format(schema=schema)
+]
+
+aos_areas = ['''
 -- Create Areas of Open Space (AOS) table
 -- this includes schools and contains indicators to differentiate schools, and parks within schools
 -- the 'geom' attributes is the area within an AOS not including a school
@@ -351,73 +509,21 @@ UPDATE {schema}.open_space SET geom_not_public = geom WHERE public_access = FALS
 --    -- can always be excluded from analysis, or an analysis can be restricted to focus on these.
 --    -- contains a subset of anonymised tags present for the school itself 
 --    -- specifically, 'designation', 'fee', 'grades', 'isced', 'school:gender', 'school:enrolment', 'school:selective', 'school:specialty'
-
+-- Open space features are clustered by cluster_open_space() (the clusters of each group being 
+-- those of ST_ClusterWithin(geom, .001)), and AOS are constructed for each tile in parallel, 
+-- each cluster being constructed in the tile of its first feature
 DROP TABLE IF EXISTS {schema}.open_space_areas; 
 CREATE TABLE {schema}.open_space_areas AS 
-WITH clusters AS(
-    SELECT unnest(ST_ClusterWithin(open_space.geom, .001)) AS gc
-      FROM {schema}.open_space 
-     WHERE (public_access IS TRUE
-           OR
-           (public_access IS FALSE
-            AND
-            within_public IS TRUE
-            AND (acceptable_linear_feature IS TRUE
-                 OR 
-                 linear_feature IS FALSE)))
-       AND in_school IS FALSE 
-       AND is_school IS FALSE
-       AND (linear_feature IS FALSE 
-            OR 
-            acceptable_linear_feature IS TRUE)
-       AND linear_waterway IS NULL
-  UNION
-    SELECT unnest(ST_ClusterWithin(not_public_os.geom, .001)) AS gc
-      FROM {schema}.open_space AS not_public_os
-     WHERE public_access IS FALSE
-       AND within_public IS FALSE
-       AND linear_waterway IS NULL
-  ----  This implicitly includes schools unless the following code is uncommented
-  --     AND in_school IS FALSE 
-  --     AND is_school IS FALSE
-  -- UNION
-  --   SELECT  unnest(ST_ClusterWithin(school_os.geom, .001)) AS gc
-  --     FROM {schema}.open_space AS school_os 
-  --    WHERE (in_school IS TRUE 
-  --       OR is_school IS TRUE)
-  --      AND linear_waterway IS NULL
-  UNION
-    SELECT  linear_os.geom AS gc
-      FROM {schema}.open_space AS linear_os 
-     WHERE (linear_feature IS TRUE 
-       AND acceptable_linear_feature IS FALSE
-       AND in_school IS FALSE 
-       AND is_school IS FALSE)
-       AND public_access IS TRUE
-       AND linear_waterway IS NULL
-  UNION
-    SELECT  waterway_os.geom AS gc
-      FROM {schema}.open_space AS waterway_os 
-     WHERE linear_waterway IS TRUE
-       )
-, unclustered AS( --unpacking GeomCollections
-    SELECT row_number() OVER () AS cluster_id, (ST_DUMP(gc)).geom AS geom 
-       FROM clusters)
-SELECT cluster_id as aos_id, 
-       jsonb_agg(jsonb_strip_nulls(to_jsonb((SELECT d FROM (SELECT {os_add_as_tags}) d)) 
-         || hstore_to_jsonb(tags) 
-         || jsonb_build_object('school_tags',school_tags) 
-         || jsonb_build_object('tags_line',tags_line)
-         || jsonb_build_object('tags_point',tags_point))) AS attributes,
-       COUNT(1) AS numgeom,
-       ST_Union(geom_public) AS geom_public,
-       ST_Union(geom_not_public) AS geom_not_public,
-       ST_Union(water_geom) AS geom_water,
-       ST_Union(geom) AS geom
-       FROM {schema}.open_space
-       INNER JOIN unclustered USING(geom)
-       GROUP BY cluster_id;   
-'''.format(os_add_as_tags = os_add_as_tags,schema=schema),
+{aos_query}
+ WHERE FALSE
+ GROUP BY cluster_id;   
+'''.format(aos_query = aos_query, schema=schema),
+'''
+INSERT INTO {schema}.open_space_areas
+{aos_query}
+ WHERE c.tile = {{tile}}
+ GROUP BY cluster_id;   
+'''.format(aos_query = aos_query, schema=schema),
 ''' 
 CREATE UNIQUE INDEX aos_idx ON {schema}.open_space_areas (aos_id);  
 CREATE INDEX idx_aos_jsb ON {schema}.open_space_areas USING GIN (attributes);
@@ -462,34 +568,13 @@ WITH school_bounds AS
 SELECT aos_id, ST_Length(geom)::numeric AS length, geom    
 FROM (SELECT aos_id, ST_ExteriorRing(geom) AS geom FROM school_bounds) t;
 '''.format(srid=srid,schema=schema),
-'''
--- Generate a point every 20m along a park outlines: 
-DROP TABLE IF EXISTS {schema}.aos_nodes; 
-CREATE TABLE {schema}.aos_nodes AS 
- WITH aos AS 
- (SELECT aos_id, 
-         length, 
-         generate_series(0,1,20/length) AS fraction, 
-         geom FROM {schema}.aos_line) 
-SELECT aos_id,
-       row_number() over(PARTITION BY aos_id) AS node, 
-       ST_LineInterpolatePoint(geom, fraction)  AS geom 
-FROM aos;
-
-CREATE INDEX aos_nodes_idx ON {schema}.aos_nodes USING GIST (geom);
-ALTER TABLE {schema}.aos_nodes ADD COLUMN aos_entryid varchar; 
-UPDATE {schema}.aos_nodes SET aos_entryid = aos_id::text || ',' || node::text; 
-'''.format(schema=schema),
-'''
--- Create table of points within 30m of lines (should be your road network) 
--- Distinct is used to avoid redundant duplication of points where they are within 20m of multiple roads 
-DROP TABLE IF EXISTS {schema}.aos_nodes_30m_line;
-CREATE TABLE {schema}.aos_nodes_30m_line AS 
-SELECT DISTINCT n.* 
-FROM {schema}.aos_nodes n, 
-     {network_schema}.edges l
-WHERE ST_DWithin(n.geom ,l.geom,30);
-'''.format(osm_prefix = osm_prefix,schema=schema,network_schema=network_schema),
+entry_points_sql(source = '{schema}.aos_line'.format(schema=schema),
+                 id = 'aos_id',
+                 output = '{schema}.aos_nodes_30m_line'.format(schema=schema),
+                 entry_id = 'aos_entryid',
+                 interval = 20,
+                 distance = 30,
+                 network_schema = network_schema),
 '''
 -- Create subset data for public_open_space_areas
 DROP TABLE IF EXISTS {schema}.aos_public_osm;
@@ -503,49 +588,101 @@ SELECT DISTINCT ON (pos.aos_id) pos.*
 '''.format(schema=schema)
 ]
 
-for sql in aos_setup:
-    start = time.time()
+def execute(sql):
+    ''' Execute a statement (for each tile in parallel, if tiled) '''
+    statement_start = time.time()
     print("\nExecuting: {}".format(sql))
-    curs.execute(sql)
+    if '{tile}' in sql:
+        failed = tiled_sql.execute(engine, sql, tiled_sql.tiles(engine, '{}.open_space'.format(schema)), processes = nWorkers)
+        if len(failed) > 0:
+            sys.exit("The above statement returned errors for tiles {}; please check and re-run.".format(', '.join(failed)))
+    else:
+        curs.execute(sql)
+        conn.commit()
+    print("Executed in {} mins".format((time.time()-statement_start)/60))
+
+def cluster_open_space():
+    '''
+    Cluster open space features as the connected components of pairs within clustering
+    distance (recorded for each tile), merging clusters which cross tile edges.  Clusters are
+    numbered in order of their first feature, and assigned to the tile of this feature.
+    '''
+    statement_start = time.time()
+    print("\nClustering open space features... "),
+    sql = '''SELECT os_id, tile FROM {schema}.open_space WHERE cluster_group IS NOT NULL ORDER BY os_id;'''.format(schema=schema)
+    features = pandas.read_sql(sql, engine)
+    pairs = engine.execute('''SELECT a, b FROM {schema}.open_space_cluster_pairs;'''.format(schema=schema)).fetchall()
+    clusters = union_find.components(features.os_id.tolist(), pairs)
+    cluster_tiles = {}
+    curs.execute('''
+      DROP TABLE IF EXISTS {schema}.open_space_clusters;
+      CREATE TABLE {schema}.open_space_clusters (os_id integer PRIMARY KEY, cluster_id bigint, tile text);
+      '''.format(schema=schema))
+    writer = BinaryCopyWriter(curs, '{}.open_space_clusters'.format(schema), ['os_id','cluster_id','tile'], ['int4','int8','text'])
+    for os_id, tile in features[['os_id','tile']].itertuples(index = False):
+        cluster_id = clusters[os_id]
+        if cluster_id not in cluster_tiles:
+            cluster_tiles[cluster_id] = tile
+        writer.write((int(os_id), cluster_id, cluster_tiles[cluster_id]))
+    writer.close()
+    curs.execute('''
+      CREATE INDEX open_space_clusters_tile_idx ON {schema}.open_space_clusters (tile);
+      DROP TABLE {schema}.open_space_cluster_pairs;
+      '''.format(schema=schema))
+    conn.commit()
+    print("{} features in {} clusters ({} pairs); executed in {} mins".format(len(features), len(cluster_tiles), len(pairs), (time.time()-statement_start)/60))
+
+if __name__ == '__main__':
+    # connect to the PostgreSQL server and ensure privileges are granted for all public tables
+    conn = psycopg2.connect(dbname=db, user=db_user, password=db_pwd)
+    curs = conn.cursor()  
+    engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
+                                                                          pwd  = db_pwd,
+                                                                          host = db_host,
+                                                                          db   = db), 
+                           use_native_hstore=False)
+    for sql in aos_setup:
+        execute(sql)
+    cluster_open_space()
+    for sql in aos_areas:
+        execute(sql)
+     
+    # pgsql to gdb
+    print("Copy nodes to ArcGIS gdb... "),
+    curs.execute(grant_query)
     conn.commit()
-    print("Executed in {} mins".format((time.time()-start)/60))
- 
- 
-# pgsql to gdb
-print("Copy nodes to ArcGIS gdb... "),
-curs.execute(grant_query)
-conn.commit()
-arcpy.env.workspace = db_sde_path
-arcpy.env.overwriteOutput = True 
+    arcpy.env.workspace = db_sde_path
+    arcpy.env.overwriteOutput = True 
 
 
-print("Exporting to GPKG as intermediary step in case of automated copy failure; can then manually copy to the study region gdb")
-# note assumptions which must be met that 
-#  1. ogr2ogr will locate tables in different schemas
-#  2. tables in different schemas have unique names within overall database
-features = [[schema,'aos_nodes_30m_line']]
-processing_gpkg = os.path.join(folderPath,'study_region',locale,'{}_processing.gpkg'.format(locale))
-for t in features:
-    schema = t[0]
-    table = t[1]
-    command = (
-            ' ogr2ogr -overwrite -f GPKG  '
-            ' {gpkg} ' 
-            ' PG:"host={host} port=5432 dbname={db} user={user} password = {pwd} active_schema={schema}" '
-            ' {table} '.format(gpkg = processing_gpkg,
-                                schema = schema,
-                                host = db_host,
-                                db = db,
-                                user = db_user,
-                                pwd = db_pwd,
-                                table = table
-                                )
-    )                              
-    sp.call(command, shell=True)
-    arcpy.CopyFeatures_management('{}/{}'.format(processing_gpkg,table), os.path.join(gdb_path,table))
+    print("Exporting to GPKG as intermediary step in case of automated copy failure; can then manually copy to the study region gdb")
+    # note assumptions which must be met that 
+    #  1. ogr2ogr will locate tables in different schemas
+    #  2. tables in different schemas have unique names within overall database
+    features = [[schema,'aos_nodes_30m_line']]
+    processing_gpkg = os.path.join(folderPath,'study_region',locale,'{}_processing.gpkg'.format(locale))
+    for t in features:
+        schema = t[0]
+        table = t[1]
+        command = (
+                ' ogr2ogr -overwrite -f GPKG  '
+                ' {gpkg} ' 
+                ' PG:"host={host} port=5432 dbname={db} user={user} password = {pwd} active_schema={schema}" '
+                ' {table} '.format(gpkg = processing_gpkg,
+                                    schema = schema,
+                                    host = db_host,
+                                    db = db,
+                                    user = db_user,
+                                    pwd = db_pwd,
+                                    table = table
+                                    )
+        )                              
+        sp.call(command, shell=True)
+        arcpy.CopyFeatures_management('{}/{}'.format(processing_gpkg,table), os.path.join(gdb_path,table))
 
-print("Done.")
+    print("Done.")
 
-# output to completion log    
-script_running_log(script, task, start, locale)
-conn.close()
+    # output to completion log    
+    script_running_log(script, task, start, locale)
+    conn.close()
+    engine.dispose()
@@ -1,6 +1,9 @@
 import subprocess as sp     # for executing external commands (e.g. pgsql2shp or ogr2ogr)
 import time
 import psycopg2
+from bulk_copy import BinaryCopyWriter
+from entry_points import entry_points_sql
+import union_find
 from script_running_log import script_running_log
 
 # Import custom variables for National Liveability indicator process
@@ -39,60 +42,73 @@ sql_queries = ['''
            AND (oneway!='yes' OR oneway IS NULL)
            ;
     CREATE INDEX paths_offroad_gix ON network.paths_offroad USING GIST(geom);
-    ''',
-    '''
+    ALTER TABLE network.paths_offroad ADD COLUMN segment_id serial PRIMARY KEY;
+    ''']
+
+# Off road path segments are clustered as the connected components of intersecting segments
+# (equivalent to ST_ClusterIntersecting), with pairs of intersecting segments found using 
+# the spatial index and merged using union-find, in place of aggregating all paths in memory
+cluster_queries = ['''
     -- Connected off road paths data set (contiguous path must be > 200m in length)
+    -- Paths are numbered in order of their first segment
     DROP TABLE IF EXISTS network.paths_offroad_contiguous;
     CREATE TABLE network.paths_offroad_contiguous AS
-    SELECT ROW_NUMBER() OVER () AS path_id, 
+    SELECT ROW_NUMBER() OVER (ORDER BY cluster_id) AS path_id, 
            ST_Length(geom)::int AS length,
            geom
-    FROM (SELECT        
-          ST_UnaryUnion(unnest(ST_ClusterIntersecting(geom))) geom
-    FROM network.paths_offroad) t
+    FROM (SELECT c.cluster_id,
+                 ST_UnaryUnion(ST_Collect(p.geom)) geom
+            FROM network.paths_offroad p
+            JOIN network.paths_offroad_clusters c USING (segment_id)
+           GROUP BY c.cluster_id) t
     -- limit to paths of over 200m length, so we know these are meaningful
     -- off road paths, not just an incidental cut through
     WHERE ST_Length(geom) > 200;
+    DROP TABLE network.paths_offroad_clusters;
     ''',
-    '''
-    -- Generate access points every 20m along path outlines, 
-    -- retaining those within 30m of the walkable network'
-    DROP TABLE IF EXISTS destinations.off_road_path_access_points; 
-    CREATE TABLE destinations.off_road_path_access_points AS 
-     WITH 
-     segments AS 
-     -- split geometries into seperate line strings
-     (SELECT path_id,
-             (ST_Dump(geom)).geom
-      FROM network.paths_offroad_contiguous
-     ),
-     path AS 
-     -- create records for series of intervals required along each line
-     (SELECT path_id, 
-             generate_series(0,1,20/ST_length(geom)::numeric) AS fraction, 
-             geom FROM segments),
-    off_road_path_access_points AS
-    -- create path entry points at regular intervals
-    (SELECT path_id,
-           row_number() over(PARTITION BY path_id) AS node, 
-           ST_LineInterpolatePoint(path.geom, fraction)  AS geom 
-    FROM path)
-    SELECT DISTINCT n.* 
-    FROM off_road_path_access_points n,
-          network.edges l
-    WHERE ST_DWithin(n.geom ,l.geom,30);
+    # Generate access points every 20m along paths, retaining those within 30m of the walkable network
+    entry_points_sql(source = 'network.paths_offroad_contiguous',
+                     id = 'path_id',
+                     output = 'destinations.off_road_path_access_points',
+                     entry_id = 'path_entryid',
+                     interval = 20,
+                     distance = 30)]
 
-    CREATE INDEX off_road_path_access_points_idx ON destinations.off_road_path_access_points USING GIST (geom);
-    ALTER TABLE destinations.off_road_path_access_points ADD COLUMN path_entryid varchar; 
-    UPDATE destinations.off_road_path_access_points SET path_entryid = path_id::text || ',' || node::text; 
-    ''']
-
-for sql in sql_queries:
-    start = time.time()
-    print("\nExecuting: {}".format(sql))
-    curs.execute(sql)
+def cluster_paths():
+    ''' Record the cluster of contiguous (ie. intersecting) off road path segments '''
+    print("\nClustering contiguous off road path segments... "),
+    curs.execute('''SELECT segment_id FROM network.paths_offroad ORDER BY segment_id;''')
+    segments = [x[0] for x in curs.fetchall()]
+    curs.execute('''
+      SELECT a.segment_id, b.segment_id
+        FROM network.paths_offroad a
+        JOIN network.paths_offroad b ON a.segment_id < b.segment_id
+                                    AND ST_Intersects(a.geom, b.geom);
+      ''')
+    pairs = curs.fetchall()
+    clusters = union_find.components(segments, pairs)
+    curs.execute('''
+      DROP TABLE IF EXISTS network.paths_offroad_clusters;
+      CREATE TABLE network.paths_offroad_clusters (segment_id integer PRIMARY KEY, cluster_id integer);
+      ''')
+    writer = BinaryCopyWriter(curs, 'network.paths_offroad_clusters', ['segment_id','cluster_id'], ['int4','int4'])
+    for segment_id in segments:
+        writer.write((segment_id, clusters[segment_id]))
+    writer.close()
     conn.commit()
-    print("Executed in {} mins".format((time.time()-start)/60))
+    print("{} segments in {} clusters.".format(len(segments), len(set(clusters.values()))))
+
+def execute(queries):
+    for sql in queries:
+        query_start = time.time()
+        print("\nExecuting: {}".format(sql))
+        curs.execute(sql)
+        conn.commit()
+        print("Executed in {} mins".format((time.time()-query_start)/60))
+
+execute(sql_queries)
+cluster_paths()
+execute(cluster_queries)
     
 # output to completion log    
 script_running_log(script, task, start, locale)
@@ -3,7 +3,6 @@
 # Authors: Carl Higgs
 # Date: 20190208
 
-import arcpy, arcinfo
 import os
 import time
 import multiprocessing
@@ -16,10 +15,19 @@ from sqlalchemy.types import BigInteger
 from tqdm import tqdm
 
 from script_running_log import script_running_log
+import polygon_scheduler
+import work_ledger
+import work_queue
 
 # Import custom variables for National Liveability indicator process
 from _project_setup import *
 
+if routing_engine == 'arcpy':
+    import arcpy, arcinfo
+    import arcpy_closest
+import network_routing
+import od_store
+
 # simple timer for log file
 start = time.time()
 script = os.path.basename(sys.argv[0])
@@ -27,18 +35,19 @@ script = os.path.basename(sys.argv[0])
 # schema where point indicator output tables will be stored
 schema = 'd_3200m_cl'
 
-# ArcGIS environment settings
-arcpy.env.workspace = gdb_path  
-# create project specific folder in temp dir for scratch.gdb, if not exists
-if not os.path.exists(os.path.join(temp,db)):
-    os.makedirs(os.path.join(temp,db))
+if routing_engine == 'arcpy':
+    # ArcGIS environment settings
+    arcpy.env.workspace = gdb_path  
+    # create project specific folder in temp dir for scratch.gdb, if not exists
+    if not os.path.exists(os.path.join(temp,db)):
+        os.makedirs(os.path.join(temp,db))
+        
+    arcpy.env.scratchWorkspace = os.path.join(temp,db)  
+    arcpy.env.qualifiedFieldNames = False  
+    arcpy.env.overwriteOutput = True 
     
-arcpy.env.scratchWorkspace = os.path.join(temp,db)  
-arcpy.env.qualifiedFieldNames = False  
-arcpy.env.overwriteOutput = True 
-
-# Get a list of feature 
-featureClasses = arcpy.ListFeatureClasses()
+    # Get a list of feature 
+    featureClasses = arcpy.ListFeatureClasses()
 
 # SQL Settings
 # result_table is now in loop
@@ -50,7 +59,7 @@ polygon_feature = polygon_feature
 # get pid name
 pid = multiprocessing.current_process().name
 
-if pid !='MainProcess':
+if pid !='MainProcess' and routing_engine == 'arcpy':
   # Make 3200m OD cost matrix layer
   result_object = arcpy.MakeODCostMatrixLayer_na(in_network_dataset = in_network_dataset, 
                                                  out_network_analysis_layer = "ODmatrix", 
@@ -67,62 +76,44 @@ if pid !='MainProcess':
   linesLayerName = subLayerNames["ODLines"]
   ODLinesSubLayer = arcpy.mapping.ListLayers(outNALayer, linesLayerName)[0]
   
-  # Make CLOSEST OD cost matrix layer
-  cl_result_object = arcpy.MakeODCostMatrixLayer_na(in_network_dataset = in_network_dataset, 
-                                                   out_network_analysis_layer = "ODmatrix", 
-                                                   impedance_attribute = "Length", 
-                                                   default_number_destinations_to_find = 1,
-                                                   UTurn_policy = "ALLOW_UTURNS", 
-                                                   hierarchy = "NO_HIERARCHY", 
-                                                   output_path_shape = "NO_LINES")
-  cl_outNALayer = cl_result_object.getOutput(0)
-  #Store the layer names that we will use later
-  cl_subLayerNames = arcpy.na.GetNAClassNames(cl_outNALayer)
-  cl_originsLayerName = cl_subLayerNames["Origins"]
-  cl_destinationsLayerName = cl_subLayerNames["Destinations"]
-  cl_linesLayerName = cl_subLayerNames["ODLines"]
-  cl_ODLinesSubLayer = arcpy.mapping.ListLayers(cl_outNALayer, cl_linesLayerName)[0]
-  
   # Define fields and features
   fields = ['Name', 'Total_Length']
   arcpy.MakeFeatureLayer_management (sample_point_feature, "sample_point_feature_layer")    
   arcpy.MakeFeatureLayer_management(polygon_feature, "polygon_layer")   
-  cl_sql = '''('{points_id}','{curlyo}{distance}{curlyc}'::int[])'''
-  sqlChunkify = 500
   
 # initial postgresql connection
 conn = psycopg2.connect(database=db, user=db_user, password=db_pwd)
 curs = conn.cursor()  
 
+engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
+                                                                  pwd  = db_pwd,
+                                                                  host = db_host,
+                                                                  db   = db), 
+                   use_native_hstore=False)
+
+# Work ledger stages: distances within 3200m (recorded by worker processes for each polygon), 
+# and closest destination (recorded by the main process for each polygon, once complete)
+ledger_stage = 'od_3200m'
+closest_stage = 'od_3200m_closest'
+work_ledger.create_ledger(engine)
+
 # Compile a list of destinations to be processed
 # ie. those which record a positive count in the destination_catalog table for this study region
-# and the table for which if existing in the d_3200m_cl schema has a row count of 
-# less than the total number of address points used for analysis in this city
-# (ie. the count of parcel_dwellings)
+# and which the work ledger does not record as complete (including the closest destination)
+# for all polygons with address points used for analysis in this city
 sql = '''
 SELECT destination
  FROM destination_catalog d
- LEFT JOIN (SELECT table_name, 
-                   (xpath('/row/cnt/text()', xml_count))[1]::text::int AS row_count
-              FROM (
-                SELECT table_name, 
-                       table_schema, 
-                       query_to_xml(format('SELECT COUNT(*) as cnt 
-                                              FROM %I.%I', 
-                                                   table_schema, 
-                                                   table_name)
-                                           , false, true, '') as xml_count
-                FROM information_schema.tables
-                WHERE table_schema = 'd_3200m_cl' --<< change here for the schema you want
-              ) t
-           ) completed_tables ON d.destination = completed_tables.table_name
 WHERE d.process_od='yes'
   AND d.count > 0
-  AND COALESCE(row_count,0) < (SELECT COUNT(*) FROM {sample_point_feature})
 ORDER BY destination;
-'''.format(sample_point_feature=sample_point_feature)
+'''
+curs.execute(sql)
+catalog_destinations = [x[0] for x in list(curs)]
+sql = '''SELECT {polygon_id} FROM poly_points WHERE count > 0;'''.format(polygon_id=polygon_id)
 curs.execute(sql)
-destination_list = [x[0] for x in list(curs)]
+analysis_polygons = [x[0] for x in list(curs)]
+destination_list = work_ledger.remaining_destinations(engine, closest_stage, catalog_destinations, analysis_polygons)
 
 print("\n")
 def list_df_values_by_id(df,a,b):
@@ -149,16 +140,20 @@ def add_locations(network,sub_layer,in_table,field):
         search_query                   = "{} #;{} #".format(network_edges,network_junctions))
 
 # Worker/Child PROCESS
-def ODMatrixWorkerFunction(polygon): 
+def ODMatrixWorkerFunction(task): 
   '''
     Iterate over polygons to processes OD matrices for destinations.
     
-    input: polygon
+    input: (polygon, batch, batches) task (see polygon_scheduler.py)
     output: Records results to Postgis database in destination specific tables
             in defined schema (e.g. d_3200m_cl).
             
-            Results are recorded for distances to all destinations up to 3200m, or closest,
-            (which may be more than 3200m away) in a jsonb list format, indexed by point id.            
+            Results are recorded for distances to all destinations up to 3200m 
+            in an integer array format, indexed by point id.  Points with no destination
+            within 3200m are subsequently recorded with the distance to the closest destination
+            (which may be more than 3200m away) by the main process, once all polygons are processed.
+            
+            Returns 0 on success, 1 on error, 2 if there were no points to process.
             
             Later scripts process the results into indicators.
             
@@ -185,6 +180,8 @@ def ODMatrixWorkerFunction(polygon):
   arcpy.CheckOutExtension('Network')
  
   polygonStartTime = time.time() 
+  polygon, batch, batches = task
+  destination = ''
   try:   
     place = "origin selection"  
     # select origin points    
@@ -198,9 +195,13 @@ def ODMatrixWorkerFunction(polygon):
     place = 'before polygon selection'
     polygon_selection = arcpy.SelectLayerByAttribute_management("polygon_layer", where_clause = sql)
     place = 'before destination in polygon selection'
+    # destinations already completed for this polygon, according to the work ledger
+    completed_destinations = work_ledger.completed_destinations(engine, ledger_stage, polygon, batch)
     # Loop over destinations
     # for destination in tqdm(destination_list,"polygon: {}".format(polygon)):
     for destination in destination_list:
+        if destination in completed_destinations:
+            continue
         arcpy.MakeFeatureLayer_management(destination, "destination_points_layer")   
         dest_in_polygon = arcpy.SelectLayerByLocation_management("destination_points_layer", 
                                                              'WITHIN_A_DISTANCE',
@@ -209,59 +210,42 @@ def ODMatrixWorkerFunction(polygon):
         destStartTime = time.time()
         result_table = '{distance_schema}."{destination}"'.format(distance_schema = distance_schema,
                                                                  destination = destination)
-        # fetch count of successfully processed results for this destination in this polygon
-        sql = '''
-          SELECT COUNT(*)
-            FROM {result_table}
-        LEFT JOIN {sample_point_feature} p USING ({points_id})
-           WHERE p.{polygon_id} = {polygon};
-        '''.format(result_table = result_table, 
-                   sample_point_feature = sample_point_feature,
-                   points_id = points_id,
-                   polygon_id = polygon_id,   
-                   polygon = polygon,
-                   destination=destination)
-        curs.execute(sql)
-        already_processed = list(curs)[0][0]
-        if already_processed == origin_point_count:
-            continue
-        remaining_to_process = origin_point_count - already_processed
         dest_in_polygon_count = int(arcpy.GetCount_management(dest_in_polygon).getOutput(0))
         if dest_in_polygon_count == 0: 
             place = 'zero dest in polygon, solve later'
-        # Add origins
-        if remaining_to_process > 0:
-            curs.execute('''SELECT p.{points_id} 
-                            FROM {sample_point_feature} p 
-                            LEFT JOIN {result_table} r ON p.{points_id} = r.{points_id}
-                            WHERE {polygon_id} = {polygon}
-                              AND r.{points_id} IS NULL;
-                         '''.format(polygon_id = polygon_id,
-                                    result_table = result_table,
-                                    sample_point_feature = sample_point_feature,
-                                    points_id = points_id.lower(), 
-                                    polygon = polygon))
-            remaining_points = [str(x[0]) for x in list(curs)]
-            if 'int' in points_id_type:
-                points = '{}'.format(",".join(remaining_points))
-            else:
-                points = "'{}'".format("','".join(remaining_points))
-            sql = '''
-              {polygon_id} = {polygon} AND {points_id} IN ({points})
-              '''.format(polygon_id = polygon_id,
-                         polygon = polygon,
-                         points_id = points_id,
-                         points = points)
-            origin_subset = arcpy.SelectLayerByAttribute_management("sample_point_feature_layer", 
-                                                                    where_clause = sql)
-            add_locations(outNALayer,originsLayerName,origin_subset,points_id)
-        else:
-            add_locations(outNALayer,originsLayerName,origin_selection,points_id)            
+        # Add origins (those in this batch without results for this destination)
+        curs.execute('''SELECT p.{points_id} 
+                        FROM {sample_point_feature} p 
+                        LEFT JOIN {result_table} r ON p.{points_id} = r.{points_id}
+                        WHERE {polygon_id} = {polygon}
+                          AND {batch_filter}
+                          AND r.{points_id} IS NULL;
+                     '''.format(polygon_id = polygon_id,
+                                result_table = result_table,
+                                sample_point_feature = sample_point_feature,
+                                points_id = points_id.lower(), 
+                                polygon = polygon,
+                                batch_filter = polygon_scheduler.batch_filter(points_id.lower(), batch, batches)))
+        remaining_points = [str(x[0]) for x in list(curs)]
+        if len(remaining_points) == 0:
+            work_ledger.record(engine, ledger_stage, destination, polygon, 'complete', 0, time.time() - destStartTime, batch)
+            continue
+        points = polygon_scheduler.id_list(remaining_points, points_id_type)
+        sql = '''
+          {polygon_id} = {polygon} AND {points_id} IN ({points})
+          '''.format(polygon_id = polygon_id,
+                     polygon = polygon,
+                     points_id = points_id,
+                     points = points)
+        origin_subset = arcpy.SelectLayerByAttribute_management("sample_point_feature_layer", 
+                                                                where_clause = sql)
+        add_locations(outNALayer,originsLayerName,origin_subset,points_id)
         # Add destinations
         add_locations(outNALayer,destinationsLayerName,dest_in_polygon,destination_id)
         
         # Process: Solve
         result = arcpy.Solve_na(outNALayer, terminate_on_solve_error = "CONTINUE")
+        df = None
         if result[1] == u'false':
             place = 'OD results processed, but no results recorded in 3200m; solve later'
         else:
@@ -282,102 +266,180 @@ def ODMatrixWorkerFunction(polygon):
             # APPEND RESULTS TO EXISTING TABLE
             df = df.drop_duplicates(subset=[points_id])
             place = 'df:\r\n{}'.format(df)
-            df.to_sql('{}'.format(destination),con = engine,schema = distance_schema, index = False, if_exists='append')
-        # Solve final closest analysis for points with no destination in 3200m
-        curs.execute('''SELECT p.{points_id} 
-                        FROM {sample_point_feature} p 
-                        LEFT JOIN {result_table} r ON p.{points_id} = r.{points_id}
-                        WHERE {polygon_id} = {polygon}
-                          AND r.{points_id} IS NULL;
-                     '''.format(result_table = result_table,
-                                sample_point_feature = sample_point_feature,
-                                polygon_id = polygon_id, 
-                                points_id = points_id.lower(), 
-                                polygon = polygon))
-        remaining_points = [str(x[0]) for x in list(curs)]
-        if 'int' in points_id_type:
-            points = '{}'.format(",".join(remaining_points))
-        else:
-            points = "'{}'".format("','".join(remaining_points))
-        if len(remaining_points) > 0:
-            sql = '''
-              {polygon_id} = {polygon} AND {points_id} IN ({points})
-              '''.format(polygon = polygon,
-                         polygon_id = polygon_id,   
-                         points_id = points_id,
-                         points = points)
-            origin_subset = arcpy.SelectLayerByAttribute_management("sample_point_feature_layer", 
-                                                                    where_clause = sql)     
-            destination_selection = arcpy.SelectLayerByAttribute_management("destination_points_layer", "NEW_SELECTION")                                                                        
-            add_locations(cl_outNALayer,cl_originsLayerName,origin_subset,points_id)
-            add_locations(cl_outNALayer,cl_destinationsLayerName,destination_selection,destination_id)
-            # Process: Solve
-            result = arcpy.Solve_na(cl_outNALayer, terminate_on_solve_error = "CONTINUE")
-            if result[1] == u'false':
-                alert = (
-                         "\t{destination}\tpolygon {polygon:5} No solution for {n} points"
-                         ).format(polygon = polygon,
-                                  destination = destination,
-                                  n = len(remaining_points))
-                print(alert)
-                place = 'OD results processed, but no results recorded'
-                sql = '''
-                 INSERT INTO {result_table} ({points_id},distances)  
-                 SELECT p.{points_id},
-                        '{curlyo}{curlyc}'::int[]
-                   FROM {sample_point_feature} p
-                   LEFT JOIN {result_table} r ON p.{points_id} = r.{points_id}
-                  WHERE {polygon_id} = {polygon}
-                    AND r.{points_id} IS NULL
-                     ON CONFLICT DO NOTHING;
-                 '''.format(result_table = result_table,
-                            sample_point_feature = sample_point_feature,
-                            points_id = points_id,
-                            polygon_id = polygon_id,   
-                            curlyo = '{',
-                            curlyc = '}',                     
-                            polygon = polygon)
-                  # print(null_dest_insert)                           
-                curs.execute(sql)
-                conn.commit()
-            else:
-                place = 'OD results processed; results to be recorded'
-                outputLines = arcpy.da.SearchCursor(cl_ODLinesSubLayer, fields)
-                count = 0
-                chunkedLines = list()
-                for outputLine in outputLines :
-                    count += 1
-                    origin_id = outputLine[0].split('-')[0].strip(' ')
-                    distance  = int(round(outputLine[1]))
-                    sql = cl_sql.format(points_id  = origin_id,  
-                                        curlyo = '{',
-                                        curlyc = '}',      
-                                        distance  = distance)
-                    chunkedLines.append(sql)
-                    if(count % sqlChunkify == 0):
-                        sql = '''
-                        INSERT INTO {result_table} AS o VALUES {values}
-                        '''.format(result_table=result_table, 
-                                    values = ','.join(chunkedLines))
-                        curs.execute(sql)
-                        conn.commit()
-                        chunkedLines = list()
-                if(count % sqlChunkify != 0):
-                    sql = '''
-                    INSERT INTO {result_table} AS o VALUES {values} 
-                    '''.format(result_table=result_table, 
-                                values = ','.join(chunkedLines))
-                    curs.execute(sql)
-                    conn.commit()            
+        # results are recorded only while this worker holds the lease on the task (if processed from a work queue)
+        with engine.begin() as connection:
+            work_queue.fence(connection)
+            if df is not None:
+                df.to_sql('{}'.format(destination),con = connection,schema = distance_schema, index = False, if_exists='append')
+            work_ledger.record(connection, ledger_stage, destination, polygon, 'complete', len(remaining_points), time.time() - destStartTime, batch)
+    return(0)
   except:
       print('''Error: {}\npolygon: {}\nDestination: {}\nPlace: {}\nSQL: {}'''.format( sys.exc_info(),polygon,destination,place,sql))  
+      # an error is only recorded once processing of a destination has commenced
+      if destination != '':
+          work_ledger.record(engine, ledger_stage, destination, polygon, 'error', duration = time.time() - polygonStartTime, batch = batch)
+      return(1)
   finally:
       arcpy.CheckInExtension('Network')
       conn.close()
    
+# Network routing engine (routing_engine = 'network')
+# The network and located destinations are loaded once by each worker process, as required
+network = None
+destination_indexes = {}
+
+def network_destinations(engine,destination = None):
+  ''' 
+  Located destinations indexed by network node (cached).  If no destination is specified,
+  all destination types to be processed are indexed together, labelled by destination.
+  '''
+  if destination not in destination_indexes:
+      index = network_routing.LocationIndex()
+      if destination is None:
+          destinations = destination_list
+      else:
+          destinations = [destination]
+      for d in destinations:
+          locations = network_routing.locate(engine, network, 
+                                             table = '{}."{}"'.format(destinations_schema,d),
+                                             id = destination_id,
+                                             tolerance = tolerance,
+                                             network_schema = network_schema)
+          if destination is None:
+              index.add(locations, label = d)
+          else:
+              index.add(locations)
+      destination_indexes[destination] = index
+  return destination_indexes[destination]
+
+def NetworkODWorkerFunction(task): 
+  '''
+    Iterate over polygons to processes OD matrices for destinations, using the
+    in-process network routing engine (ie. without ArcGIS).
+    
+    input: (polygon, batch, batches) task (see polygon_scheduler.py)
+    output: Records results to Postgis database in destination specific tables
+            in defined schema (e.g. d_3200m_cl), as per ODMatrixWorkerFunction.
+            
+            Origins are located on the network, and a search bounded at 3200m is run 
+            from each origin to record distances to destinations within 3200m; origins 
+            with no destination within 3200m are evaluated for the closest destination 
+            by the main process, as for the arcpy engine.
+            
+            If od_search is 'combined', one search per origin evaluates all destination 
+            types, which are labelled onto network nodes ahead of time; otherwise, 
+            a separate search is run for each destination type.
+  '''
+  global network
+  polygon, batch, batches = task
+  # Connect to SQL database 
+  try:
+    conn = psycopg2.connect(database=db, user=db_user, password=db_pwd)
+    curs = conn.cursor()
+    engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
+                                                                      pwd  = db_pwd,
+                                                                      host = db_host,
+                                                                      db   = db), 
+                       use_native_hstore=False)
+  except:
+    print("SQL connection error")
+    print(sys.exc_info()[1])
+    return 100
+  polygonStartTime = time.time() 
+  destination = ''
+  # destinations to be processed for this polygon which are not yet recorded as complete in the ledger
+  pending = []
+  sql = ''
+  try:   
+    place = "network setup"
+    if network is None:
+        network = network_routing.load_network(engine, network_schema = network_schema)
+    place = "origin selection"  
+    # identify origin points in polygon remaining to be processed for each destination
+    # not already completed for this polygon, according to the work ledger
+    completed_destinations = work_ledger.completed_destinations(engine, ledger_stage, polygon, batch)
+    polygon_destinations = [d for d in destination_list if d not in completed_destinations]
+    pending = list(polygon_destinations)
+    remaining = {}
+    for destination in polygon_destinations:
+        sql = '''SELECT p.{points_id} 
+                  FROM {sample_point_feature} p 
+                  LEFT JOIN {distance_schema}."{destination}" r ON p.{points_id} = r.{points_id}
+                  WHERE {polygon_id} = {polygon}
+                    AND {batch_filter}
+                    AND r.{points_id} IS NULL;
+               '''.format(polygon_id = polygon_id,
+                          distance_schema = distance_schema,
+                          destination = destination,
+                          sample_point_feature = sample_point_feature,
+                          points_id = points_id.lower(), 
+                          polygon = polygon,
+                          batch_filter = polygon_scheduler.batch_filter(points_id.lower(), batch, batches))
+        curs.execute(sql)
+        remaining[destination] = set([x[0] for x in list(curs)])
+    remaining_points = set().union(*remaining.values())
+    if len(remaining_points) == 0:
+        for destination in polygon_destinations:
+            work_ledger.record(engine, ledger_stage, destination, polygon, 'complete', 0, time.time() - polygonStartTime, batch)
+        return(2)
+    # locate origin points in polygon on network
+    sql = '''p.{polygon_id} = {polygon}'''.format(polygon_id = polygon_id, polygon = polygon)
+    origins = network_routing.locate(engine, network, 
+                                     table = sample_point_feature,
+                                     id = points_id,
+                                     where = sql,
+                                     tolerance = tolerance,
+                                     network_schema = network_schema)
+    origins = origins[origins.id.isin(remaining_points)]
+    results = dict([(destination,[]) for destination in polygon_destinations])
+    if od_search == 'combined':
+        place = "destination location"
+        destinations = network_destinations(engine)
+        place = "network search"
+        for origin in origins.itertuples():
+            settled = network_routing.search(network, network_routing.origin_seeds(origin), 3200)
+            distances = network_routing.distances_by_label(network_routing.reachable(settled, origin, destinations, 3200))
+            for destination in polygon_destinations:
+                if origin.id in remaining[destination] and destination in distances:
+                    results[destination].append([origin.id,sorted([int(d) for d in distances[destination]])])
+    else:
+        for destination in polygon_destinations:
+            place = "destination location"
+            destinations = network_destinations(engine,destination)
+            place = "network search"
+            for origin in origins.itertuples():
+                if origin.id in remaining[destination]:
+                    distances = network_routing.distances_within(network, origin, destinations, 3200)
+                    if len(distances) > 0:
+                        results[destination].append([origin.id,sorted([int(d) for d in distances.values()])])
+    for destination in polygon_destinations:
+        place = 'results were returned, now processing...'
+        # results are recorded only while this worker holds the lease on the task (if processed from a work queue)
+        with engine.begin() as connection:
+            work_queue.fence(connection)
+            if len(results[destination]) > 0:
+                df = pandas.DataFrame(data = results[destination], columns = [points_id,'distances'])
+                df = df.drop_duplicates(subset=[points_id])
+                df.to_sql('{}'.format(destination),con = connection,schema = distance_schema, index = False, if_exists='append')
+            work_ledger.record(connection, ledger_stage, destination, polygon, 'complete', len(remaining[destination]), time.time() - polygonStartTime, batch)
+        pending.remove(destination)
+    return(0)
+  except:
+      print('''Error: {}\npolygon: {}\nDestination: {}\nPlace: {}\nSQL: {}'''.format( sys.exc_info(),polygon,destination,place,sql))  
+      # errors are recorded for each destination not completed (none, if the error preceded their selection)
+      for destination in pending:
+          work_ledger.record(engine, ledger_stage, destination, polygon, 'error', duration = time.time() - polygonStartTime, batch = batch)
+      return(1)
+  finally:
+      conn.close()
+      engine.dispose()
+
 # MAIN PROCESS
 if __name__ == '__main__':
   task = 'Record distances from origins to destinations within 3200m, and closest'
+  print("Routing engine: {}".format(routing_engine))
+  if routing_engine == 'network':
+      print("OD search mode: {}".format(od_search))
   print("Commencing task ({}): {} at {}".format(db,task,time.strftime("%Y%m%d-%H%M%S")))
   # initial postgresql connection
   conn = psycopg2.connect(database=db, user=db_user, password=db_pwd)
@@ -410,18 +472,126 @@ if __name__ == '__main__':
   print(destination_list)
   
   if len(destination_list) > 0:
-      # Parallel processing setting
-      pool = multiprocessing.Pool(processes=nWorkers)
-      # get list of polygons over which to iterate
-      sql = '''
-        SELECT DISTINCT {polygon_id} FROM poly_points WHERE count > 0;
-          '''.format(polygon_id=polygon_id)
-      curs.execute(sql)
-      iteration_list = np.asarray([x[0] for x in list(curs)])
-      # # Iterate process over polygons across nWorkers
-      # pool.map(ODMatrixWorkerFunction, iteration_list, chunksize=1)
-      # # The below code implements a progress counter using polygon iterations
-      r = list(tqdm(pool.imap(ODMatrixWorkerFunction, iteration_list), total=len(iteration_list), unit='polygon'))
+      if od_queue == 'yes':
+          # The queue is specific to the destinations and batching of this run, so that tasks
+          # completed by a previous run (e.g. for other destinations) are not taken as complete;
+          # only one host at a time may (re)build snapping indexes, or record closest destinations
+          queue = work_queue.queue_name(ledger_stage, sorted(destination_list), od_batch_points)
+          print("\nDistributed processing using work queue '{}' (waiting for any other hosts to finish setup)...".format(queue))
+          queue_lock = work_queue.lock(engine, queue)
+      if routing_engine == 'network':
+          # Ensure origins and destinations have a current snapping index (rebuilt only if the network or points have changed)
+          print("\nChecking network snapping index for origins and destinations..."),
+          snap_tables = [sample_point_feature]+['{}."{}"'.format(destinations_schema,d) for d in destination_list]
+          for table in snap_tables:
+              network_routing.snap_index(engine, 
+                                         table = table,
+                                         id = points_id if table == sample_point_feature else destination_id,
+                                         tolerance = tolerance,
+                                         network_schema = network_schema)
+          print("Done.")
+      # get list of polygon tasks over which to iterate, ordered by estimated cost (longest first), 
+      # with polygons having more than od_batch_points points split into origin batches
+      candidate_destinations = '''
+        (SELECT geom FROM {destinations_schema}.study_destinations WHERE destination IN ('{destinations}'))
+        '''.format(destinations_schema = destinations_schema,
+                   destinations = "','".join(destination_list))
+      iteration_list = polygon_scheduler.polygon_tasks(engine, polygon_id, 
+                                                       max_points = od_batch_points,
+                                                       sample_point_feature = sample_point_feature,
+                                                       destinations = candidate_destinations,
+                                                       distance = 3200)
+      # # Iterate process over polygon tasks across nWorkers
+      # # The below code implements a progress counter using polygon task iterations
+      if routing_engine == 'arcpy':
+          worker = ODMatrixWorkerFunction
+      else:
+          worker = NetworkODWorkerFunction
+      if od_queue == 'yes':
+          # Tasks are shared with any other hosts processing this queue
+          queue_lock.close()
+          completed = work_queue.process(engine, queue, iteration_list, worker, 
+                                         processes = nWorkers,
+                                         lease = od_queue_lease,
+                                         max_tasks = worker_max_tasks)
+          queue_lock = work_queue.lock(engine, queue)
+      else:
+          # Parallel processing setting; worker processes are recycled after worker_max_tasks tasks
+          pool = multiprocessing.Pool(processes=nWorkers, maxtasksperchild=worker_max_tasks or None)
+          r = list(tqdm(pool.imap(worker, iteration_list), total=len(iteration_list), unit='task'))
+          pool.close()
+          completed = polygon_scheduler.completed_polygons(iteration_list, r)
+      # Solve final closest analysis for points with no destination in 3200m, using the routing engine
+      # used for distances within 3200m: using arcpy, an OD cost matrix finding the closest destination
+      # is solved for the remaining points; otherwise, a single reverse search from all destinations of 
+      # each type labels every network node with its closest destination, from which the closest 
+      # distance for all remaining points in the region is read.  This is restricted to polygons which were successfully processed,
+      # and for which the work ledger records all tasks of this run as complete for the destination
+      # (so that points are not recorded with only their closest destination, where distances 
+      # within 3200m have not been recorded)
+      if len(completed) > 0:
+          print("\nRecord distance to closest destination for points with no destination within 3200m...")
+          if routing_engine == 'network':
+              network = network_routing.load_network(engine, network_schema = network_schema)
+          for destination in tqdm(destination_list, unit='destination'):
+              processed = set(work_ledger.completed_task_polygons(engine, ledger_stage, destination, iteration_list))
+              destination_completed = [str(polygon) for polygon in completed if int(polygon) in processed]
+              if len(destination_completed) < len(completed):
+                  print("\n  - {}: {} of {} completed polygons have not been processed for this destination; "
+                        "these will be evaluated once processed".format(destination, len(completed) - len(destination_completed), len(completed)))
+              if len(destination_completed) == 0:
+                  continue
+              result_table = '{distance_schema}."{destination}"'.format(distance_schema = distance_schema,
+                                                                       destination = destination)
+              remaining = '''
+                p.{polygon_id} IN ({polygons})
+                AND NOT EXISTS (SELECT 1 FROM {result_table} r WHERE r.{points_id} = p.{points_id})
+                '''.format(polygon_id = polygon_id,
+                           polygons = ','.join(destination_completed),
+                           result_table = result_table,
+                           points_id = points_id.lower())
+              if routing_engine == 'arcpy':
+                  df = arcpy_closest.closest_destinations(engine, sample_point_feature, points_id, points_id_type,
+                                                          destination, destination_id, 
+                                                          where = remaining,
+                                                          in_network_dataset = in_network_dataset,
+                                                          tolerance = tolerance,
+                                                          network_edges = network_edges,
+                                                          network_junctions = network_junctions)
+              else:
+                  df = network_routing.closest_destinations(engine, network,
+                                                            network_destinations(engine,destination),
+                                                            table = sample_point_feature,
+                                                            id = points_id,
+                                                            where = remaining,
+                                                            tolerance = tolerance,
+                                                            network_schema = network_schema)
+              if len(df) > 0:
+                  df[points_id] = df['id']
+                  # distances are recorded in whole metres (truncated), as for distances within 3200m
+                  df['distances'] = [[int(d)] for d in df.distance]
+                  df[[points_id,'distances']].to_sql('{}'.format(destination),con = engine,schema = distance_schema, index = False, if_exists='append')
+              # Record points with no solution (not located on network, or no reachable destination)
+              sql = '''
+               INSERT INTO {result_table} ({points_id},distances)
+               SELECT p.{points_id},
+                      '{curlyo}{curlyc}'::int[]
+                 FROM {sample_point_feature} p
+                WHERE {remaining}
+                   ON CONFLICT DO NOTHING;
+               '''.format(result_table = result_table,
+                          sample_point_feature = sample_point_feature,
+                          points_id = points_id,
+                          curlyo = '{',
+                          curlyc = '}',
+                          remaining = remaining)
+              curs.execute(sql)
+              conn.commit()
+              work_ledger.record_polygons(engine, closest_stage, destination, destination_completed, 'complete')
+              # Update distance to closest destination of this class in the closest_distance table
+              od_store.update_closest_distance(engine, distance_schema, destination, sample_point_feature, points_id, points_id_type)
+      if od_queue == 'yes':
+          queue_lock.close()
   else:
     print("\nIt seems that results have already been processed for all destinations.")
   print("\nEnsuring all tables are indexed, and contain only unique ids..."),
@@ -436,51 +606,43 @@ if __name__ == '__main__':
       curs.execute(sql)
       conn.commit()
   print("Done.")   
-  print("\nProcessed destination summary\n(tables in schema {distance_schema})\n").format(distance_schema = distance_schema)
-  engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
-                                                                    pwd  = db_pwd,
-                                                                    host = db_host,
-                                                                    db   = db), 
-                     use_native_hstore=False)
-  sql = '''
-     SELECT table_name, 
-          (xpath('/row/cnt/text()', xml_count))[1]::text::int AS row_count
-     FROM (
-       SELECT table_name, 
-              table_schema, 
-              query_to_xml(format('SELECT COUNT(*) as cnt 
-                                     FROM %%I.%%I', 
-                                          table_schema, 
-                                          table_name)
-                                  , false, true, '') as xml_count
-       FROM information_schema.tables
-       WHERE table_schema = '{distance_schema}' --<< change here for the schema you want
-       ORDER BY table_name
-     ) t;
-    '''.format(distance_schema = distance_schema)
-  result_summary = pandas.read_sql(sql, engine)
+  # Ensure the closest_distance table records all destinations (eg. those processed previously)
+  closest_distance_destinations = od_store.closest_distance_destinations(engine, distance_schema)
+  for destination in [d for d in full_destination_list if d not in closest_distance_destinations]:
+      od_store.update_closest_distance(engine, distance_schema, destination, sample_point_feature, points_id, points_id_type)
+  if od_columnar_store == 'yes':
+      # Load destinations processed in this run (or not yet stored) to the columnar OD store
+      print("\nLoading distances to columnar OD store ({distance_schema}.od_distances)...".format(distance_schema = distance_schema))
+      stored_destinations = od_store.stored_destinations(engine, distance_schema)
+      for destination in tqdm([d for d in full_destination_list if d in destination_list or d not in stored_destinations], unit='destination'):
+          od_store.load_destination(engine, distance_schema, destination, sample_point_feature, points_id, points_id_type)
+  print("\nProcessed destination summary\n(from work ledger table {ledger_table})\n".format(ledger_table = work_ledger.ledger_table))
+  result_summary = work_ledger.summary(engine, ledger_stage)
+  closest_summary = work_ledger.summary(engine, closest_stage)[['destination','polygons_complete']]
+  result_summary = result_summary.merge(closest_summary, 
+                                        on = 'destination', 
+                                        how = 'outer', 
+                                        suffixes = ('','_closest'))
   with pandas.option_context('display.max_rows', None): 
     print(result_summary)
   print((
          "\nPlease consider the above summary carefully. "
-         "\n\nIf any of the above destination tables... "
-         "\n- have a row count of 0: "
-         "\n    - it implies that there are no destinations of this type "
-         "\n      accessible within this study region."
-         "\n\n"
-         "\n- have row count > 0 and less than the count of origin points:"
+         "\n\nThere are {} polygons with points to be processed. If any of the above destinations... "
+         "\n- have polygons_error > 0, or fewer than this number of polygons complete: "
          "\n    - it implies that processing is not fully complete; "
          "\n      it is recommended to run this script again."
          "\n\n"
-         "\n - have a row count equal to the count of origin points: "
+         "\n- are not listed: "
+         "\n    - it implies that there are no destinations of this type "
+         "\n      accessible within this study region."
+         "\n\n"
+         "\n- have polygons_complete_closest equal to this number of polygons: "
          "\n     - it implies that processing has successfully completed for all points."
          "\n\n"
-         "\n   - have a row count greater than the count of origin points: "
-         "\n       - it implies that there are duplicate rows recorded; "
-         "\n         the attempt to create a unique index will have failed, "
-         "\n         and the cause of how duplicate results have been recorded "
-         "\n         must be investigated."
-         ))
+         "\nIf the attempt to create a unique index above failed, duplicate rows "
+         "\nhave been recorded, and the cause must be investigated."
+         ).format(len(analysis_polygons)))
   # Log completion   
   script_running_log(script, task, start, locale)
-  conn.close()
\ No newline at end of file
+  conn.close()
+  engine.dispose()
\ No newline at end of file
@@ -17,6 +17,10 @@ from sqlalchemy.types import BigInteger
 # from progressor import progressor
 from tqdm import tqdm
 
+import arcpy_closest
+import od_arrays
+import polygon_scheduler
+import work_queue
 from script_running_log import script_running_log
 
 # Import custom variables for National Liveability indicator process
@@ -86,22 +90,6 @@ if pid !='MainProcess':
   linesLayerName = subLayerNames["ODLines"]
   ODLinesSubLayer = arcpy.mapping.ListLayers(outNALayer, linesLayerName)[0]
   
-  # Make CLOSEST OD cost matrix layer
-  cl_result_object = arcpy.MakeODCostMatrixLayer_na(in_network_dataset = in_network_dataset, 
-                                                   out_network_analysis_layer = "ODmatrix", 
-                                                   impedance_attribute = "Length", 
-                                                   default_number_destinations_to_find = 1,
-                                                   UTurn_policy = "ALLOW_UTURNS", 
-                                                   hierarchy = "NO_HIERARCHY", 
-                                                   output_path_shape = "NO_LINES")
-  cl_outNALayer = cl_result_object.getOutput(0)
-  #Store the layer names that we will use later
-  cl_subLayerNames = arcpy.na.GetNAClassNames(cl_outNALayer)
-  cl_originsLayerName = cl_subLayerNames["Origins"]
-  cl_destinationsLayerName = cl_subLayerNames["Destinations"]
-  cl_linesLayerName = cl_subLayerNames["ODLines"]
-  cl_ODLinesSubLayer = arcpy.mapping.ListLayers(cl_outNALayer, cl_linesLayerName)[0]
-  
   # Define fields and features
   fields = ['Name', 'Total_Length']
   arcpy.MakeFeatureLayer_management (sample_point_feature, "sample_point_feature_layer")
@@ -125,12 +113,15 @@ def od_pt_process(polygon_dest_tuple):
   '''
     Iterate over polygons to calculate network distances to public transport stops.
     
-    input: [polygon,points]
+    input: [polygon,batch,batches,points] (see polygon_scheduler.py)
     output: Records results to Postgis database in a long form table
             (contra style for most destinations) containing fields
             gnaf_pid fid mode distance headway
             These allow posthoc querying for PT indicators by mode, distance and headway
-            Within 800m, and for closest
+            Within 800m; points with no stop within 800m are subsequently recorded with
+            the closest stop by the main process, once all polygons are processed.
+            
+            Returns 0 on success, 1 on error, 2 if there were no points to process.
   '''
   engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
                                                                       pwd  = db_pwd,
@@ -141,7 +132,9 @@ def od_pt_process(polygon_dest_tuple):
   arcpy.CheckOutExtension('Network')
   polygonStartTime = time.time() 
   polygon = polygon_dest_tuple[0]
-  p       = polygon_dest_tuple[1]
+  batch   = polygon_dest_tuple[1]
+  batches = polygon_dest_tuple[2]
+  p       = polygon_dest_tuple[3]
   result_table = 'od_pt_800m_cl_{}'.format(p)
   try:   
     place = "origin selection"  
@@ -178,26 +171,25 @@ def od_pt_process(polygon_dest_tuple):
         dest_within_dist_polygon_count = int(arcpy.GetCount_management(dest_within_dist_polygon).getOutput(0))
         if dest_within_dist_polygon_count == 0: 
             place = 'zero dest within analysis distance of polygon, solve later'
-        # Add origins
-        if remaining_to_process < origin_point_count:
+        # Add origins (those remaining to be processed, or in this batch if the polygon is split)
+        if remaining_to_process < origin_point_count or batches > 1:
             sql = '''SELECT p.{points_id} 
                      FROM {sample_point_feature} p 
                      LEFT JOIN {schema}.{result_table} r ON p.{points_id} = r.{points_id}
                      WHERE {polygon_id} = {polygon}
+                       AND {batch_filter}
                        AND r.{points_id} IS NULL;
                   '''.format(polygon_id = polygon_id,
                              result_table = result_table,
                              schema=schema,
                              sample_point_feature = sample_point_feature,
                              points_id = points_id.lower(), 
-                             polygon = polygon)
+                             polygon = polygon,
+                             batch_filter = polygon_scheduler.batch_filter(points_id.lower(), batch, batches))
             remaining_points = pandas.read_sql(sql,engine)
-            remaining_points = remaining_points[points_id].astype(str).values
-            if 'int' in points_id_type:
-                points = '{}'.format(",".join(remaining_points))
-            else:
-                remaining_points = remaining_points[points_id].astype(str).values
-                points = "'{}'".format("','".join(remaining_points))
+            if len(remaining_points) == 0:
+                return(2)
+            points = polygon_scheduler.id_list(remaining_points[points_id.lower()].values, points_id_type)
             sql = '''
               {polygon_id} = {polygon} AND {points_id} IN ({points})
               '''.format(polygon_id = polygon_id,
@@ -226,85 +218,16 @@ def od_pt_process(polygon_dest_tuple):
             df.distance = df.distance.astype('int')
             df[[points_id,pt_id_orig]] = df['od'].str.split(' - ',expand=True)
             df[pt_id_orig] = df[pt_id_orig].astype(int)
-            df = df[[points_id,pt_id_orig,'distance']].groupby(points_id).apply(lambda x: x[[pt_id_orig,'distance']].to_json(orient='records'))
-            df = df.reset_index()
-            df.columns = [points_id,'attributes']
+            df = od_arrays.encode(df[[points_id,pt_id_orig,'distance']], points_id, pt_id_orig)
             place = 'df:\r\n{}'.format(df)
-            df.to_sql('{}'.format(result_table),con = engine, schema=schema, index = False, if_exists='append')
-        # Solve final closest analysis for points with no destination in 800m
-        sql = '''SELECT p.{points_id} 
-                        FROM {sample_point_feature} p 
-                        LEFT JOIN {schema}.{result_table} r ON p.{points_id} = r.{points_id}
-                        WHERE {polygon_id} = {polygon}
-                          AND r.{points_id} IS NULL;
-                     '''.format(result_table = result_table,
-                                schema=schema,
-                                sample_point_feature = sample_point_feature,
-                                polygon_id = polygon_id, 
-                                points_id = points_id.lower(), 
-                                polygon = polygon)
-        remaining_points = pandas.read_sql(sql,engine)
-        remaining_points = remaining_points[points_id].astype(str).values
-        if 'int' in points_id_type:
-            points = '{}'.format(",".join(remaining_points))
-        else:
-            remaining_points = remaining_points[points_id].astype(str).values
-            points = "'{}'".format("','".join(remaining_points))
-        if len(remaining_points) > 0:
-            sql = '''
-              {polygon_id} = {polygon} AND {points_id} IN ({points})
-              '''.format(polygon = polygon,
-                         polygon_id = polygon_id,   
-                         points_id = points_id,
-                         points = points)
-            origin_subset = arcpy.SelectLayerByAttribute_management("sample_point_feature_layer", 
-                                                                    where_clause = sql)   
-            destination_selection = arcpy.SelectLayerByAttribute_management(p, "NEW_SELECTION")    
-            add_locations(cl_outNALayer,cl_originsLayerName,origin_subset,points_id)       
-            add_locations(cl_outNALayer,cl_destinationsLayerName,destination_selection,pt_id)
-            # Process: Solve
-            result = arcpy.Solve_na(cl_outNALayer, terminate_on_solve_error = "CONTINUE")
-            if result[1] == u'false':
-                alert = (
-                         "\tpolygon {polygon:5} No solution for {n} points"
-                         ).format(polygon = polygon,
-                                  n = len(remaining_points))
-                print(alert)
-                place = 'OD results processed, but no results recorded'
-                sql = '''
-                 INSERT INTO {schema}.{result_table} ({points_id},attributes)  
-                 SELECT p.{points_id},
-                        '{curlyo}{curlyc}'::jsonb
-                   FROM {sample_point_feature} p
-                   LEFT JOIN {schema}.{result_table} r ON p.{points_id} = r.{points_id}
-                  WHERE {polygon_id} = {polygon}
-                    AND r.{points_id} IS NULL
-                     ON CONFLICT DO NOTHING;
-                 '''.format(result_table = result_table,
-                            schema=schema,
-                            sample_point_feature = sample_point_feature,
-                            points_id = points_id,
-                            polygon_id = polygon_id,   
-                            curlyo = '{',
-                            curlyc = '}',                     
-                            polygon = polygon)
-                  # print(null_dest_insert)                           
-                engine.execute(sql)
-            else:
-                place = 'OD results processed; results to be recorded'
-                outputLines = arcpy.da.SearchCursor(cl_ODLinesSubLayer, fields)   
-                data = [x for x in outputLines]
-                df = pandas.DataFrame(data = data, columns = ['od','distance'])
-                df.distance = df.distance.astype('int')
-                df[[points_id,pt_id_orig]] = df['od'].str.split(' - ',expand=True)
-                df[pt_id_orig] = df[pt_id_orig].astype(int)
-                df = df[[points_id,pt_id_orig,'distance']].groupby(points_id).apply(lambda x: x[[pt_id_orig,'distance']].to_json(orient='records'))
-                df = df.reset_index()
-                df.columns = [points_id,'attributes']
-                place = 'df:\r\n{}'.format(df)
-                df.to_sql('{}'.format(result_table),con = engine, schema=schema, index = False, if_exists='append')     
+            # results are recorded only while this worker holds the lease on the task (if processed from a work queue)
+            with engine.begin() as connection:
+                work_queue.fence(connection)
+                od_arrays.write(connection, df, schema, result_table)
+    return(0)
   except:
       print('''Error: {}\npolygon: {}\nDestination: {}\nPlace: {}\nSQL: {}'''.format( sys.exc_info(),polygon,'PT',place,sql))  
+      return(1)
   finally:
       arcpy.CheckInExtension('Network')
       engine.dispose()
@@ -319,40 +242,90 @@ if __name__ == '__main__':
     for p in pt_points.destination:
         result_table = 'od_pt_800m_cl_{}'.format(p)
         print('\n{}'.format(result_table))
-        if not engine.has_table(result_table):
+        if not engine.has_table(result_table, schema=schema):
             print("  - create result table '{}'... ".format(result_table)),
-            sql = '''
-              CREATE TABLE IF NOT EXISTS {schema}.{result_table}
-              ({points_id} {points_id_type} NOT NULL ,
-               attributes jsonb
-               );
-               DELETE FROM {schema}.{result_table} WHERE attributes='{curly_braces}';
-               '''.format(result_table=result_table,
-                          schema=schema,
-                          points_id=points_id,
-                          points_id_type=points_id_type,
-                          pt_id = pt_id,
-                          curly_braces = '{}')
-            engine.execute(sql)      
+            od_arrays.create_table(engine, schema, result_table, points_id, points_id_type)
             print("\nDone.")
         else: 
           print("  - result table already exists.")
-        # Select polygons remaining to be processed
-        sql = '''SELECT DISTINCT {polygon_id} FROM poly_points; '''.format(polygon_id=polygon_id)
-        polygons = pandas.read_sql(sql, engine)
-        iteration_list = [[int(i),p] for i in polygons[polygon_id].values]
-        # Parallel processing setting
-        pool = multiprocessing.Pool(processes=nWorkers)
-        # # Iterate process over polygons across nWorkers
-        # # The below code implements a progress counter using polygon iterations
-        r = list(tqdm(pool.imap(od_pt_process, iteration_list), total=len(iteration_list), unit='polygon'))
+          if od_arrays.migrate(engine, schema, result_table, points_id, pt_id_orig):
+              print("  - converted results from JSONB records to arrays of destination ids and distances.")
+        # Select polygon tasks to be processed, ordered by estimated cost (longest first), 
+        # with polygons having more than od_batch_points points split into origin batches
+        tasks = polygon_scheduler.polygon_tasks(engine, polygon_id, 
+                                                max_points = od_batch_points,
+                                                sample_point_feature = sample_point_feature,
+                                                destinations = 'destinations.{}'.format(p),
+                                                distance = 800)
+        iteration_list = [[polygon,batch,batches,p] for polygon,batch,batches in tasks]
+        if od_queue == 'yes':
+            # Tasks are shared with any other hosts processing this queue (named for the result table
+            # and the batching of this run);
+            # only one host at a time may record closest destinations
+            queue = work_queue.queue_name(result_table, od_batch_points)
+            completed = work_queue.process(engine, queue, tasks, od_pt_process, 
+                                           processes = nWorkers,
+                                           extra = (p,),
+                                           lease = od_queue_lease,
+                                           max_tasks = worker_max_tasks)
+            queue_lock = work_queue.lock(engine, queue)
+        else:
+            # Parallel processing setting; worker processes are recycled after worker_max_tasks tasks
+            pool = multiprocessing.Pool(processes=nWorkers, maxtasksperchild=worker_max_tasks or None)
+            # # Iterate process over polygon tasks across nWorkers
+            # # The below code implements a progress counter using polygon task iterations
+            r = list(tqdm(pool.imap(od_pt_process, iteration_list), total=len(iteration_list), unit='task'))
+            pool.close()
+            completed = polygon_scheduler.completed_polygons(iteration_list, r)
+        # Solve final closest analysis for points with no destination in 800m
+        # An OD cost matrix finding the closest stop is solved for all remaining points in the region,
+        # using the network dataset used for distances within 800m; 
+        # this is restricted to polygons which were successfully processed
+        completed = [str(polygon) for polygon in completed]
+        if len(completed) > 0:
+            print("  - record closest stop for points with no stop within 800m..."),
+            remaining = '''
+              p.{polygon_id} IN ({polygons})
+              AND NOT EXISTS (SELECT 1 FROM {schema}.{result_table} r WHERE r.{points_id} = p.{points_id})
+              '''.format(polygon_id = polygon_id,
+                         polygons = ','.join(completed),
+                         schema = schema,
+                         result_table = result_table,
+                         points_id = points_id.lower())
+            df = arcpy_closest.closest_destinations(engine, sample_point_feature, points_id, points_id_type,
+                                                    p, pt_id,
+                                                    where = remaining,
+                                                    in_network_dataset = in_network_dataset,
+                                                    tolerance = tolerance,
+                                                    network_edges = network_edges,
+                                                    network_junctions = network_junctions)
+            if len(df) > 0:
+                df[pt_id_orig] = df['dest_id'].astype(int)
+                df['distance'] = df['distance'].astype(int)
+                df[points_id] = df['id']
+                df = od_arrays.encode(df[[points_id,pt_id_orig,'distance']], points_id, pt_id_orig)
+                od_arrays.write(engine, df, schema, result_table)
+            # Record points with no solution (not located on network, or no reachable stop)
+            sql = '''
+             INSERT INTO {schema}.{result_table} ({points_id})  
+             SELECT p.{points_id}
+               FROM {sample_point_feature} p
+              WHERE {remaining}
+                 ON CONFLICT DO NOTHING;
+             '''.format(result_table = result_table,
+                        schema=schema,
+                        sample_point_feature = sample_point_feature,
+                        points_id = points_id,
+                        remaining = remaining)
+            engine.execute(sql)
+            print("Done.")
+        if od_queue == 'yes':
+            queue_lock.close()
         print("\n  - ensuring all tables are indexed, and contain only unique ids..."),
         sql = '''
           CREATE UNIQUE INDEX IF NOT EXISTS {result_table}_idx ON  {schema}.{result_table} ({points_id});
           CREATE INDEX IF NOT EXISTS {p}_mode_idx ON  destinations.{p} (mode);
           CREATE INDEX IF NOT EXISTS {p}_headway_idx ON  destinations.{p} (headway);
-          CREATE INDEX IF NOT EXISTS {result_table}_{pt_id_orig} ON {schema}.{result_table} ((attributes->'{pt_id_orig}'));
-          CREATE INDEX IF NOT EXISTS {result_table}_distance ON {schema}.{result_table} ((attributes->'distance'));
           -- removing incorrect index, created earlier (refers to 'objectid' instead of 'fid'; due to arcpy mixup)
           DROP INDEX IF EXISTS {result_table}_{pt_id};
           '''.format(result_table=result_table,
@@ -1,4 +1,10 @@
-# Purpose: Evaluate Euclidean buffer co-location of Areas of Open Space with other amenities within 100m
+# Purpose: Evaluate Euclidean buffer co-location of Areas of Open Space with other amenities 
+#          within each of the co-location radii (co_location_radii, by default 100m)
+#
+#          Pairs of AOS and destinations within the largest radius are found in a single pass using
+#          the spatial indexes, and recorded with their exact distance (destinations intersecting an
+#          AOS have distance 0) in open_space.aos_co_location_distances; the co_location_{radius}m
+#          field for each radius is then summarised from these pairs in one aggregation.
 # Author:  Carl Higgs
 # Date:    20180626
 
@@ -19,19 +25,35 @@ conn = psycopg2.connect(database=db, user=db_user, password=db_pwd)
 curs = conn.cursor()
 
 
+max_radius = max(co_location_radii)
+co_location_fields = ['co_location_{}m'.format(radius) for radius in co_location_radii]
+
 sql = '''
-  ALTER TABLE open_space.open_space_areas DROP COLUMN IF EXISTS co_location_100m;
-  ALTER TABLE open_space.open_space_areas ADD COLUMN co_location_100m jsonb;
+  DROP TABLE IF EXISTS open_space.aos_co_location_distances;
+  CREATE TABLE open_space.aos_co_location_distances AS
+  SELECT osa.aos_id, 
+         d.destination,
+         d.dest_oid,
+         ST_Distance(osa.geom,d.geom) AS distance
+    FROM open_space.open_space_areas osa, destinations.study_destinations d 
+   WHERE ST_DWithin(osa.geom,d.geom,{max_radius});
+  CREATE INDEX aos_co_location_distances_idx ON open_space.aos_co_location_distances (aos_id);
+  
+  ALTER TABLE open_space.open_space_areas {drop_fields};
+  ALTER TABLE open_space.open_space_areas {add_fields};
   UPDATE open_space.open_space_areas o 
-     SET co_location_100m  = t.co_location_100m
-    FROM (SELECT aos_id, jsonb_agg(destination) AS co_location_100m
-          FROM open_space.open_space_areas osa, destinations.study_destinations d 
-         WHERE ST_DWithin(osa.geom,d.geom,100) 
-            OR ST_Intersects(osa.geom,d.geom)
-         GROUP BY aos_id) t 
-   WHERE o.aos_id = t.aos_id
-     AND t.co_location_100m IS NOT NULL;
-'''
+     SET {set_fields}
+    FROM (SELECT aos_id, 
+                 {aggregates}
+            FROM open_space.aos_co_location_distances
+           GROUP BY aos_id) t 
+   WHERE o.aos_id = t.aos_id;
+'''.format(max_radius = max_radius,
+           drop_fields = ',\n      '.join(['DROP COLUMN IF EXISTS {}'.format(f) for f in co_location_fields]),
+           add_fields = ',\n      '.join(['ADD COLUMN {} jsonb'.format(f) for f in co_location_fields]),
+           set_fields = ',\n         '.join(['{f} = t.{f}'.format(f = f) for f in co_location_fields]),
+           aggregates = ',\n                 '.join(['jsonb_agg(destination ORDER BY distance) FILTER (WHERE distance <= {radius}) AS co_location_{radius}m'.format(radius = radius) 
+                                                     for radius in co_location_radii]))
 
 
 print(''' Example usage of co-location field:    
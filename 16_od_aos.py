@@ -5,7 +5,6 @@
 # Authors: Carl Higgs
 # Date: 2020-03-17
 
-import arcpy, arcinfo
 import os
 import time
 import multiprocessing
@@ -17,10 +16,19 @@ from sqlalchemy.types import BigInteger
 # from progressor import progressor
 from tqdm import tqdm
 
+import network_routing
+import od_arrays
+import polygon_scheduler
+import work_queue
 from script_running_log import script_running_log
 
 # Import custom variables for National Liveability indicator process
 from _project_setup import *
+
+if routing_engine == 'arcpy':
+    import arcpy, arcinfo
+    import arcpy_closest
+
 engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
                                                                       pwd  = db_pwd,
                                                                       host = db_host,
@@ -32,15 +40,16 @@ script = os.path.basename(sys.argv[0])
 # schema where point indicator output tables will be stored
 schema = 'ind_point'
 
-# ArcGIS environment settings
-arcpy.env.workspace = gdb_path  
-# create project specific folder in temp dir for scratch.gdb, if not exists
-if not os.path.exists(os.path.join(temp,db)):
-    os.makedirs(os.path.join(temp,db))
-    
-arcpy.env.scratchWorkspace = os.path.join(temp,db)  
-arcpy.env.qualifiedFieldNames = False  
-arcpy.env.overwriteOutput = True 
+if routing_engine == 'arcpy':
+    # ArcGIS environment settings
+    arcpy.env.workspace = gdb_path  
+    # create project specific folder in temp dir for scratch.gdb, if not exists
+    if not os.path.exists(os.path.join(temp,db)):
+        os.makedirs(os.path.join(temp,db))
+        
+    arcpy.env.scratchWorkspace = os.path.join(temp,db)  
+    arcpy.env.qualifiedFieldNames = False  
+    arcpy.env.overwriteOutput = True 
 
 # SQL Settings
 
@@ -60,8 +69,7 @@ dest_id =  'aos_id'
 
 print("Access analysis for {}\n".format(dest_points))
 
-in_gdb = arcpy.Exists(dest_points)
-if in_gdb == False:
+if routing_engine == 'arcpy' and not arcpy.Exists(dest_points):
     sys.exit('The required points for this analysis do not appear to be located in the destination geodatabase; please ensure it has been correctly specified and imported')
 
 # pt_fields = [dest_id,'mode','headway']
@@ -69,7 +77,7 @@ if in_gdb == False:
 # get pid name
 pid = multiprocessing.current_process().name
 
-if pid !='MainProcess':
+if pid !='MainProcess' and routing_engine == 'arcpy':
   # Make OD cost matrix layer
   result_object = arcpy.MakeODCostMatrixLayer_na(in_network_dataset = in_network_dataset, 
                                                  out_network_analysis_layer = "ODmatrix", 
@@ -86,22 +94,6 @@ if pid !='MainProcess':
   linesLayerName = subLayerNames["ODLines"]
   ODLinesSubLayer = arcpy.mapping.ListLayers(outNALayer, linesLayerName)[0]
   
-  # Make CLOSEST OD cost matrix layer
-  cl_result_object = arcpy.MakeODCostMatrixLayer_na(in_network_dataset = in_network_dataset, 
-                                                   out_network_analysis_layer = "ODmatrix", 
-                                                   impedance_attribute = "Length", 
-                                                   default_number_destinations_to_find = 1,
-                                                   UTurn_policy = "ALLOW_UTURNS", 
-                                                   hierarchy = "NO_HIERARCHY", 
-                                                   output_path_shape = "NO_LINES")
-  cl_outNALayer = cl_result_object.getOutput(0)
-  #Store the layer names that we will use later
-  cl_subLayerNames = arcpy.na.GetNAClassNames(cl_outNALayer)
-  cl_originsLayerName = cl_subLayerNames["Origins"]
-  cl_destinationsLayerName = cl_subLayerNames["Destinations"]
-  cl_linesLayerName = cl_subLayerNames["ODLines"]
-  cl_ODLinesSubLayer = arcpy.mapping.ListLayers(cl_outNALayer, cl_linesLayerName)[0]
-  
   # Define fields and features
   fields = ['Name', 'Total_Length']
   arcpy.MakeFeatureLayer_management(sample_point_feature, "sample_point_feature_layer")
@@ -125,12 +117,16 @@ def od_destination_process(polygon_dest_tuple):
   '''
     Iterate over polygons to calculate network distances to public transport stops.
     
-    input: [polygon,points]
+    input: [polygon,batch,batches,points] (see polygon_scheduler.py)
     output: Records results to Postgis database in a long form table
             (contra style for most destinations) containing fields
             gnaf_pid fid mode distance headway
             These allow posthoc querying for indicators by locations specific
-            attributes, within threshold, and for closest
+            attributes, within threshold; points with no destination within threshold
+            are subsequently recorded with the closest destination by the main process, 
+            once all polygons are processed.
+            
+            Returns 0 on success, 1 on error, 2 if there were no points to process.
   '''
   engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
                                                                       pwd  = db_pwd,
@@ -141,7 +137,9 @@ def od_destination_process(polygon_dest_tuple):
   arcpy.CheckOutExtension('Network')
   polygonStartTime = time.time() 
   polygon = polygon_dest_tuple[0]
-  destination       = polygon_dest_tuple[1]
+  batch   = polygon_dest_tuple[1]
+  batches = polygon_dest_tuple[2]
+  destination       = polygon_dest_tuple[3]
   result_table = 'od_{}_{}m_cl'.format(concept,threshold)
   try:   
     place = "origin selection"  
@@ -178,26 +176,25 @@ def od_destination_process(polygon_dest_tuple):
         dest_within_dist_polygon_count = int(arcpy.GetCount_management(dest_within_dist_polygon).getOutput(0))
         if dest_within_dist_polygon_count == 0: 
             place = 'zero dest within analysis distance of polygon, solve later'
-        # Add origins
-        if remaining_to_process < origin_point_count:
+        # Add origins (those remaining to be processed, or in this batch if the polygon is split)
+        if remaining_to_process < origin_point_count or batches > 1:
             sql = '''SELECT p.{points_id} 
                      FROM {sample_point_feature} p 
                      LEFT JOIN {schema}.{result_table} r ON p.{points_id} = r.{points_id}
                      WHERE {polygon_id} = {polygon}
+                       AND {batch_filter}
                        AND r.{points_id} IS NULL;
                   '''.format(polygon_id = polygon_id,
                              result_table = result_table,
                              schema=schema,
                              sample_point_feature = sample_point_feature,
                              points_id = points_id.lower(), 
-                             polygon = polygon)
+                             polygon = polygon,
+                             batch_filter = polygon_scheduler.batch_filter(points_id.lower(), batch, batches))
             remaining_points = pandas.read_sql(sql,engine)
-            remaining_points = remaining_points[points_id].astype(str).values
-            if 'int' in points_id_type:
-                points = '{}'.format(",".join(remaining_points))
-            else:
-                remaining_points = remaining_points[points_id].astype(str).values
-                points = "'{}'".format("','".join(remaining_points))
+            if len(remaining_points) == 0:
+                return(2)
+            points = polygon_scheduler.id_list(remaining_points[points_id.lower()].values, points_id_type)
             sql = '''
               {polygon_id} = {polygon} AND {points_id} IN ({points})
               '''.format(polygon_id = polygon_id,
@@ -230,138 +227,226 @@ def od_destination_process(polygon_dest_tuple):
             # e.g. represents a park with multiple pseudo entry points
             # we take the minimum distance for each point-destination combination
             df = df.groupby([points_id,dest_id])['distance'].min().reset_index()
-            df = df[[points_id,dest_id,'distance']].groupby(points_id).apply(lambda x: x[[dest_id,'distance']].to_json(orient='records'))
-            df = df.reset_index()
-            df.columns = [points_id,'attributes']
+            df = od_arrays.encode(df, points_id, dest_id)
             place = 'df:\r\n{}'.format(df)
-            df.to_sql('{}'.format(result_table),con = engine, schema=schema, index = False, if_exists='append')
-        # Solve final closest analysis for points with no destination in threshold
-        sql = '''SELECT p.{points_id} 
-                        FROM {sample_point_feature} p 
-                        LEFT JOIN {schema}.{result_table} r ON p.{points_id} = r.{points_id}
-                        WHERE {polygon_id} = {polygon}
-                          AND r.{points_id} IS NULL;
-                     '''.format(result_table = result_table,
-                                schema=schema,
-                                sample_point_feature = sample_point_feature,
-                                polygon_id = polygon_id, 
-                                points_id = points_id.lower(), 
-                                polygon = polygon)
-        remaining_points = pandas.read_sql(sql,engine)
-        remaining_points = remaining_points[points_id].astype(str).values
-        if 'int' in points_id_type:
-            points = '{}'.format(",".join(remaining_points))
-        else:
-            remaining_points = remaining_points[points_id].astype(str).values
-            points = "'{}'".format("','".join(remaining_points))
-        if len(remaining_points) > 0:
-            sql = '''
-              {polygon_id} = {polygon} AND {points_id} IN ({points})
-              '''.format(polygon = polygon,
-                         polygon_id = polygon_id,   
-                         points_id = points_id,
-                         points = points)
-            origin_subset = arcpy.SelectLayerByAttribute_management("sample_point_feature_layer", 
-                                                                    where_clause = sql)     
-            add_locations(cl_outNALayer,cl_originsLayerName,origin_subset,points_id)       
-            arcpy.SelectLayerByAttribute_management(destination, "NEW_SELECTION")
-            add_locations(cl_outNALayer,cl_destinationsLayerName,destination,dest_id)
-            # Process: Solve
-            result = arcpy.Solve_na(cl_outNALayer, terminate_on_solve_error = "CONTINUE")
-            if result[1] == u'false':
-                alert = (
-                         "\tpolygon {polygon:5} No solution for {n} points"
-                         ).format(polygon = polygon,
-                                  n = len(remaining_points))
-                print(alert)
-                place = 'OD results processed, but no results recorded'
-                sql = '''
-                 INSERT INTO {schema}.{result_table} ({points_id},attributes)  
-                 SELECT p.{points_id},
-                        '{curlyo}{curlyc}'::jsonb
-                   FROM {sample_point_feature} p
-                   LEFT JOIN {schema}.{result_table} r ON p.{points_id} = r.{points_id}
-                  WHERE {polygon_id} = {polygon}
-                    AND r.{points_id} IS NULL
-                     ON CONFLICT DO NOTHING;
-                 '''.format(result_table = result_table,
-                            schema=schema,
-                            sample_point_feature = sample_point_feature,
-                            points_id = points_id,
-                            polygon_id = polygon_id,   
-                            curlyo = '{',
-                            curlyc = '}',                     
-                            polygon = polygon)
-                  # print(null_dest_insert)                           
-                engine.execute(sql)
-            else:
-                place = 'OD results processed; results to be recorded'
-                outputLines = arcpy.da.SearchCursor(cl_ODLinesSubLayer, fields)   
-                data = [x for x in outputLines]
-                df = pandas.DataFrame(data = data, columns = ['od','distance'])
-                df.distance = df.distance.astype('int')
-                df[[points_id,dest_id]] = df['od'].str.split(' - ',expand=True)
-                df[dest_id] = df[dest_id].astype(int)
-                # In case aos_id is not a unique location,
-                # e.g. represents a park with multiple pseudo entry points
-                # we take the minimum distance for each point-destination combination
-                df = df.groupby([points_id,dest_id])['distance'].min().reset_index()
-                df = df[[points_id,dest_id,'distance']].groupby(points_id).apply(lambda x: x[[dest_id,'distance']].to_json(orient='records'))
-                df = df.reset_index()
-                df.columns = [points_id,'attributes']
-                place = 'df:\r\n{}'.format(df)
-                df.to_sql('{}'.format(result_table),con = engine, schema=schema, index = False, if_exists='append')     
+            # results are recorded only while this worker holds the lease on the task (if processed from a work queue)
+            with engine.begin() as connection:
+                work_queue.fence(connection)
+                od_arrays.write(connection, df, schema, result_table)
+    return(0)
   except:
       print('''Error: {}\npolygon: {}\nDestination: {}\nPlace: {}\nSQL: {}'''.format( sys.exc_info(),polygon,concept,place,sql))  
+      return(1)
   finally:
       arcpy.CheckInExtension('Network')
       engine.dispose()
+
+# Network routing engine (routing_engine = 'network')
+# The network and park entry points are loaded once by each worker process, as required
+network = None
+parks = None
+
+def network_parks(engine):
+  '''
+  Located park entry points (cached), indexed so that all entry points of a park are a single
+  multi-source target; a search from an origin then evaluates the distance to the closest 
+  entry point of each park directly, rather than to each of its entry points
+  '''
+  global parks
+  if parks is None:
+      locations = network_routing.locate(engine, network, 
+                                         table = '{}.{}'.format(open_space_schema,dest_points),
+                                         id = dest_id,
+                                         tolerance = tolerance,
+                                         network_schema = network_schema)
+      parks = network_routing.LocationIndex()
+      parks.add_targets(locations)
+  return parks
+
+def network_od_process(polygon_dest_tuple):
+  '''
+    Iterate over polygons to calculate network distances to parks, using the
+    in-process network routing engine (ie. without ArcGIS).
     
+    input: [polygon,batch,batches,points] (see polygon_scheduler.py)
+    output: Records results to Postgis database, as per od_destination_process; a search 
+            bounded at the threshold distance is run from each origin, returning the 
+            distance to each park within threshold.
+            
+            Returns 0 on success, 1 on error, 2 if there were no points to process.
+  '''
+  global network
+  engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
+                                                                      pwd  = db_pwd,
+                                                                      host = db_host,
+                                                                      db   = db), 
+                       use_native_hstore=False)
+  polygon = polygon_dest_tuple[0]
+  batch   = polygon_dest_tuple[1]
+  batches = polygon_dest_tuple[2]
+  result_table = 'od_{}_{}m_cl'.format(concept,threshold)
+  sql = ''
+  try:   
+    place = "network setup"
+    if network is None:
+        network = network_routing.load_network(engine, network_schema = network_schema)
+    destinations = network_parks(engine)
+    place = "origin selection"  
+    # locate origin points in this batch of the polygon remaining to be processed
+    sql = '''
+      p.{polygon_id} = {polygon}
+      AND {batch_filter}
+      AND NOT EXISTS (SELECT 1 FROM {schema}.{result_table} r WHERE r.{points_id} = p.{points_id})
+      '''.format(polygon_id = polygon_id,
+                 polygon = polygon,
+                 batch_filter = polygon_scheduler.batch_filter(points_id.lower(), batch, batches),
+                 schema = schema,
+                 result_table = result_table,
+                 points_id = points_id.lower())
+    origins = network_routing.locate(engine, network, 
+                                     table = sample_point_feature,
+                                     id = points_id,
+                                     where = sql,
+                                     tolerance = tolerance,
+                                     network_schema = network_schema)
+    if len(origins) == 0:
+        return(2)
+    place = "network search"
+    results = []
+    for origin in origins.itertuples():
+        distances = network_routing.distances_within(network, origin, destinations, threshold)
+        if len(distances) > 0:
+            parks_by_distance = sorted([(int(d), int(id)) for id, d in distances.items()])
+            results.append([origin.id,
+                            [id for d, id in parks_by_distance],
+                            [d for d, id in parks_by_distance]])
+    if len(results) > 0:
+        place = 'results were returned, now processing...'
+        df = pandas.DataFrame(data = results, columns = [points_id,'dest_ids','distances'])
+        # results are recorded only while this worker holds the lease on the task (if processed from a work queue)
+        with engine.begin() as connection:
+            work_queue.fence(connection)
+            od_arrays.write(connection, df, schema, result_table)
+    return(0)
+  except:
+      print('''Error: {}\npolygon: {}\nDestination: {}\nPlace: {}\nSQL: {}'''.format( sys.exc_info(),polygon,concept,place,sql))  
+      return(1)
+  finally:
+      engine.dispose()
+
 # MAIN PROCESS
 if __name__ == '__main__':
     task = 'Record distances and {concept} location metadata from origins to {concept} locations within {threshold}m, and closest'.format(concept=concept,threshold=threshold)
+    print("Routing engine: {}".format(routing_engine))
     print("Commencing task ({}): {} at {}".format(db,task,time.strftime("%Y%m%d-%H%M%S")))
     # # initial postgresql connection
     # conn = psycopg2.connect(database=db, user=db_user, password=db_pwd)
     # curs = conn.cursor()  
     result_table = 'od_{}_{}m_cl'.format(concept,threshold)
     print('\n{}'.format(result_table))
-    if not engine.has_table(result_table):
+    if not engine.has_table(result_table, schema=schema):
         print("  - create result table '{}'... ".format(result_table)),
-        sql = '''
-          CREATE TABLE IF NOT EXISTS {schema}.{result_table}
-          ({points_id} {points_id_type} NOT NULL ,
-           attributes jsonb
-           );
-          DELETE FROM {schema}.{result_table} WHERE attributes='{curly_braces}';
-           '''.format(result_table=result_table,
-                      schema=schema,
-                      points_id=points_id,
-                      points_id_type=points_id_type,
-                      dest_id = dest_id,
-                      curly_braces = '{}')
-        engine.execute(sql)      
+        od_arrays.create_table(engine, schema, result_table, points_id, points_id_type)
         print("\nDone.")
     else: 
       print("  - result table already exists.")
-    # Select polygons remaining to be processed
-    sql = '''SELECT DISTINCT {polygon_id} FROM poly_points; '''.format(polygon_id=polygon_id)
-    polygons = pandas.read_sql(sql, engine)
-    iteration_list = [[int(i),dest_points] for i in polygons[polygon_id].values]
-    # Parallel processing setting
-    pool = multiprocessing.Pool(processes=nWorkers)
-    # # Iterate process over polygons across nWorkers
-    # # The below code implements a progress counter using polygon iterations
-    r = list(tqdm(pool.imap(od_destination_process, iteration_list), total=len(iteration_list), unit='polygon'))
+      if od_arrays.migrate(engine, schema, result_table, points_id, dest_id):
+          print("  - converted results from JSONB records to arrays of destination ids and distances.")
+    # Select polygon tasks to be processed, ordered by estimated cost (longest first), 
+    # with polygons having more than od_batch_points points split into origin batches
+    tasks = polygon_scheduler.polygon_tasks(engine, polygon_id, 
+                                            max_points = od_batch_points,
+                                            sample_point_feature = sample_point_feature,
+                                            destinations = '{}.{}'.format(open_space_schema,dest_points),
+                                            distance = threshold)
+    iteration_list = [[polygon,batch,batches,dest_points] for polygon,batch,batches in tasks]
+    if routing_engine == 'arcpy':
+        worker = od_destination_process
+    else:
+        network_routing.snap_index(engine, sample_point_feature, points_id, tolerance, network_schema)
+        network_routing.snap_index(engine, '{}.{}'.format(open_space_schema,dest_points), dest_id, tolerance, network_schema)
+        worker = network_od_process
+    if od_queue == 'yes':
+        # Tasks are shared with any other hosts processing this queue (named for the result table
+        # and the batching of this run);
+        # only one host at a time may record closest destinations
+        queue = work_queue.queue_name(result_table, od_batch_points)
+        completed = work_queue.process(engine, queue, tasks, worker, 
+                                       processes = nWorkers,
+                                       extra = (dest_points,),
+                                       lease = od_queue_lease,
+                                       max_tasks = worker_max_tasks)
+        queue_lock = work_queue.lock(engine, queue)
+    else:
+        # Parallel processing setting; worker processes are recycled after worker_max_tasks tasks
+        pool = multiprocessing.Pool(processes=nWorkers, maxtasksperchild=worker_max_tasks or None)
+        # # Iterate process over polygon tasks across nWorkers
+        # # The below code implements a progress counter using polygon task iterations
+        r = list(tqdm(pool.imap(worker, iteration_list), total=len(iteration_list), unit='task'))
+        pool.close()
+        completed = polygon_scheduler.completed_polygons(iteration_list, r)
+    # Solve final closest analysis for points with no destination in threshold, using the routing engine
+    # used for distances within threshold: using arcpy, an OD cost matrix finding the closest entry point 
+    # is solved for the remaining points; otherwise, a single reverse search from all parks (each a target 
+    # of its entry points) labels every network node with its closest park, from which the closest 
+    # destination for all remaining points in the region is read.  This is restricted to polygons which 
+    # were successfully processed
+    completed = [str(polygon) for polygon in completed]
+    if len(completed) > 0:
+        print("  - record closest destination for points with no destination within threshold..."),
+        remaining = '''
+          p.{polygon_id} IN ({polygons})
+          AND NOT EXISTS (SELECT 1 FROM {schema}.{result_table} r WHERE r.{points_id} = p.{points_id})
+          '''.format(polygon_id = polygon_id,
+                     polygons = ','.join(completed),
+                     schema = schema,
+                     result_table = result_table,
+                     points_id = points_id.lower())
+        if routing_engine == 'arcpy':
+            df = arcpy_closest.closest_destinations(engine, sample_point_feature, points_id, points_id_type,
+                                                    dest_points, dest_id,
+                                                    where = remaining,
+                                                    in_network_dataset = in_network_dataset,
+                                                    tolerance = tolerance,
+                                                    network_edges = network_edges,
+                                                    network_junctions = network_junctions)
+        else:
+            network = network_routing.load_network(engine, network_schema = network_schema)
+            df = network_routing.closest_destinations(engine, network,
+                                                      network_parks(engine),
+                                                      table = sample_point_feature,
+                                                      id = points_id,
+                                                      where = remaining,
+                                                      tolerance = tolerance,
+                                                      network_schema = network_schema)
+        if len(df) > 0:
+            df[dest_id] = df['dest_id'].astype(int)
+            df['distance'] = df['distance'].astype(int)
+            df[points_id] = df['id']
+            df = od_arrays.encode(df[[points_id,dest_id,'distance']], points_id, dest_id)
+            od_arrays.write(engine, df, schema, result_table)
+        # Record points with no solution (not located on network, or no reachable destination)
+        sql = '''
+         INSERT INTO {schema}.{result_table} ({points_id})  
+         SELECT p.{points_id}
+           FROM {sample_point_feature} p
+          WHERE {remaining}
+             ON CONFLICT DO NOTHING;
+         '''.format(result_table = result_table,
+                    schema=schema,
+                    sample_point_feature = sample_point_feature,
+                    points_id = points_id,
+                    remaining = remaining)
+        engine.execute(sql)
+        print("Done.")
+    if od_queue == 'yes':
+        queue_lock.close()
     print("\n  - ensuring all tables are indexed, and contain only unique ids..."),
     sql = '''
       CREATE UNIQUE INDEX IF NOT EXISTS {result_table}_idx ON  {schema}.{result_table} ({points_id});
-      CREATE INDEX IF NOT EXISTS {result_table}_{dest_id} ON {schema}.{result_table} ((attributes->'{dest_id}'));
-      CREATE INDEX IF NOT EXISTS {result_table}_distance ON {schema}.{result_table} ((attributes->'distance'));
       '''.format(result_table=result_table,
                  points_id=points_id,
-                 schema=schema,
-                 dest_id=dest_id)
+                 schema=schema)
     engine.execute(sql)
     print("Done.")   
     print("  - Processed results summary:")
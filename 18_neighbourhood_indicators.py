@@ -10,6 +10,8 @@ import psycopg2
 from sqlalchemy import create_engine
 
 from script_running_log import script_running_log
+import threshold_indicators
+import od_arrays
 
 # Import custom variables for National Liveability indicator process
 from _project_setup import *
@@ -83,68 +85,41 @@ DROP TABLE IF EXISTS {schema}.{table};
 CREATE TABLE IF NOT EXISTS {schema}.{table} AS
 SELECT 
        p.{points_id},
-       LEAST(array_min(convenience_osm.distances),
-             array_min(newsagent_osm.distances),
-             array_min(petrolstation_osm.distances),
-             array_min(market_osm.distances)) AS convenience_osm_2018,
-       LEAST(array_min(supermarkets_2017.distances),
-             array_min(supermarket_osm.distances)) AS supermarket_hlc_2017_osm_2018,
-       LEAST(array_min(community_centre_osm.distances),
-             array_min(hlc_2016_community_centres.distances)) AS community_centre_hlc_2016_osm_2018,
-       LEAST(array_min(bakery_osm.distances),
-             array_min(meat_seafood_osm.distances),
-             array_min(fruit_veg_osm.distances),
-             array_min(deli_osm.distances)) AS food_fresh_specialty_osm_2018,
-       LEAST(array_min(fastfood_osm.distances),
-             array_min(food_court_osm.distances),
-             array_min(fastfood_2017.distances)) AS food_fast_hlc_2017_osm_2018,         
-       LEAST(array_min(restaurant_osm.distances),
-             array_min(cafe_osm.distances),
-             array_min(pub_osm.distances)) AS food_dining_osm_2018,     
-       LEAST(array_min(museum_osm.distances), 
-             array_min(theatre_osm.distances), 
-             array_min(cinema_osm.distances), 
-             array_min(art_gallery_osm.distances), 
-             array_min(art_centre_osm.distances)) AS culture_osm_2018,            
-       LEAST(array_min(bar_osm.distances), 
-             array_min(nightclub_osm.distances),
-             array_min(pub_osm.distances)) AS alcohol_nightlife_osm_2018,            
-       LEAST(array_min("p_12_schools_gov_2018".distances), 
-             array_min(primary_schools_gov_2018.distances)) AS schools_primary_all_gov,           
-       LEAST(array_min("p_12_schools_gov_2018".distances), 
-             array_min(secondary_schools_gov_2018.distances)) AS schools_secondary_all_gov,
+       LEAST(c."convenience_osm",
+             c."newsagent_osm",
+             c."petrolstation_osm",
+             c."market_osm") AS convenience_osm_2018,
+       LEAST(c."supermarkets_2017",
+             c."supermarket_osm") AS supermarket_hlc_2017_osm_2018,
+       LEAST(c."community_centre_osm",
+             c."hlc_2016_community_centres") AS community_centre_hlc_2016_osm_2018,
+       LEAST(c."bakery_osm",
+             c."meat_seafood_osm",
+             c."fruit_veg_osm",
+             c."deli_osm") AS food_fresh_specialty_osm_2018,
+       LEAST(c."fastfood_osm",
+             c."food_court_osm",
+             c."fastfood_2017") AS food_fast_hlc_2017_osm_2018,         
+       LEAST(c."restaurant_osm",
+             c."cafe_osm",
+             c."pub_osm") AS food_dining_osm_2018,     
+       LEAST(c."museum_osm", 
+             c."theatre_osm", 
+             c."cinema_osm", 
+             c."art_gallery_osm", 
+             c."art_centre_osm") AS culture_osm_2018,            
+       LEAST(c."bar_osm", 
+             c."nightclub_osm",
+             c."pub_osm") AS alcohol_nightlife_osm_2018,            
+       LEAST(c."p_12_schools_gov_2018", 
+             c."primary_schools_gov_2018") AS schools_primary_all_gov,           
+       LEAST(c."p_12_schools_gov_2018", 
+             c."secondary_schools_gov_2018") AS schools_secondary_all_gov,
        ind_pt_d_800m_cl_headway_day_2019_oct8_dec5_0700_1900.pt_any AS gtfs_20191008_20191205_pt_any,
        ind_pt_d_800m_cl_headway_day_2019_oct8_dec5_0700_1900.pt_h20min AS gtfs_20191008_20191205_pt_0020
 FROM {sample_point_feature} p
-LEFT JOIN d_3200m_cl."p_12_schools_gov_2018"   ON p.{points_id}    = d_3200m_cl."p_12_schools_gov_2018".{points_id}
-LEFT JOIN d_3200m_cl.primary_schools_gov_2018  ON p.{points_id}    = d_3200m_cl.primary_schools_gov_2018.{points_id}
-LEFT JOIN d_3200m_cl.secondary_schools_gov_2018  ON p.{points_id}    = d_3200m_cl.secondary_schools_gov_2018.{points_id}
+LEFT JOIN d_3200m_cl.closest_distance c ON p.{points_id} = c.{points_id}
 LEFT JOIN ind_point.ind_pt_d_800m_cl_headway_day_2019_oct8_dec5_0700_1900   ON p.{points_id}    = ind_point.ind_pt_d_800m_cl_headway_day_2019_oct8_dec5_0700_1900.{points_id}
-LEFT JOIN d_3200m_cl.convenience_osm   ON p.{points_id}    = d_3200m_cl.convenience_osm.{points_id}
-LEFT JOIN d_3200m_cl.newsagent_osm     ON p.{points_id}    = d_3200m_cl.newsagent_osm.{points_id}
-LEFT JOIN d_3200m_cl.petrolstation_osm ON p.{points_id}    = d_3200m_cl.petrolstation_osm.{points_id}
-LEFT JOIN d_3200m_cl.market_osm        ON p.{points_id}    = d_3200m_cl.market_osm.{points_id}
-LEFT JOIN d_3200m_cl.supermarkets_2017 ON p.{points_id}    = d_3200m_cl.supermarkets_2017.{points_id}
-LEFT JOIN d_3200m_cl.supermarket_osm ON p.{points_id} = d_3200m_cl.supermarket_osm.{points_id} 
-LEFT JOIN d_3200m_cl.community_centre_osm ON p.{points_id} = d_3200m_cl.community_centre_osm.{points_id}
-LEFT JOIN d_3200m_cl.hlc_2016_community_centres ON p.{points_id} = d_3200m_cl.hlc_2016_community_centres.{points_id}
-LEFT JOIN d_3200m_cl.bakery_osm       ON p.{points_id} = d_3200m_cl.bakery_osm.{points_id}
-LEFT JOIN d_3200m_cl.meat_seafood_osm ON p.{points_id} = d_3200m_cl.meat_seafood_osm.{points_id}
-LEFT JOIN d_3200m_cl.fruit_veg_osm   ON p.{points_id}  = d_3200m_cl.fruit_veg_osm.{points_id}
-LEFT JOIN d_3200m_cl.deli_osm        ON p.{points_id}  = d_3200m_cl.deli_osm.{points_id}
-LEFT JOIN d_3200m_cl.fastfood_osm    ON p.{points_id}  = d_3200m_cl.fastfood_osm.{points_id}
-LEFT JOIN d_3200m_cl.food_court_osm  ON p.{points_id}  = d_3200m_cl.food_court_osm.{points_id}            
-LEFT JOIN d_3200m_cl.fastfood_2017   ON p.{points_id}  = d_3200m_cl.fastfood_2017.{points_id}
-LEFT JOIN d_3200m_cl.restaurant_osm  ON p.{points_id}  = d_3200m_cl.restaurant_osm.{points_id}
-LEFT JOIN d_3200m_cl.cafe_osm        ON p.{points_id}  = d_3200m_cl.cafe_osm.{points_id}
-LEFT JOIN d_3200m_cl.museum_osm      ON p.{points_id}  = d_3200m_cl.museum_osm.{points_id} 
-LEFT JOIN d_3200m_cl.theatre_osm     ON p.{points_id}  = d_3200m_cl.theatre_osm.{points_id} 
-LEFT JOIN d_3200m_cl.cinema_osm      ON p.{points_id}  = d_3200m_cl.cinema_osm.{points_id} 
-LEFT JOIN d_3200m_cl.art_gallery_osm ON p.{points_id}  = d_3200m_cl.art_gallery_osm.{points_id} 
-LEFT JOIN d_3200m_cl.art_centre_osm  ON p.{points_id}  = d_3200m_cl.art_centre_osm.{points_id} 
-LEFT JOIN d_3200m_cl.bar_osm         ON p.{points_id}  = d_3200m_cl.bar_osm.{points_id} 
-LEFT JOIN d_3200m_cl.nightclub_osm   ON p.{points_id}  = d_3200m_cl.nightclub_osm.{points_id}
-LEFT JOIN d_3200m_cl.pub_osm         ON p.{points_id}  = d_3200m_cl.pub_osm.{points_id}  
 ;
 CREATE UNIQUE INDEX IF NOT EXISTS {table}_idx ON  {schema}.{table} ({points_id}); 
 '''.format(sample_point_feature = sample_point_feature, schema = schema, points_id = points_id,table = table)
@@ -154,111 +129,79 @@ conn.commit()
 print("Done.")
   
 print("Create hard and soft threshold indicators for curated destination categories...")
-for threshold_type in ['hard','soft']:
-    for nh_threshold in [400,800,1000,1600]:
-        print("  - nh_inds_{threshold_type}_{nh_threshold}m".format(threshold_type = threshold_type, nh_threshold = nh_threshold))
-        sql = '''
-        DROP TABLE IF EXISTS {schema}.nh_inds_{threshold_type}_{nh_threshold}m;
-        CREATE TABLE IF NOT EXISTS {schema}.nh_inds_{threshold_type}_{nh_threshold}m AS
-        SELECT  
-        {points_id},
-        threshold_{threshold_type}(convenience_osm_2018,{nh_threshold}) AS convenience_osm_2018, 
-        threshold_{threshold_type}(supermarket_hlc_2017_osm_2018,{nh_threshold}) AS supermarket_hlc_2017_osm_2018, 
-        threshold_{threshold_type}(community_centre_hlc_2016_osm_2018,{nh_threshold}) AS community_centre_hlc_2016_osm_2018,
-        threshold_{threshold_type}(food_fresh_specialty_osm_2018,{nh_threshold}) AS food_fresh_specialty_osm_2018 ,
-        threshold_{threshold_type}(food_fast_hlc_2017_osm_2018,{nh_threshold}) AS food_fast_hlc_2017_osm_2018,
-        threshold_{threshold_type}(food_dining_osm_2018,{nh_threshold}) AS food_dining_osm_2018,
-        threshold_{threshold_type}(culture_osm_2018,{nh_threshold}) AS culture_osm_2018,
-        threshold_{threshold_type}(gtfs_20191008_20191205_pt_any    ,{nh_threshold}) AS gtfs_20191008_20191205_pt_any,
-        threshold_{threshold_type}(gtfs_20191008_20191205_pt_0020    ,{nh_threshold}) AS gtfs_20191008_20191205_pt_0020
-        FROM {schema}.nh_inds_distance ;
-        CREATE UNIQUE INDEX IF NOT EXISTS nh_inds_{threshold_type}_{nh_threshold}m_idx ON  {schema}.nh_inds_{threshold_type}_{nh_threshold}m ({points_id}); 
-        '''.format(points_id = points_id,schema = schema, threshold_type = threshold_type, nh_threshold = nh_threshold)
-        engine.execute(sql)
-        
+# Distances to closest destination are read once, and indicators for all threshold types and 
+# distances are evaluated as arrays, and copied to a single wide table (nh_inds_threshold)
+nh_inds_destinations = threshold_indicators.nh_inds_destinations
+local_living_destinations = threshold_indicators.local_living_destinations
+sql = '''
+SELECT n.{points_id},
+       {nh_inds},
+       {local_living}
+  FROM {schema}.nh_inds_distance n
+  LEFT JOIN d_3200m_cl.closest_distance c ON n.{points_id} = c.{points_id}
+ ORDER BY n.{points_id};
+'''.format(points_id = points_id,
+           schema = schema,
+           nh_inds = ','.join(['n.{0}'.format(x) for x in nh_inds_destinations]),
+           local_living = ','.join(['c."{0}" AS {0}'.format(x) for x in local_living_destinations]))
+count = threshold_indicators.write_threshold_indicators(engine, 
+                                                        '{}.nh_inds_threshold'.format(schema), 
+                                                        sql, 
+                                                        points_id, 
+                                                        points_id_type, 
+                                                        nh_inds_destinations + local_living_destinations)
+print("  - nh_inds_threshold ({} points)".format(count))
+# views by threshold type and distance (e.g. nh_inds_soft_1000m), as used in indicator configuration queries
+threshold_indicators.write_threshold_views(engine, 
+                                           schema, 
+                                           'nh_inds_threshold', 
+                                           points_id, 
+                                           nh_inds_destinations + local_living_destinations)
+print("  - nh_inds_{hard,soft}_{400,800,1000,1600}m (views)")
 print("Done.")
 
 print("Processing neighbourhood indicators:")
 # Define table name and abbreviation
 # This saves us having to retype these values, and allows the code to be more easily re-used
-table = 'ind_daily_living'
-abbrev = 'dl'
-print(" - {}".format(table)),
-ind_list = []
-from_list = []
-for t in ['hard','soft']:
-    for d in [400,800,1000,1600]:
-        inds = '''
-          (COALESCE(nh_inds_{t}_{d}m.convenience_osm_2018,0) + 
-           COALESCE(nh_inds_{t}_{d}m.supermarket_hlc_2017_osm_2018,0) + 
-           COALESCE(nh_inds_{t}_{d}m.gtfs_20191008_20191205_pt_any,0)) AS {abbrev}_{t}_{d}m
-        '''.format(t=t,d=d,abbrev=abbrev)
-        ind_list  +=[inds]
-        from_list +=['LEFT JOIN {schema}.nh_inds_{t}_{d}m ON p.{points_id} = {schema}.nh_inds_{t}_{d}m.{points_id}'.format(t=t,d=d,schema = schema, points_id=points_id)]
-sql = '''
-DROP TABLE IF EXISTS {schema}.{table};
-CREATE TABLE {schema}.{table} AS
-SELECT p.{points_id},
-       {inds}
-FROM {sample_point_feature} p
-     {from_list};
-CREATE UNIQUE INDEX {table}_idx ON  {schema}.{table} ({points_id});
-'''.format(inds=','.join(ind_list), 
-           schema = schema, 
-           sample_point_feature=sample_point_feature,
-           from_list = '\r\n'.join(from_list),
-           points_id = points_id,
-           table = table)
-engine.execute(sql)
-
-print(" Done.")
-
-table = 'ind_local_living'
-abbrev = 'll'
-print(" - {}".format(table)),
-ind_list = []
-from_list = []
-for t in ['hard','soft']:
-    for d in [400,800,1000,1600]:
-        inds = '''
-            (COALESCE(nh_inds_{t}_{d}m.community_centre_hlc_2016_osm_2018,0) + 
-            COALESCE(threshold_{t}(array_min(d_3200m_cl.libraries_2018.distances),{d}),0) +
-            COALESCE(threshold_{t}(array_min(d_3200m_cl.childcare_all_meet_2019.distances),{d}),0) +
-            COALESCE(threshold_{t}(array_min(d_3200m_cl. nhsd_2017_dentist.distances),{d}),0) +
-            COALESCE(threshold_{t}(array_min(d_3200m_cl. nhsd_2017_gp.distances),{d}),0) +
-            COALESCE(threshold_{t}(array_min(d_3200m_cl. nhsd_2017_pharmacy.distances),{d}),0) +
-            COALESCE(nh_inds_{t}_{d}m.supermarket_hlc_2017_osm_2018,0) + 
-            COALESCE(nh_inds_{t}_{d}m.convenience_osm_2018,0) +
-            COALESCE(nh_inds_{t}_{d}m.food_fresh_specialty_osm_2018,0) +
-            COALESCE(threshold_{t}(array_min(d_3200m_cl.postoffice_osm.distances),{d}),0) + 
-            COALESCE(nh_inds_{t}_{d}m.gtfs_20191008_20191205_pt_any,0)) AS {abbrev}_{t}_{d}m
-        '''.format(t=t,d=d,abbrev=abbrev)
-        ind_list  +=[inds]
-        from_list +=['LEFT JOIN {schema}.nh_inds_{t}_{d}m ON p.{points_id} = {schema}.nh_inds_{t}_{d}m.{points_id}'.format(t=t,d=d,
-           schema = schema, points_id=points_id)]
-sql = '''
-DROP TABLE IF EXISTS {schema}.{table};
-CREATE TABLE {schema}.{table} AS
-SELECT p.{points_id},
-       {inds}
-FROM {sample_point_feature} p
-     {from_list}
-    LEFT JOIN d_3200m_cl.libraries_2018 ON p.{points_id} = d_3200m_cl.libraries_2018.{points_id}
-    LEFT JOIN d_3200m_cl.childcare_all_meet_2019 ON p.{points_id} = d_3200m_cl.childcare_all_meet_2019.{points_id}
-    LEFT JOIN d_3200m_cl. nhsd_2017_dentist ON p.{points_id} = d_3200m_cl. nhsd_2017_dentist.{points_id}
-    LEFT JOIN d_3200m_cl. nhsd_2017_gp ON p.{points_id} = d_3200m_cl. nhsd_2017_gp.{points_id}
-    LEFT JOIN d_3200m_cl. nhsd_2017_pharmacy ON p.{points_id} = d_3200m_cl. nhsd_2017_pharmacy.{points_id}
-    LEFT JOIN d_3200m_cl.postoffice_osm ON p.{points_id} = d_3200m_cl.postoffice_osm.{points_id} ;
-CREATE UNIQUE INDEX {table}_idx ON  {schema}.{table} ({points_id});
-'''.format(inds=','.join(ind_list), 
-           sample_point_feature=sample_point_feature,
-           schema = schema, 
-           from_list = '\r\n'.join(from_list),
-           points_id = points_id,
-           table = table)
-engine.execute(sql)
-
-print(" Done.")
+indicator_sets = [['ind_daily_living','dl',['convenience_osm_2018',
+                                            'supermarket_hlc_2017_osm_2018',
+                                            'gtfs_20191008_20191205_pt_any']],
+                  ['ind_local_living','ll',['community_centre_hlc_2016_osm_2018',
+                                            'libraries_2018',
+                                            'childcare_all_meet_2019',
+                                            'nhsd_2017_dentist',
+                                            'nhsd_2017_gp',
+                                            'nhsd_2017_pharmacy',
+                                            'supermarket_hlc_2017_osm_2018',
+                                            'convenience_osm_2018',
+                                            'food_fresh_specialty_osm_2018',
+                                            'postoffice_osm',
+                                            'gtfs_20191008_20191205_pt_any']]]
+for table, abbrev, destinations in indicator_sets:
+    print(" - {}".format(table)),
+    ind_list = []
+    for t in threshold_indicators.threshold_types:
+        for d in threshold_indicators.thresholds:
+            inds = '''
+              ({sum}) AS {abbrev}_{t}_{d}m
+            '''.format(sum = ' + \n'.join(['COALESCE(n.{}_{}_{}m,0)'.format(x,t,d) for x in destinations]),
+                       t=t,d=d,abbrev=abbrev)
+            ind_list  +=[inds]
+    sql = '''
+    DROP TABLE IF EXISTS {schema}.{table};
+    CREATE TABLE {schema}.{table} AS
+    SELECT p.{points_id},
+           {inds}
+    FROM {sample_point_feature} p
+    LEFT JOIN {schema}.nh_inds_threshold n ON p.{points_id} = n.{points_id};
+    CREATE UNIQUE INDEX {table}_idx ON  {schema}.{table} ({points_id});
+    '''.format(inds=','.join(ind_list), 
+               schema = schema, 
+               sample_point_feature=sample_point_feature,
+               points_id = points_id,
+               table = table)
+    engine.execute(sql)
+    print(" Done.")
 
 # calculate food indicators at both 1600 m and 3200 m 
 print(" - ind_food... "),
@@ -334,14 +277,8 @@ else:
 table = ['ind_os_distances_3200m','os']
 print(" - {schema}.{table}".format(table = table[0],schema=schema)),
 
-sql = '''
-DROP TABLE IF EXISTS {schema}.{table};
-CREATE TABLE IF NOT EXISTS {schema}.{table} AS SELECT {points_id} FROM {sample_point_feature};
-'''.format(table = table[0], sample_point_feature=sample_point_feature,schema=schema,points_id = points_id)
-engine.execute(sql)
-
-
-# Create OS measures if not existing
+# OS measures: distances to areas of open space of interest (by public open space size), 
+# and to areas with sport facilities, or public open space with toilets nearby
 aos_of_interest = [["pos_any"         ,"aos_ha_public > 0"                         ],
                    ["pos_0k_4k_sqm"   ,"aos_ha_public > 0 AND aos_ha_public <= 0.4"],
                    ["pos_4k_sqm"      ,"aos_ha_public > 0.4"                       ],
@@ -352,150 +289,78 @@ aos_of_interest = [["pos_any"         ,"aos_ha_public > 0"
                    ["pos_10k_50k_sqm" ,"aos_ha_public > 1 AND aos_ha_public <= 5"  ],
                    ["pos_50k_200k_sqm","aos_ha_public > 5 AND aos_ha_public <= 20" ],
                    ["pos_50k_sqm"     ,"aos_ha_public > 5 AND aos_ha_public <= 20" ],
-                   ["pos_200k_sqm"    ,"aos_ha_public > 20"                        ]]
-
-for aos in aos_of_interest:
-    measure = '{}_distances_3200m'.format(aos[0])
-    sql = '''
-    SELECT 1
-    FROM information_schema.columns 
-    WHERE table_name='{table}' AND table_schema='{schema}' AND column_name='{column}';
-    '''.format(table = table[0],schema=schema,column = measure)
-    res = engine.execute(sql).fetchone()
-    if not res:   
-        add_and_update_measure = '''
-        DROP INDEX IF EXISTS {schema}.{table}_idx;
-        ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS {measure} int[];
-        UPDATE {schema}.{table} t 
-        SET {measure} = os_filtered.distances
-        FROM {sample_point_feature} orig
-        LEFT JOIN (SELECT p.{points_id}, 
-                        array_agg(distance) AS distances
-                    FROM {sample_point_feature} p
-                    LEFT JOIN 
-                    (SELECT {points_id},
-                            (obj->>'aos_id')::int AS aos_id,
-                            (obj->>'distance')::int AS distance
-                    FROM ind_point.od_aos_3200m_cl,
-                        jsonb_array_elements(attributes) obj) o ON p.{points_id} = o.{points_id}
-                    LEFT JOIN open_space.open_space_areas pos ON o.aos_id = pos.aos_id
-                        WHERE pos.aos_id IS NOT NULL
-                        AND {where}
-                    GROUP BY p.{points_id}) os_filtered ON orig.{points_id} = os_filtered.{points_id}
-        WHERE t.{points_id} = orig.{points_id};
-        '''.format(points_id = points_id,
-                   schema=schema,
-                   sample_point_feature=sample_point_feature, 
-                   table = table[0], 
-                   measure = measure,
-                   where = aos[1])
-        engine.execute(add_and_update_measure)
-        
-    print("."),
-
-measure = 'sport_distances_3200m'
+                   ["pos_200k_sqm"    ,"aos_ha_public > 20"                        ],
+                   ["sport"           ,"sport AND distance < 3200"                 ],
+                   ["pos_toilet"      ,"aos_ha_public IS NOT NULL AND toilets"     ]]
+
+# The AOS OD results are exploded once to a typed (point, aos_id, distance) relation, with 
+# the size, sport and toilet attributes of each AOS attached; the distance arrays for all 
+# measures are then evaluated in a single grouped aggregate, as sorted arrays
+# (AOS OD results recorded as JSONB are first converted to arrays, if required)
+od_arrays.migrate(engine, 'ind_point', 'od_aos_3200m_cl', points_id, 'aos_id')
 sql = '''
-SELECT 1 
-FROM information_schema.columns 
-WHERE table_name='{table}' AND table_schema = '{schema}' AND column_name='{column}';
-'''.format(table = table[0],schema=schema,column = measure)
-res = engine.execute(sql).fetchone()
-if not res:     
-    add_and_update_measure = '''
-    DROP INDEX IF EXISTS {schema}.{table}_idx;
-    ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS {measure} int[];
-    UPDATE {schema}.{table} t 
-    SET {measure} = os_filtered.distances
-    FROM {sample_point_feature} orig
-    LEFT JOIN (SELECT p.{points_id}, 
-                    array_agg(distance) AS distances
-            FROM {sample_point_feature} p
-            LEFT JOIN (SELECT {points_id},
-                                (obj->>'aos_id')::int AS aos_id,
-                                (obj->>'distance')::int AS distance
-                            FROM ind_point.od_aos_3200m_cl,
-                                jsonb_array_elements(attributes) obj
-                        WHERE (obj->>'distance')::int < 3200) o ON p.{points_id} = o.{points_id}                  
-            WHERE EXISTS -- we restrict our results to distances to AOS with sports facilities 
-                        (SELECT 1 FROM open_space.open_space_areas sport,
-                                        jsonb_array_elements(attributes) obj
-                            WHERE (obj->>'leisure' IN ('golf_course','sports_club','sports_centre','fitness_centre','pitch','track','fitness_station','ice_rink','swimming_pool') 
-                            OR (obj->>'sport' IS NOT NULL 
-                            AND obj->>'sport' != 'no'))
-                            AND  o.aos_id = sport.aos_id)
-            GROUP BY p.{points_id} ) os_filtered ON orig.{points_id} = os_filtered.{points_id}
-    WHERE t.{points_id} = orig.{points_id};
-    '''.format(points_id = points_id,
-           sample_point_feature=sample_point_feature, 
-           schema=schema,
+DROP TABLE IF EXISTS {schema}.od_aos_3200m_cl_long;
+CREATE UNLOGGED TABLE {schema}.od_aos_3200m_cl_long AS
+WITH aos AS (
+    SELECT aos_id,
+           aos_ha_public,
+           EXISTS (SELECT 1 
+                     FROM jsonb_array_elements(attributes) obj
+                    WHERE obj->>'leisure' IN ('golf_course','sports_club','sports_centre','fitness_centre','pitch','track','fitness_station','ice_rink','swimming_pool') 
+                       OR (obj->>'sport' IS NOT NULL 
+                           AND obj->>'sport' != 'no')) AS sport,
+           COALESCE(co_location_100m ? 'toilets_2018', FALSE) AS toilets
+      FROM open_space.open_space_areas)
+SELECT r.{points_id},
+       aos.aos_id,
+       o.distance,
+       aos.aos_ha_public,
+       aos.sport,
+       aos.toilets
+  FROM ind_point.od_aos_3200m_cl r,
+       unnest(r.dest_ids, r.distances) o(aos_id, distance)
+  JOIN aos ON o.aos_id = aos.aos_id;
+CREATE INDEX od_aos_3200m_cl_long_idx ON {schema}.od_aos_3200m_cl_long ({points_id});
+ANALYZE {schema}.od_aos_3200m_cl_long;
+DROP TABLE IF EXISTS {schema}.{table};
+CREATE TABLE {schema}.{table} AS 
+SELECT p.{points_id},
+       {measures}
+  FROM {sample_point_feature} p
+  LEFT JOIN {schema}.od_aos_3200m_cl_long o ON p.{points_id} = o.{points_id}
+ GROUP BY p.{points_id};
+CREATE UNIQUE INDEX IF NOT EXISTS {table}_idx ON  {schema}.{table} ({points_id});
+'''.format(points_id = points_id,
+           schema = schema,
+           sample_point_feature = sample_point_feature, 
            table = table[0], 
-           measure = measure)
-    engine.execute(add_and_update_measure)
-
-
-measure = 'pos_toilet_distances_3200m'
-sql = '''
-SELECT column_name 
-FROM information_schema.columns 
-WHERE table_name='{table}' AND table_schema = '{schema}' AND column_name='{column}';
-'''.format(table = table[0],column = measure,schema=schema)
-res = engine.execute(sql).fetchone()
-if not res:     
-    add_and_update_measure = '''
-    DROP INDEX IF EXISTS {table}_idx;
-    ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS {measure} int[];
-    UPDATE {schema}.{table} t 
-    SET {measure} = os_filtered.distances
-    FROM {sample_point_feature} orig
-    LEFT JOIN (SELECT DISTINCT ON (p.{points_id}) 
-                    p.{points_id}, 
-                    array_agg(distance) AS distances
-            FROM {sample_point_feature} p
-            LEFT JOIN   
-                        (SELECT {points_id},  
-                        (obj->>'aos_id')::int AS aos_id, 
-                        (obj->>'distance')::int AS distance 
-                        FROM ind_point.od_aos_3200m_cl, 
-                        jsonb_array_elements(attributes) obj) o ON p.{points_id} = o.{points_id} 
-            LEFT JOIN open_space.open_space_areas pos ON o.aos_id = pos.aos_id 
-                WHERE pos.aos_id IS NOT NULL  
-                    AND co_location_100m ? 'toilets_2018'
-            GROUP BY p.{points_id} ) os_filtered ON orig.{points_id} = os_filtered.{points_id}
-    WHERE t.{points_id} = orig.{points_id};
-    '''.format(points_id = points_id, 
-           sample_point_feature=sample_point_feature,
-           schema=schema,
-           table = table[0],
-           measure = measure)
-    engine.execute(add_and_update_measure)
-    
-print("."),
+           measures = ',\n       '.join(['array_agg(distance ORDER BY distance) FILTER (WHERE {where}) AS {measure}_distances_3200m'.format(measure = aos[0], where = aos[1]) 
+                                           for aos in aos_of_interest]))
+engine.execute(sql)
 print(" Done.")
 
-create_index = '''CREATE UNIQUE INDEX IF NOT EXISTS {table}_idx ON  {schema}.{table} ({points_id});  '''.format(table = table[0], schema=schema, points_id = points_id)
-engine.execute(create_index)
-
 
 table = ['ind_os_distance','os']
 print(" - {schema}.{table}".format(table = table[0],schema=schema)),    
 sql = '''
 DROP TABLE IF EXISTS {schema}.ind_os_distance;
 CREATE TABLE IF NOT EXISTS {schema}.ind_os_distance AS
+-- (distance arrays are aggregated in ascending order, so the closest distance is the first element)
 SELECT 
     {points_id},
-    array_min(pos_any_distances_3200m) AS pos_any_distance_m,
-    array_min(pos_0k_4k_sqm_distances_3200m) AS pos_0k_4k_sqm_distance_m,
-    array_min(pos_4k_sqm_distances_3200m) AS pos_4k_sqm_distance_m,
-    array_min(pos_5k_sqm_distances_3200m) AS pos_5k_sqm_distance_m,
-    array_min(pos_15k_sqm_distances_3200m) AS pos_15k_sqm_distance_m,
-    array_min(pos_20k_sqm_distances_3200m) AS pos_20k_sqm_distance_m,
-    array_min(pos_4k_10k_sqm_distances_3200m) AS pos_4k_10k_sqm_distance_m,
-    array_min(pos_10k_50k_sqm_distances_3200m) AS pos_10k_50k_sqm_distance_m,
-    array_min(pos_50k_200k_sqm_distances_3200m) AS pos_50k_200k_sqm_distance_m,
-    array_min(pos_50k_sqm_distances_3200m) AS pos_50k_sqm_distance_m,
-    array_min(pos_200k_sqm_distances_3200m) AS pos_200k_sqm_distance_m,
-    array_min(sport_distances_3200m) AS sport_distance_m,
-    array_min(pos_toilet_distances_3200m) AS pos_toilet_distance_m
+    array_first(pos_any_distances_3200m) AS pos_any_distance_m,
+    array_first(pos_0k_4k_sqm_distances_3200m) AS pos_0k_4k_sqm_distance_m,
+    array_first(pos_4k_sqm_distances_3200m) AS pos_4k_sqm_distance_m,
+    array_first(pos_5k_sqm_distances_3200m) AS pos_5k_sqm_distance_m,
+    array_first(pos_15k_sqm_distances_3200m) AS pos_15k_sqm_distance_m,
+    array_first(pos_20k_sqm_distances_3200m) AS pos_20k_sqm_distance_m,
+    array_first(pos_4k_10k_sqm_distances_3200m) AS pos_4k_10k_sqm_distance_m,
+    array_first(pos_10k_50k_sqm_distances_3200m) AS pos_10k_50k_sqm_distance_m,
+    array_first(pos_50k_200k_sqm_distances_3200m) AS pos_50k_200k_sqm_distance_m,
+    array_first(pos_50k_sqm_distances_3200m) AS pos_50k_sqm_distance_m,
+    array_first(pos_200k_sqm_distances_3200m) AS pos_200k_sqm_distance_m,
+    array_first(sport_distances_3200m) AS sport_distance_m,
+    array_first(pos_toilet_distances_3200m) AS pos_toilet_distance_m
 FROM {schema}.ind_os_distances_3200m;
 '''.format(points_id = points_id,schema=schema)    
 engine.execute(sql)
@@ -633,11 +498,11 @@ for nh_distance in [800,1600]:
     FROM {sample_point_feature} p 
     LEFT JOIN  
         -- get the distances and ids for all AOS with schools within 3200 m
-        (SELECT {points_id}, 
-                (obj->>'aos_id')::int AS aos_id, 
-                (obj->>'distance')::int AS distance 
-        FROM ind_point.od_aos_3200m_cl, 
-            jsonb_array_elements(attributes) obj) o  
+        (SELECT r.{points_id}, 
+                o.aos_id, 
+                o.distance 
+        FROM ind_point.od_aos_3200m_cl r, 
+            unnest(r.dest_ids, r.distances) o(aos_id, distance)) o  
     ON p.{points_id} = o.{points_id} 
     LEFT JOIN schools.aos_acara_naplan naplan ON o.aos_id = naplan.aos_id 
     WHERE naplan.acara_school_id IS NOT NULL 
@@ -665,13 +530,13 @@ SELECT p.{points_id},
 FROM {sample_point_feature} p 
 LEFT JOIN  
     -- get the distanc and id for closest AOS with school within 3200 m
-    (SELECT DISTINCT ON ({points_id})
-            {points_id}, 
-            (obj->>'aos_id')::int AS aos_id, 
-            (obj->>'distance')::int AS distance
-    FROM ind_point.od_aos_3200m_cl, 
-        jsonb_array_elements(attributes) obj
-    ORDER BY {points_id}, distance) o  
+    (SELECT DISTINCT ON (r.{points_id})
+            r.{points_id}, 
+            o.aos_id, 
+            o.distance
+    FROM ind_point.od_aos_3200m_cl r, 
+        unnest(r.dest_ids, r.distances) o(aos_id, distance)
+    ORDER BY r.{points_id}, o.distance) o  
 ON p.{points_id} = o.{points_id} 
 LEFT JOIN schools.aos_acara_naplan naplan ON o.aos_id = naplan.aos_id 
 WHERE naplan.acara_school_id IS NOT NULL 
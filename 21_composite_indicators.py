@@ -86,37 +86,24 @@ DROP TABLE IF EXISTS {schema}.{table};
 CREATE TABLE IF NOT EXISTS {schema}.{table} AS
 SELECT p.{points_id},
     (COALESCE(threshold_soft(nh_inds_distance.community_centre_hlc_2016_osm_2018, 1000),0) +
-    COALESCE(threshold_soft(LEAST(array_min("museum_osm".distances),array_min("art_gallery_osm".distances)), 3200),0) +
-    COALESCE(threshold_soft(LEAST(array_min("cinema_osm".distances),array_min("theatre_osm".distances)), 3200),0) +
-    COALESCE(threshold_soft(array_min("libraries_2018".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("childcare_oshc_meet_2019".distances), 1600),0) +
-    COALESCE(threshold_soft(array_min("childcare_all_meet_2019".distances), 800),0)  +
+    COALESCE(threshold_soft(LEAST(c."museum_osm",c."art_gallery_osm"), 3200),0) +
+    COALESCE(threshold_soft(LEAST(c."cinema_osm",c."theatre_osm"), 3200),0) +
+    COALESCE(threshold_soft(c."libraries_2018", 1000),0) +
+    COALESCE(threshold_soft(c."childcare_oshc_meet_2019", 1600),0) +
+    COALESCE(threshold_soft(c."childcare_all_meet_2019", 800),0)  +
     COALESCE(threshold_soft(nh_inds_distance.schools_primary_all_gov, 1600),0) +
     COALESCE(threshold_soft(nh_inds_distance.schools_secondary_all_gov, 1600),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_aged_care_residential".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_pharmacy".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_mc_family_health".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_other_community_health_care".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_dentist".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_gp".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("public_swimming_pool_osm".distances), 1200),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_aged_care_residential", 1000),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_pharmacy", 1000),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_mc_family_health", 1000),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_other_community_health_care", 1000),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_dentist", 1000),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_gp", 1000),0) +
+    COALESCE(threshold_soft(c."public_swimming_pool_osm", 1200),0) +
     COALESCE(threshold_soft(ind_os_distance.sport_distance_m, 1000),0)) AS si_mix
     FROM {points} p
     LEFT JOIN {schema}.nh_inds_distance ON p.{points_id} = {schema}.nh_inds_distance.{points_id}
-    LEFT JOIN d_3200m_cl."museum_osm" ON p.{points_id} = d_3200m_cl."museum_osm".{points_id}
-    LEFT JOIN d_3200m_cl."art_gallery_osm" ON p.{points_id} = d_3200m_cl."art_gallery_osm".{points_id}
-    LEFT JOIN d_3200m_cl."cinema_osm" ON p.{points_id} = d_3200m_cl."cinema_osm".{points_id}
-    LEFT JOIN d_3200m_cl."theatre_osm" ON p.{points_id} = d_3200m_cl."theatre_osm".{points_id}
-    LEFT JOIN d_3200m_cl."libraries_2018" ON p.{points_id} = d_3200m_cl."libraries_2018".{points_id}
-    LEFT JOIN d_3200m_cl."childcare_oshc_meet_2019" ON p.{points_id} = d_3200m_cl."childcare_oshc_meet_2019".{points_id}
-    LEFT JOIN d_3200m_cl."childcare_all_meet_2019" ON p.{points_id} = d_3200m_cl."childcare_all_meet_2019".{points_id}
-    LEFT JOIN d_3200m_cl."nhsd_2017_aged_care_residential" ON p.{points_id} = d_3200m_cl."nhsd_2017_aged_care_residential".{points_id}
-    LEFT JOIN d_3200m_cl."nhsd_2017_pharmacy" ON p.{points_id} = d_3200m_cl."nhsd_2017_pharmacy".{points_id}
-    LEFT JOIN d_3200m_cl."nhsd_2017_mc_family_health" ON p.{points_id} = d_3200m_cl."nhsd_2017_mc_family_health".{points_id}
-    LEFT JOIN d_3200m_cl."nhsd_2017_other_community_health_care" ON p.{points_id} = d_3200m_cl."nhsd_2017_other_community_health_care".{points_id}
-    LEFT JOIN d_3200m_cl."nhsd_2017_dentist" ON p.{points_id} = d_3200m_cl."nhsd_2017_dentist".{points_id}
-    LEFT JOIN d_3200m_cl."nhsd_2017_gp" ON p.{points_id} = d_3200m_cl."nhsd_2017_gp".{points_id}
-    LEFT JOIN d_3200m_cl."public_swimming_pool_osm" ON p.{points_id} = d_3200m_cl."public_swimming_pool_osm".{points_id}
+    LEFT JOIN d_3200m_cl.closest_distance c ON p.{points_id} = c.{points_id}
     LEFT JOIN {schema}.ind_os_distance ON p.{points_id} = {schema}.ind_os_distance.{points_id};
     CREATE UNIQUE INDEX IF NOT EXISTS {table}_idx ON  {schema}.{table} ({points_id});
 '''.format(points_id = points_id,
@@ -193,27 +180,27 @@ SELECT p.{points_id},
     COALESCE(sc_nh1600m,0) AS sc_nh1600m,
     COALESCE(dd_nh1600m,0) AS dd_nh1600m,
    (COALESCE(threshold_soft(nh_inds_distance.community_centre_hlc_2016_osm_2018, 1000),0) +
-    COALESCE(threshold_soft(LEAST(array_min("museum_osm".distances),array_min("art_gallery_osm".distances)), 3200),0) +
-    COALESCE(threshold_soft(LEAST(array_min("cinema_osm".distances),array_min("theatre_osm".distances)), 3200),0) +
-    COALESCE(threshold_soft(array_min("libraries_2018".distances), 1000),0))/4.0 AS community_culture_leisure ,
-   (COALESCE(threshold_soft(array_min("childcare_oshc_meet_2019".distances), 1600),0) +
-    COALESCE(threshold_soft(array_min("childcare_all_meet_2019".distances), 800),0))/2.0 AS early_years,
+    COALESCE(threshold_soft(LEAST(c."museum_osm",c."art_gallery_osm"), 3200),0) +
+    COALESCE(threshold_soft(LEAST(c."cinema_osm",c."theatre_osm"), 3200),0) +
+    COALESCE(threshold_soft(c."libraries_2018", 1000),0))/4.0 AS community_culture_leisure ,
+   (COALESCE(threshold_soft(c."childcare_oshc_meet_2019", 1600),0) +
+    COALESCE(threshold_soft(c."childcare_all_meet_2019", 800),0))/2.0 AS early_years,
    (COALESCE(threshold_soft(nh_inds_distance.schools_primary_all_gov, 1600),0) +
     COALESCE(threshold_soft(nh_inds_distance.schools_secondary_all_gov, 1600),0))/2.0 AS education ,
-   (COALESCE(threshold_soft(array_min("nhsd_2017_aged_care_residential".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_pharmacy".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_mc_family_health".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_other_community_health_care".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_dentist".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("nhsd_2017_gp".distances), 1000),0))/6.0 AS health_services ,
-   (COALESCE(threshold_soft(array_min("public_swimming_pool_osm".distances), 1200),0) +
+   (COALESCE(threshold_soft(c."nhsd_2017_aged_care_residential", 1000),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_pharmacy", 1000),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_mc_family_health", 1000),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_other_community_health_care", 1000),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_dentist", 1000),0) +
+    COALESCE(threshold_soft(c."nhsd_2017_gp", 1000),0))/6.0 AS health_services ,
+   (COALESCE(threshold_soft(c."public_swimming_pool_osm", 1200),0) +
     COALESCE(threshold_soft(ind_os_distance.sport_distance_m, 1000),0))/2.0 AS sport_rec,
-   (COALESCE(threshold_soft(array_min("fruit_veg_osm".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("meat_seafood_osm".distances), 3200),0) +
-    COALESCE(threshold_soft(array_min("supermarket_osm".distances), 1000),0))/3.0 AS food,    
-   (COALESCE(threshold_soft(array_min("convenience_osm".distances), 1000),0) +
-    COALESCE(threshold_soft(array_min("newsagent_osm".distances), 3200),0) +
-    COALESCE(threshold_soft(array_min("petrolstation_osm".distances), 1000),0))/3.0 AS convenience,         
+   (COALESCE(threshold_soft(c."fruit_veg_osm", 1000),0) +
+    COALESCE(threshold_soft(c."meat_seafood_osm", 3200),0) +
+    COALESCE(threshold_soft(c."supermarket_osm", 1000),0))/3.0 AS food,    
+   (COALESCE(threshold_soft(c."convenience_osm", 1000),0) +
+    COALESCE(threshold_soft(c."newsagent_osm", 3200),0) +
+    COALESCE(threshold_soft(c."petrolstation_osm", 1000),0))/3.0 AS convenience,         
     COALESCE(threshold_soft(nh_inds_distance.gtfs_20191008_20191205_pt_0020,400),0) AS pt_regular_400m,
     COALESCE(threshold_soft(ind_os_distance.pos_15k_sqm_distance_m,400),0) AS pos_large_400m,
     -- we coalesce 30:40 measures to 0, as nulls mean no one is in bottom two housing quintiles - really 0/0 implies 0% in this context
@@ -229,26 +216,7 @@ LEFT JOIN {schema}.sc_nh1600m ON p.{points_id} = {schema}.sc_nh1600m.{points_id}
 LEFT JOIN {schema}.dd_nh1600m ON p.{points_id} = {schema}.dd_nh1600m.{points_id}
 LEFT JOIN {schema}.ind_os_distance ON p.{points_id} = {schema}.ind_os_distance.{points_id}
 LEFT JOIN ind_sa1.abs_indicators abs ON a.sa1_7digitcode_2016 = abs.sa1_7digitcode_2016::text
-LEFT JOIN d_3200m_cl."fruit_veg_osm" ON p.{points_id} = d_3200m_cl."fruit_veg_osm".{points_id}
-LEFT JOIN d_3200m_cl."meat_seafood_osm" ON p.{points_id} = d_3200m_cl."meat_seafood_osm".{points_id}
-LEFT JOIN d_3200m_cl."supermarket_osm" ON p.{points_id} = d_3200m_cl."supermarket_osm".{points_id}
-LEFT JOIN d_3200m_cl."convenience_osm" ON p.{points_id} = d_3200m_cl."convenience_osm".{points_id}
-LEFT JOIN d_3200m_cl."newsagent_osm" ON p.{points_id} = d_3200m_cl."newsagent_osm".{points_id}
-LEFT JOIN d_3200m_cl."petrolstation_osm" ON p.{points_id} = d_3200m_cl."petrolstation_osm".{points_id}
-LEFT JOIN d_3200m_cl."museum_osm" ON p.{points_id} = d_3200m_cl."museum_osm".{points_id}
-LEFT JOIN d_3200m_cl."art_gallery_osm" ON p.{points_id} = d_3200m_cl."art_gallery_osm".{points_id}
-LEFT JOIN d_3200m_cl."cinema_osm" ON p.{points_id} = d_3200m_cl."cinema_osm".{points_id}
-LEFT JOIN d_3200m_cl."theatre_osm" ON p.{points_id} = d_3200m_cl."theatre_osm".{points_id}
-LEFT JOIN d_3200m_cl."libraries_2018" ON p.{points_id} = d_3200m_cl."libraries_2018".{points_id}
-LEFT JOIN d_3200m_cl."childcare_oshc_meet_2019" ON p.{points_id} = d_3200m_cl."childcare_oshc_meet_2019".{points_id}
-LEFT JOIN d_3200m_cl."childcare_all_meet_2019" ON p.{points_id} = d_3200m_cl."childcare_all_meet_2019".{points_id}
-LEFT JOIN d_3200m_cl."nhsd_2017_aged_care_residential" ON p.{points_id} = d_3200m_cl."nhsd_2017_aged_care_residential".{points_id}
-LEFT JOIN d_3200m_cl."nhsd_2017_pharmacy" ON p.{points_id} = d_3200m_cl."nhsd_2017_pharmacy".{points_id}
-LEFT JOIN d_3200m_cl."nhsd_2017_mc_family_health" ON p.{points_id} = d_3200m_cl."nhsd_2017_mc_family_health".{points_id}
-LEFT JOIN d_3200m_cl."nhsd_2017_other_community_health_care" ON p.{points_id} = d_3200m_cl."nhsd_2017_other_community_health_care".{points_id}
-LEFT JOIN d_3200m_cl."nhsd_2017_dentist" ON p.{points_id} = d_3200m_cl."nhsd_2017_dentist".{points_id}
-LEFT JOIN d_3200m_cl."nhsd_2017_gp" ON p.{points_id} = d_3200m_cl."nhsd_2017_gp".{points_id}
-LEFT JOIN d_3200m_cl."public_swimming_pool_osm" ON p.{points_id} = d_3200m_cl."public_swimming_pool_osm".{points_id}
+LEFT JOIN d_3200m_cl.closest_distance c ON p.{points_id} = c.{points_id}
 WHERE e.{points_id} IS NULL;
 CREATE UNIQUE INDEX IF NOT EXISTS ix_uli_inds ON  {schema}.uli_inds ({points_id});
 '''.format(points_id = points_id,points=points,schema=schema)
@@ -8,6 +8,7 @@ import psycopg2
 import numpy as np
 from sqlalchemy import create_engine
 
+import od_store
 from script_running_log import script_running_log
 
 # Import custom variables for National Liveability indicator process
@@ -139,9 +140,29 @@ SELECT DISTINCT(table_name)
 curs.execute(sql)
 dest_tables = [x[0] for x in curs.fetchall()]
 dest_tables = [x for x in dest_tables if x in df_destinations.query("unit_level_description!='NULL'").destination.values]
-destination_array_inds = ','.join(['d_3200m_cl."{dest}".distances AS "{dest}"'.format(dest = x) for x in dest_tables])
-destination_closest_inds = ','.join(['array_min(d_3200m_cl."{dest}".distances) AS "dist_m_{dest}"'.format(dest = x) for x in dest_tables])
-destination_from = '\n'.join(['LEFT JOIN d_3200m_cl."{dest}" ON p.{points_id} = d_3200m_cl."{dest}".{points_id}'.format(dest = x,points_id = points_id) for x in dest_tables])
+# Distances are read from the columnar OD store for destinations loaded there (see od_store.py),
+# and otherwise from the destination's table
+if od_columnar_store == 'yes':
+    stored_destinations = od_store.stored_destinations(engine, 'd_3200m_cl')
+else:
+    stored_destinations = []
+destination_source = dict([(x,'d_3200m_cl."{dest}"'.format(dest = x)) for x in dest_tables])
+for x in dest_tables:
+    if x in stored_destinations:
+        destination_source[x] = od_store.destination_sql(engine, 'd_3200m_cl', x, points_id)
+destination_array_inds = ','.join(['"{dest}".distances AS "{dest}"'.format(dest = x) for x in dest_tables])
+# Distance to closest is read from the closest_distance table (maintained by 13_od_distances_3200m_cl.py)
+# for destinations recorded there, and otherwise evaluated from the destination's distance arrays
+# (the first element, as these are recorded sorted in ascending order)
+closest_destinations = od_store.closest_distance_destinations(engine, 'd_3200m_cl')
+array_tables = [x for x in dest_tables if x not in closest_destinations]
+destination_closest_inds = ','.join(['c."{dest}" AS "dist_m_{dest}"'.format(dest = x) 
+                                     if x in closest_destinations else
+                                     'array_first("{dest}".distances) AS "dist_m_{dest}"'.format(dest = x) 
+                                     for x in dest_tables])
+destination_from = '\n'.join(['LEFT JOIN {source} "{dest}" ON p.{points_id} = "{dest}".{points_id}'.format(source = destination_source[x], dest = x,points_id = points_id) for x in array_tables])
+if len(closest_destinations) > 0:
+    destination_from = 'LEFT JOIN d_3200m_cl.closest_distance c ON p.{points_id} = c.{points_id}\n'.format(points_id = points_id) + destination_from
 
 print("Creating distance to closest measures with classification data..."),
 dest_closest_indicators = '''
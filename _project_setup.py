@@ -179,6 +179,70 @@ in_network_dataset_path = os.path.join(gdb_path,in_network_dataset)
 service_areas =  [int(x) for x in service_areas.split(',')]
 service_areas = sorted(set(service_areas +[distance]))
 
+# Routing engine used for network analyses
+#  - 'arcpy': ArcGIS Network Analyst, using the network dataset in the study region gdb
+#  - 'network': in-process routing over network.edges (see network_routing.py); no ArcGIS required
+# This may be defined as 'routing_engine' in the parameters worksheet (default is 'arcpy'),
+# and can be overridden for a particular run using an environment variable, e.g.
+#   set ROUTING_ENGINE=network
+#   python 13_od_distances_3200m_cl.py perth
+if globals().get('routing_engine','') == '':
+    routing_engine = 'arcpy'
+routing_engine = os.environ.get('ROUTING_ENGINE',routing_engine).lower()
+if routing_engine not in ['arcpy','network']:
+    sys.exit("The routing engine '{}' is not recognised; please specify either 'arcpy' or 'network'.".format(routing_engine))
+
+# OD search mode for the network routing engine
+#  - 'combined': one search per origin evaluates all destination types (default)
+#  - 'per_destination': a separate search per origin for each destination type
+if globals().get('od_search','') == '':
+    od_search = 'combined'
+
+# Dwelling density method (06_dwelling_density.py)
+#  - 'sql': a set-based spatial join of service areas and meshblocks in PostgreSQL, using parallel query (default)
+#  - 'shapely': an in-Python spatial join using an STRtree of meshblocks (requires shapely 2.0 or later)
+if globals().get('dwelling_density_method','') == '':
+    dwelling_density_method = 'sql'
+
+# Scheduling of polygons for parallel processing (see polygon_scheduler.py)
+#  - od_batch_points: polygons with more points than this are split into origin batches (0 to not split)
+#  - worker_max_tasks: worker processes are recycled after this many tasks, to cap memory use (0 to not recycle)
+if globals().get('od_batch_points','') == '':
+    od_batch_points = 5000
+if globals().get('worker_max_tasks','') == '':
+    worker_max_tasks = 50
+
+# Distributed processing of OD analyses (13, 14 and 16) using a work queue in the study region database
+# (see work_queue.py); when 'yes', any number of hosts may run the same script for a study region,
+# sharing its polygon tasks.  This can be overridden for a particular run using an environment variable, e.g.
+#   set OD_QUEUE=yes
+#   python 13_od_distances_3200m_cl.py perth
+#  - od_queue_lease: seconds for which a claimed task is leased to a worker, between heartbeats
+if globals().get('od_queue','') == '':
+    od_queue = 'no'
+od_queue = os.environ.get('OD_QUEUE',od_queue).lower()
+if globals().get('od_queue_lease','') == '':
+    od_queue_lease = 600
+
+# Columnar OD distance store (see od_store.py); when 'yes', distances recorded in the d_3200m_cl 
+# destination tables are also loaded to a single table partitioned by destination class, 
+# which indicator scripts read from in place of the destination tables
+if globals().get('od_columnar_store','') == '':
+    od_columnar_store = 'no'
+
+# Tiled parallel processing of the Areas of Open Space build (10_aos_setup.py; see tiled_sql.py)
+#  - aos_tile_size: width (in metres) of the square tiles to which open space features are assigned
+if globals().get('aos_tile_size','') == '':
+    aos_tile_size = 3200
+
+# Euclidean co-location of Areas of Open Space with destinations (15_aos_co-locations.py)
+#  - co_location_radii: comma separated distances (m) within which destinations are co-located with an AOS;
+#    a co_location_{radius}m field is recorded for each; 100m is always included, as co_location_100m
+#    is used for neighbourhood indicators (18_neighbourhood_indicators.py)
+if globals().get('co_location_radii','') == '':
+    co_location_radii = '100'
+co_location_radii = sorted(set([int(float(x)) for x in str(co_location_radii).split(',')] + [100]))
+
 # Island exceptions are defined using ABS constructs in the project configuration file.
 # They identify contexts where null indicator values are expected to be legitimate due to true network isolation, 
 # not connectivity errors. 
@@ -0,0 +1,88 @@
+# Script:  arcpy_closest.py
+# Purpose: Closest destination for points using ArcGIS Network Analyst (routing_engine = 'arcpy')
+#
+#          Points with no destination within the threshold of an OD analysis (13, 14 and 16)
+#          are evaluated for their closest destination (at any distance) by the main process,
+#          once all polygons are processed.  Using the arcpy routing engine, this is solved
+#          using an OD cost matrix layer finding one destination for each origin, over the
+#          network dataset used for distances within threshold, for chunks of the remaining
+#          points against all destinations of a type.
+#
+#          Results are returned in the same form as network_routing.closest_destinations(),
+#          which is used for the network routing engine.
+#
+#          Example usage:
+#            df = closest_destinations(engine, sample_point_feature, points_id, points_id_type,
+#                                      destination, destination_id, where = remaining)
+
+import arcpy
+import pandas
+
+def add_locations(layer, sub_layer, in_table, field, tolerance, network_edges, network_junctions):
+    arcpy.AddLocations_na(in_network_analysis_layer = layer,
+        sub_layer                      = sub_layer,
+        in_table                       = in_table,
+        field_mappings                 = "Name {} #".format(field),
+        search_tolerance               = "{} Meters".format(tolerance),
+        search_criteria                = "{} SHAPE;{} NONE".format(network_edges,network_junctions),
+        append                         = "CLEAR",
+        snap_to_position_along_network = "NO_SNAP",
+        exclude_restricted_elements    = "INCLUDE",
+        search_query                   = "{} #;{} #".format(network_edges,network_junctions))
+
+def closest_destinations(engine, points, points_id, points_id_type, destinations, dest_id, where,
+                         in_network_dataset, tolerance, network_edges, network_junctions, chunk_size = 5000):
+    '''
+    The closest destination for each point in a table meeting a condition, solved using an
+    OD cost matrix layer with ArcGIS Network Analyst.
+
+    input: points table (in the database, aliased as 'p', and the gdb workspace) and id,
+           destinations feature (in the gdb workspace) and id field, and a where clause
+           selecting the points to be evaluated
+    output: a data frame of points with fields id, dest_id and distance, for located points
+            from which a destination can be reached
+    '''
+    sql = '''SELECT p.{points_id} FROM {points} p WHERE {where};'''.format(points_id = points_id,
+                                                                          points = points,
+                                                                          where = where)
+    ids = [str(x[0]) for x in engine.execute(sql)]
+    records = []
+    if len(ids) == 0:
+        return pandas.DataFrame(data = records, columns = ['id','dest_id','distance'])
+    arcpy.CheckOutExtension('Network')
+    try:
+        result_object = arcpy.MakeODCostMatrixLayer_na(in_network_dataset = in_network_dataset,
+                                                       out_network_analysis_layer = "ClosestODmatrix",
+                                                       impedance_attribute = "Length",
+                                                       default_number_destinations_to_find = 1,
+                                                       UTurn_policy = "ALLOW_UTURNS",
+                                                       hierarchy = "NO_HIERARCHY",
+                                                       output_path_shape = "NO_LINES")
+        layer = result_object.getOutput(0)
+        sub_layers = arcpy.na.GetNAClassNames(layer)
+        lines_layer = arcpy.mapping.ListLayers(layer, sub_layers["ODLines"])[0]
+        arcpy.MakeFeatureLayer_management(points, "closest_points_layer")
+        arcpy.MakeFeatureLayer_management(destinations, "closest_destinations_layer")
+        add_locations(layer, sub_layers["Destinations"], "closest_destinations_layer", dest_id,
+                      tolerance, network_edges, network_junctions)
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            if 'int' in points_id_type:
+                values = ",".join(chunk)
+            else:
+                values = "'{}'".format("','".join(chunk))
+            origins = arcpy.SelectLayerByAttribute_management("closest_points_layer",
+                                                              where_clause = '''{} IN ({})'''.format(points_id, values))
+            add_locations(layer, sub_layers["Origins"], origins, points_id,
+                          tolerance, network_edges, network_junctions)
+            result = arcpy.Solve_na(layer, terminate_on_solve_error = "CONTINUE")
+            if result[1] == u'false':
+                continue
+            for name, distance in arcpy.da.SearchCursor(lines_layer, ['Name', 'Total_Length']):
+                origin, destination = [x.strip() for x in name.split(' - ')]
+                if 'int' in points_id_type:
+                    origin = int(origin)
+                records.append([origin, destination, distance])
+    finally:
+        arcpy.CheckInExtension('Network')
+    return pandas.DataFrame(data = records, columns = ['id','dest_id','distance'])
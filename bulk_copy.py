@@ -0,0 +1,87 @@
+# Script:  bulk_copy.py
+# Purpose: Streaming bulk loader for PostgreSQL using COPY ... FROM STDIN (FORMAT binary)
+#
+#          Rows are encoded in the PostgreSQL binary copy format and sent in batches,
+#          avoiding per row INSERT statements and commits (and the parsing of text
+#          representations, such as WKT geometries, by the server).  Geometries may be
+#          loaded as WKB to a bytea column, and converted using ST_GeomFromWKB in a
+#          subsequent set-based query.
+#
+#          Supported column types: text, bytea, int4, int8, float8 (None is loaded as NULL)
+#
+#          Example usage:
+#            writer = BinaryCopyWriter(curs, 'processing.staging', ['id','wkb'], ['text','bytea'])
+#            for row in rows:
+#                writer.write(row)
+#            writer.close()
+#            conn.commit()
+
+import io
+import struct
+
+header  = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+trailer = struct.pack('!h', -1)
+
+def encode_text(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return value
+
+encoders = {'text'  : encode_text,
+            'bytea' : lambda value: bytes(value),
+            'int4'  : lambda value: struct.pack('!i', value),
+            'int8'  : lambda value: struct.pack('!q', value),
+            'float8': lambda value: struct.pack('!d', value)}
+
+class BinaryCopyWriter(object):
+    '''
+    Stream rows to a PostgreSQL table using binary COPY, in batches of chunk_size rows.
+
+    input: psycopg2 cursor, table name, list of columns, and list of column types
+    '''
+    def __init__(self, curs, table, columns, types, chunk_size = 10000):
+        unsupported = [t for t in types if t not in encoders]
+        if len(unsupported) > 0:
+            raise ValueError('Unsupported column type(s) for binary copy: {}'.format(', '.join(unsupported)))
+        self.curs = curs
+        self.sql = 'COPY {table} ({columns}) FROM STDIN (FORMAT binary)'.format(table = table,
+                                                                                 columns = ','.join(columns))
+        self.encoders = [encoders[t] for t in types]
+        self.field_count = struct.pack('!h', len(columns))
+        self.chunk_size = chunk_size
+        self.count = 0
+        self._start()
+
+    def _start(self):
+        self.buffer = io.BytesIO()
+        self.buffer.write(header)
+        self.rows = 0
+
+    def write(self, row):
+        ''' Add a row (a sequence of values, in column order) '''
+        buffer = self.buffer
+        buffer.write(self.field_count)
+        for value, encode in zip(row, self.encoders):
+            if value is None:
+                buffer.write(struct.pack('!i', -1))
+            else:
+                value = encode(value)
+                buffer.write(struct.pack('!i', len(value)))
+                buffer.write(value)
+        self.rows += 1
+        self.count += 1
+        if self.rows == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        ''' Copy the current batch of rows to the database '''
+        if self.rows > 0:
+            self.buffer.write(trailer)
+            self.buffer.seek(0)
+            self.curs.copy_expert(self.sql, self.buffer)
+        self._start()
+
+    def close(self):
+        ''' Copy any remaining rows; returns the total number of rows written '''
+        self.flush()
+        return self.count
@@ -0,0 +1,146 @@
+# Script:  entry_points.py
+# Purpose: Generation of network entry points along feature outlines
+#
+#          Entry points are locations at a regular interval (e.g. every 20m) along the outline
+#          of a feature (e.g. the boundary of an area of open space, or an off road path) within
+#          some distance (e.g. 30m) of the pedestrian network.  Rather than interpolating points
+#          along the full length of every outline and discarding those not near the network, the
+#          outlines are first intersected with an indexed table of buffered network edges, and
+#          points are only interpolated within the fractions of each outline covered by these.
+#
+#          Entry points are numbered as they would be when interpolated along the full outline
+#          (ie. point k of an outline is at fraction k*interval/length), so the numbering of
+#          retained points is unchanged; outlines of a feature with several parts are numbered
+#          in turn (ordered by their position).
+#
+#          Each entry point is located on its closest network edge within the search distance
+#          (recording u, v, length, edge_offset and snap_distance, as for the snapping index of
+#          network_routing.py), and where several entry points of a feature are located at the
+#          same position on the network (to the nearest resolution metres) only the first is
+#          retained, as these are redundant for network analysis.
+#
+#          Example usage:
+#            curs.execute(entry_points_sql('open_space.aos_line', 'aos_id',
+#                                          'open_space.aos_nodes_30m_line', 'aos_entryid'))
+
+# margin (m) added to edge buffers, which approximate circular arcs using line segments and so
+# slightly underestimate the search distance; candidate points are then confirmed by distance
+buffer_margin = 0.5
+
+def entry_points_sql(source, id, output, entry_id, interval = 20, distance = 30, resolution = 1,
+                     network_schema = 'network', edges = 'edges'):
+    '''
+    SQL creating a table of entry points (id, node, entry_id, u, v, length, edge_offset,
+    snap_distance, geom) along the lines of a source table (id, geom), with a spatial index
+    '''
+    return '''
+    DROP TABLE IF EXISTS edge_buffers;
+    CREATE TEMP TABLE edge_buffers AS
+    SELECT ST_Buffer(geom, {buffer}) AS geom
+      FROM {network_schema}.{edges};
+    CREATE INDEX edge_buffers_gix ON edge_buffers USING GIST (geom);
+    ANALYZE edge_buffers;
+
+    DROP TABLE IF EXISTS {output};
+    CREATE TABLE {output} AS
+    WITH
+    parts AS
+    -- line parts of each feature, with the interval between points as a fraction of length
+    (SELECT {id},
+            ROW_NUMBER() OVER (PARTITION BY {id} ORDER BY ST_XMin(geom), ST_YMin(geom), ST_Length(geom)) AS part,
+            {interval}/ST_Length(geom)::numeric AS step,
+            geom
+       FROM (SELECT {id}, (ST_Dump(geom)).geom FROM {source}) s
+      WHERE ST_Length(geom) > 0),
+    lines AS
+    -- the last point of each part, and count of points along preceding parts of the feature
+    (SELECT {id},
+            part,
+            step,
+            last,
+            SUM(last + 1) OVER (PARTITION BY {id} ORDER BY part) - (last + 1) AS preceding,
+            geom
+       FROM (SELECT *, floor(1/step)::int AS last FROM parts) p),
+    pieces AS
+    -- fractions along each part at either end, and the middle, of its intersections with buffered edges
+    (SELECT l.{id},
+            l.part,
+            ST_IsClosed(l.geom) AS closed,
+            ST_LineLocatePoint(l.geom, COALESCE(ST_StartPoint(x.geom), x.geom)) AS f0,
+            ST_LineLocatePoint(l.geom, COALESCE(ST_EndPoint(x.geom), x.geom)) AS f1,
+            ST_LineLocatePoint(l.geom, CASE WHEN ST_Dimension(x.geom) = 1 
+                                            THEN ST_LineInterpolatePoint(x.geom, 0.5)
+                                            ELSE x.geom END) AS fm
+       FROM lines l
+       JOIN edge_buffers b ON ST_Intersects(l.geom, b.geom)
+      CROSS JOIN LATERAL ST_Dump(ST_Intersection(l.geom, b.geom)) x
+      WHERE ST_Dimension(x.geom) < 2),
+    near AS
+    -- on closed lines, a piece crosses the start point (and so covers the fractions from its
+    -- greater end to 1, and from 0 to its lesser end) if its middle lies outside the range of 
+    -- its ends; this is independent of the direction of the piece, and of whether an end 
+    -- at the start point is located at 0 (rather than 1)
+    (SELECT {id},
+            part,
+            LEAST(f0, f1) AS lo,
+            GREATEST(f0, f1) AS hi,
+            closed AND fm NOT BETWEEN LEAST(f0, f1) AND GREATEST(f0, f1) AS wraps
+       FROM pieces),
+    ranges AS
+    (SELECT {id}, part, lo, hi FROM near WHERE NOT wraps
+     UNION ALL
+     SELECT {id}, part, 0, lo FROM near WHERE wraps
+     UNION ALL
+     SELECT {id}, part, hi, 1 FROM near WHERE wraps),
+    positions AS
+    -- positions of points along each part within these ranges
+    (SELECT DISTINCT
+            r.{id},
+            r.part,
+            k
+       FROM ranges r
+       JOIN lines l USING ({id}, part)
+      CROSS JOIN LATERAL generate_series(ceil(r.lo::numeric/l.step)::int, LEAST(floor(r.hi::numeric/l.step)::int, l.last)) k),
+    candidates AS
+    (SELECT l.{id},
+            l.preceding + p.k + 1 AS node,
+            ST_LineInterpolatePoint(l.geom, LEAST(p.k * l.step, 1)::float) AS geom
+       FROM positions p
+       JOIN lines l USING ({id}, part))
+    SELECT DISTINCT ON (c.{id}, e.u, e.v, round(e.edge_offset/{resolution}))
+           c.{id},
+           c.node,
+           c.{id}::text || ',' || c.node::text AS {entry_id},
+           e.u,
+           e.v,
+           e.length,
+           e.edge_offset,
+           e.snap_distance,
+           c.geom
+      FROM candidates c
+     CROSS JOIN LATERAL
+           (SELECT u,
+                   v,
+                   ST_Length(geom) AS length,
+                   ST_Length(geom) * ST_LineLocatePoint(geom, c.geom) AS edge_offset,
+                   ST_Distance(geom, c.geom) AS snap_distance
+              FROM {network_schema}.{edges} e
+             WHERE ST_DWithin(e.geom, c.geom, {distance})
+             ORDER BY e.geom <-> c.geom
+             LIMIT 1) e
+     ORDER BY c.{id}, e.u, e.v, round(e.edge_offset/{resolution}), c.node;
+
+    CREATE INDEX {index}_gix ON {output} USING GIST (geom);
+    CREATE UNIQUE INDEX {index}_idx ON {output} ({entry_id});
+    DROP TABLE edge_buffers;
+    '''.format(source = source,
+               id = id,
+               output = output,
+               entry_id = entry_id,
+               interval = interval,
+               distance = distance,
+               buffer = distance + buffer_margin,
+               resolution = resolution,
+               index = output.split('.')[-1],
+               network_schema = network_schema,
+               edges = edges)
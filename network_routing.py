@@ -0,0 +1,631 @@
+# Script:  network_routing.py
+# Purpose: In-process routing over the study region pedestrian network
+#          (network.edges, as loaded by 01_study_region_setup.py), as an
+#          alternative to ArcGIS Network Analyst for OD analyses.
+#
+#          - the network is held as a compressed sparse row (CSR) graph of
+#            NumPy arrays, with projected edge length (metres) as impedance
+#          - origins and destinations are located on their closest network edge
+#            within the search tolerance, and recorded as an offset along that edge;
+#            locations are recorded once in a persistent snapping index for each
+#            point table, which is rebuilt only when the network or points change
+#          - distances are evaluated using a bounded multi-source Dijkstra search
+#            (an origin seeds both ends of its edge with the respective offsets)
+#          - the closest destination for many points may be evaluated using a single
+#            region-wide reverse search from all destinations, which labels every
+#            node with its nearest destination
+#
+#          Edges are traversable in both directions, consistent with the
+#          pedestrian network dataset used with arcpy (ALLOW_UTURNS, no hierarchy).
+#          As for arcpy with NO_SNAP, the distance from a point to the network
+#          (snap distance) is not included in network distances.
+#
+#          The searches are run in Python (heapq) over list copies of the CSR arrays, 
+#          rather than vectorised: searches from each origin are bounded, and terminate 
+#          early once the cutoff (or closest destination) is reached, and the reverse 
+#          search propagates destination ids as well as distances.  SciPy (whose 
+#          csgraph.dijkstra supports limit and min_only) is not a dependency of the project.
+#
+#          The module does not depend on arcpy, and may be run on Linux.
+#          Example usage on a small network is given when run as a script:
+#            python network_routing.py
+#          and tests, on small hand-built networks, are in tests/test_network_routing.py:
+#            python -m pytest tests
+
+import hashlib
+import heapq
+import re
+import numpy as np
+import pandas
+
+inf = float('inf')
+
+class Network(object):
+    '''
+    Pedestrian network as a compressed sparse row (CSR) graph.
+
+    Nodes are indexed 0..n-1 in the order of their sorted source ids (e.g. OSM node ids);
+    the neighbours of node i are indices[indptr[i]:indptr[i+1]], with edge lengths in the
+    corresponding positions of weights.  The source edge id of each of these, and whether it is
+    traversed in the direction of the source edge geometry (from u to v), are in edges and forward.
+    '''
+    def __init__(self, node_ids, indptr, indices, weights, edges, forward):
+        self.node_ids = node_ids
+        self.indptr   = indptr
+        self.indices  = indices
+        self.weights  = weights
+        self.edges    = edges
+        self.forward  = forward
+        # plain lists are faster than NumPy scalars for element-wise access in the search loop
+        self._indptr  = indptr.tolist()
+        self._indices = indices.tolist()
+        self._weights = weights.tolist()
+        self._edges   = edges.tolist()
+        self._forward = forward.tolist()
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def node_index(self, ids):
+        ''' Return the graph indices for an array of source node ids '''
+        index = np.searchsorted(self.node_ids, ids)
+        index[index == len(self.node_ids)] = 0
+        if not (self.node_ids[index] == ids).all():
+            raise ValueError('Some node ids are not present in the network.')
+        return index
+
+def network_from_edges(u, v, length, edge_ids = None):
+    '''
+    Build a CSR network from arrays of edge end node ids and edge lengths, and optionally
+    edge ids (by default, edges are identified by their position in the arrays).
+    Each edge is added in both directions.
+    '''
+    u = np.asarray(u)
+    v = np.asarray(v)
+    length = np.asarray(length, dtype = np.float64)
+    n_edges = len(u)
+    if edge_ids is None:
+        edge_ids = np.arange(n_edges)
+    edge_ids = np.asarray(edge_ids)
+    node_ids, index = np.unique(np.concatenate([u, v]), return_inverse = True)
+    tails   = np.concatenate([index[:n_edges], index[n_edges:]])
+    heads   = np.concatenate([index[n_edges:], index[:n_edges]])
+    weights = np.concatenate([length, length])
+    edges   = np.concatenate([edge_ids, edge_ids])
+    forward = np.concatenate([np.ones(n_edges, dtype = bool), np.zeros(n_edges, dtype = bool)])
+    order   = np.argsort(tails, kind = 'mergesort')
+    indptr  = np.zeros(len(node_ids) + 1, dtype = np.int64)
+    np.cumsum(np.bincount(tails, minlength = len(node_ids)), out = indptr[1:])
+    return Network(node_ids, indptr, heads[order], weights[order], edges[order], forward[order])
+
+def load_network(engine, network_schema = 'network', edges = 'edges', edge_id = None):
+    '''
+    Load the study region pedestrian network from PostgreSQL as a CSR network
+    (with edges identified by the edge_id field, if specified)
+    '''
+    if edge_id is None:
+        edge_id = 'NULL'
+    sql = '''
+    SELECT u,
+           v,
+           ST_Length(geom) AS length,
+           {edge_id} AS edge_id
+      FROM {network_schema}.{edges};
+    '''.format(network_schema = network_schema,
+               edges = edges,
+               edge_id = edge_id)
+    df = pandas.read_sql(sql, engine)
+    if edge_id == 'NULL':
+        return network_from_edges(df.u.values, df.v.values, df.length.values)
+    return network_from_edges(df.u.values, df.v.values, df.length.values, df.edge_id.values)
+
+def snap_sql(table, id, tolerance = 500, network_schema = 'network', edges = 'edges'):
+    '''
+    SQL query locating each point in a table (aliased as 'p') on its closest network edge within the
+    search tolerance, using the spatial index of the network edges
+    '''
+    return '''
+    SELECT p.{id} AS id,
+           e.u,
+           e.v,
+           e.length,
+           e.length * ST_LineLocatePoint(e.geom, p.geom) AS edge_offset,
+           ST_Distance(e.geom, p.geom) AS snap_distance
+      FROM {table} p
+     CROSS JOIN LATERAL
+           (SELECT u,
+                   v,
+                   ST_Length(geom) AS length,
+                   geom
+              FROM {network_schema}.{edges} e
+             WHERE ST_DWithin(e.geom, p.geom, {tolerance})
+             ORDER BY e.geom <-> p.geom
+             LIMIT 1) e
+    '''.format(id = id,
+               table = table,
+               network_schema = network_schema,
+               edges = edges,
+               tolerance = tolerance)
+
+def snap_hashes(engine, table, id, network_schema = 'network', edges = 'edges'):
+    '''
+    Hashes of the network edges and of a point table's ids and geometries, used to
+    identify when a persistent snapping index must be rebuilt
+    '''
+    sql = '''
+    SELECT (SELECT md5(string_agg(h, '' ORDER BY h))
+              FROM (SELECT md5(concat_ws(',', u, v, ST_AsEWKB(geom))) AS h
+                      FROM {network_schema}.{edges}) e) AS network_hash,
+           (SELECT md5(string_agg(h, '' ORDER BY h))
+              FROM (SELECT md5(concat_ws(',', {id}, ST_AsEWKB(geom))) AS h
+                      FROM {table}) p) AS points_hash;
+    '''.format(id = id,
+               table = table,
+               network_schema = network_schema,
+               edges = edges)
+    return tuple(engine.execute(sql).fetchone())
+
+def snap_table_name(source):
+    '''
+    Name of the snapping index table for a source ('table.id'): a readable prefix of the source,
+    and a hash of the full source, so that sources whose names share a long prefix are not confused
+    (the name is kept short enough that it, and that of its index, fit PostgreSQL's 63 character limit)
+    '''
+    slug = re.sub('[^a-z0-9]+', '_', source.lower()).strip('_')[:45].strip('_')
+    return 'snap_{}_{}'.format(slug, hashlib.md5(source.encode('utf-8')).hexdigest()[:8])
+
+def snap_index(engine, table, id, tolerance = 500, network_schema = 'network', edges = 'edges', rebuild = False):
+    '''
+    Persistent snapping index for a point table: the closest network edge of each point,
+    its offset along the edge and snap distance are recorded once in a table in the network schema,
+    and registered in {network_schema}.snap_index with hashes of the network and points.
+
+    The index is rebuilt only if the network, points or tolerance have changed since it was recorded
+    (or if rebuild is True); this should be checked once per run in the main process, prior to
+    parallel processing, as the hashes are evaluated over the full network and point table.
+    The registry is checked and the index built while holding an advisory lock for the source,
+    so that processes (or hosts) checking the same index concurrently build it only once.
+
+    output: name of the snapping index table (in the network schema)
+    '''
+    source = '{}.{}'.format(table, id)
+    snap_table = snap_table_name(source)
+    sql = '''
+    CREATE TABLE IF NOT EXISTS {network_schema}.snap_index
+    (source text PRIMARY KEY,
+     snap_table text NOT NULL,
+     tolerance double precision NOT NULL,
+     network_hash text,
+     points_hash text,
+     created timestamp DEFAULT now()
+    );
+    '''.format(network_schema = network_schema)
+    engine.execute(sql)
+    network_hash, points_hash = snap_hashes(engine, table, id, network_schema, edges)
+    with engine.begin() as connection:
+        connection.execute('''SELECT pg_advisory_xact_lock(hashtext(%(source)s));''', {'source':'snap_index:{}'.format(source)})
+        sql = '''
+        SELECT source
+          FROM {network_schema}.snap_index
+         WHERE snap_table = %(snap_table)s
+           AND source != %(source)s;
+        '''.format(network_schema = network_schema)
+        other = connection.execute(sql, {'source':source, 'snap_table':snap_table}).fetchone()
+        if other is not None:
+            raise ValueError("Snapping index table {}.{} for {} is registered for {}; please drop it and re-run.".format(network_schema, snap_table, source, other[0]))
+        sql = '''
+        SELECT snap_table, tolerance, network_hash, points_hash
+          FROM {network_schema}.snap_index
+         WHERE source = %(source)s;
+        '''.format(network_schema = network_schema)
+        registered = connection.execute(sql, {'source':source}).fetchone()
+        if not rebuild and registered is not None and tuple(registered) == (snap_table, tolerance, network_hash, points_hash):
+            return snap_table
+        sql = '''
+        DROP TABLE IF EXISTS {network_schema}.{snap_table};
+        CREATE TABLE {network_schema}.{snap_table} AS {snap_sql};
+        CREATE INDEX {snap_table}_idx ON {network_schema}.{snap_table} (id);
+        INSERT INTO {network_schema}.snap_index (source, snap_table, tolerance, network_hash, points_hash)
+        VALUES (%(source)s, %(snap_table)s, %(tolerance)s, %(network_hash)s, %(points_hash)s)
+        ON CONFLICT (source) DO UPDATE
+           SET snap_table   = EXCLUDED.snap_table,
+               tolerance    = EXCLUDED.tolerance,
+               network_hash = EXCLUDED.network_hash,
+               points_hash  = EXCLUDED.points_hash,
+               created      = now();
+        '''.format(network_schema = network_schema,
+                   snap_table = snap_table,
+                   snap_sql = snap_sql(table, id, tolerance, network_schema, edges))
+        if registered is not None and registered[0] != snap_table:
+            # an index recorded under a previous naming scheme is replaced
+            sql = '''DROP TABLE IF EXISTS {network_schema}.{previous};'''.format(network_schema = network_schema,
+                                                                                      previous = registered[0]) + sql
+        connection.execute(sql, {'source':source,
+                                 'snap_table':snap_table,
+                                 'tolerance':tolerance,
+                                 'network_hash':network_hash,
+                                 'points_hash':points_hash})
+    return snap_table
+
+def locate(engine, network, table, id, where = '', tolerance = 500, network_schema = 'network', edges = 'edges'):
+    '''
+    Locate points on their closest network edge within the search tolerance.
+
+    Locations are read from the point table's persistent snapping index, which must have been 
+    built for this table and tolerance using snap_index (in the main process, prior to parallel 
+    processing); it is not built here, as worker processes would otherwise race to build it.
+
+    input: a point table (aliased as 'p', to which an optional where clause may refer) and its id field
+    output: a data frame of located points with fields
+              id, u, v (graph indices of the edge end nodes),
+              length (of edge), edge_offset (distance along edge from u), snap_distance
+            Points further than the search tolerance from the network are not returned.
+    '''
+    sql = '''
+    SELECT snap_table
+      FROM {network_schema}.snap_index
+     WHERE source = %(source)s
+       AND tolerance = %(tolerance)s;
+    '''.format(network_schema = network_schema)
+    source = '{}.{}'.format(table, id)
+    if engine.has_table('snap_index', schema = network_schema):
+        registered = engine.execute(sql, {'source':source, 'tolerance':tolerance}).fetchone()
+    else:
+        registered = None
+    if registered is None:
+        raise ValueError("No snapping index is registered for {} (tolerance {}); please run snap_index() for this table before locating points.".format(source, tolerance))
+    snap_table = registered[0]
+    if where != '':
+        where = 'WHERE s.id IN (SELECT p.{id} FROM {table} p WHERE {where})'.format(id = id,
+                                                                                  table = table,
+                                                                                  where = where)
+    sql = '''
+    SELECT s.id,
+           s.u,
+           s.v,
+           s.length,
+           s.edge_offset,
+           s.snap_distance
+      FROM {network_schema}.{snap_table} s
+     {where};
+    '''.format(network_schema = network_schema,
+               snap_table = snap_table,
+               where = where)
+    df = pandas.read_sql(sql, engine)
+    df['u'] = network.node_index(df.u.values)
+    df['v'] = network.node_index(df.v.values)
+    return df
+
+def edge_key(u, v, length, edge_offset):
+    '''
+    Direction independent key for an edge, and the location's position along it
+    (length is included in the key to distinguish parallel edges)
+    '''
+    if u <= v:
+        return (u, v, round(length, 3)), edge_offset
+    return (v, u, round(length, 3)), length - edge_offset
+
+class LocationIndex(object):
+    '''
+    Index of located destinations by the network nodes at either end of their edges,
+    with the additional distance from each node to the destination; destinations
+    are also indexed by edge, to evaluate origins and destinations sharing an edge.
+
+    Destinations of several types may be held in the one index, so that a single search
+    from an origin evaluates all of them; if a label (e.g. the destination type) is given
+    when adding locations, destinations are identified as (label, id).
+    '''
+    def __init__(self, locations = None, label = None):
+        self.nodes = {}
+        self.edges = {}
+        if locations is not None:
+            self.add(locations, label)
+
+    def add(self, locations, label = None):
+        ''' Add located destinations to the index '''
+        for row in locations[['id','u','v','length','edge_offset']].itertuples(index = False):
+            id, u, v, length, edge_offset = row
+            u, v = int(u), int(v)
+            if label is not None:
+                id = (label, id)
+            self.nodes.setdefault(u, []).append((id, edge_offset))
+            self.nodes.setdefault(v, []).append((id, length - edge_offset))
+            key, position = edge_key(u, v, length, edge_offset)
+            self.edges.setdefault(key, []).append((id, position))
+
+    def add_targets(self, locations, label = None):
+        '''
+        Add located destinations sharing an id (e.g. the entry points of a park) as a single
+        multi-source target: each network node is recorded once for each target, with the least
+        additional distance to any of its locations, so that searches evaluate the distance to
+        the closest location of each target directly
+        '''
+        ends = pandas.concat([pandas.DataFrame({'id':locations.id.values,
+                                                'node':locations.u.values.astype(int),
+                                                'extra':locations.edge_offset.values}),
+                              pandas.DataFrame({'id':locations.id.values,
+                                                'node':locations.v.values.astype(int),
+                                                'extra':(locations.length - locations.edge_offset).values})])
+        ends = ends.groupby(['node','id'], sort = False)['extra'].min().reset_index()
+        for node, id, extra in ends[['node','id','extra']].itertuples(index = False):
+            if label is not None:
+                id = (label, id)
+            self.nodes.setdefault(int(node), []).append((id, extra))
+        # locations on the same edge as an origin are evaluated directly
+        for row in locations[['id','u','v','length','edge_offset']].drop_duplicates().itertuples(index = False):
+            id, u, v, length, edge_offset = row
+            if label is not None:
+                id = (label, id)
+            key, position = edge_key(int(u), int(v), length, edge_offset)
+            self.edges.setdefault(key, []).append((id, position))
+
+    def __len__(self):
+        return len(self.nodes)
+
+def distances_by_label(result):
+    '''
+    Group distances to labelled destinations, as returned by reachable() for an index
+    of destinations of several types, into sorted lists of distances for each label
+    '''
+    grouped = {}
+    for (label, id), d in result.items():
+        grouped.setdefault(label, []).append(d)
+    for label in grouped:
+        grouped[label].sort()
+    return grouped
+
+def origin_seeds(origin):
+    ''' Search seeds (node, initial distance) for a located origin '''
+    return [(int(origin.u), origin.edge_offset),
+            (int(origin.v), origin.length - origin.edge_offset)]
+
+def search(network, seeds, cutoff = None, visit = None):
+    '''
+    Bounded multi-source Dijkstra search.
+
+    input:  seeds  -- iterable of (node, initial distance)
+            cutoff -- maximum distance to search (optional)
+            visit  -- function called as visit(node, distance) when each node is settled
+                      (optional); if it returns a number, the cutoff is tightened to this.
+    output: dictionary of settled nodes and their network distance
+    '''
+    indptr  = network._indptr
+    indices = network._indices
+    weights = network._weights
+    if cutoff is None:
+        cutoff = inf
+    settled = {}
+    heap = [(d, node) for node, d in seeds if d <= cutoff]
+    heapq.heapify(heap)
+    while heap:
+        d, node = heapq.heappop(heap)
+        if d > cutoff:
+            break
+        if node in settled:
+            continue
+        settled[node] = d
+        if visit is not None:
+            tightened = visit(node, d)
+            if tightened is not None and tightened < cutoff:
+                cutoff = tightened
+        for i in range(indptr[node], indptr[node + 1]):
+            next_node = indices[i]
+            if next_node not in settled:
+                next_d = d + weights[i]
+                if next_d <= cutoff:
+                    heapq.heappush(heap, (next_d, next_node))
+    return settled
+
+def reachable(settled, origin, destinations, cutoff = inf):
+    '''
+    Distances to destinations from the settled nodes of a search from an origin
+
+    output: dictionary of destination ids and distances within cutoff
+    '''
+    result = {}
+    # iterate over the smaller of the searched neighbourhood and the destination nodes
+    if len(settled) <= len(destinations.nodes):
+        candidates = ((d, destinations.nodes[node]) for node, d in settled.items() if node in destinations.nodes)
+    else:
+        candidates = ((settled[node], dests) for node, dests in destinations.nodes.items() if node in settled)
+    for d, dests in candidates:
+        for id, extra in dests:
+            total = d + extra
+            if total <= cutoff and total < result.get(id, inf):
+                result[id] = total
+    # destinations on the origin's own edge may be reached directly
+    key, position = edge_key(int(origin.u), int(origin.v), origin.length, origin.edge_offset)
+    for id, dest_position in destinations.edges.get(key, []):
+        total = abs(position - dest_position)
+        if total <= cutoff and total < result.get(id, inf):
+            result[id] = total
+    return result
+
+def distances_within(network, origin, destinations, cutoff):
+    ''' Distances to all destinations within cutoff network distance of a located origin '''
+    settled = search(network, origin_seeds(origin), cutoff)
+    return reachable(settled, origin, destinations, cutoff)
+
+def closest(network, origin, destinations):
+    '''
+    The closest destination to a located origin, with no distance limit.
+
+    The search terminates once no unsettled node could be closer than
+    the best destination found.
+
+    output: tuple of (destination id, distance), or (None, inf) if no destination can be reached
+    '''
+    best = [None, inf]
+    key, position = edge_key(int(origin.u), int(origin.v), origin.length, origin.edge_offset)
+    for id, dest_position in destinations.edges.get(key, []):
+        if abs(position - dest_position) < best[1]:
+            best[:] = [id, abs(position - dest_position)]
+    def visit(node, d):
+        for id, extra in destinations.nodes.get(node, []):
+            if d + extra < best[1]:
+                best[:] = [id, d + extra]
+        return best[1]
+    search(network, origin_seeds(origin), best[1], visit)
+    return tuple(best)
+
+def service_area(network, origin, cutoff, settled = None):
+    '''
+    Edges reachable from a located origin within the cutoff distance, with the network distance
+    to each of their end nodes.  The fragment of each edge reachable within any smaller distance
+    (e.g. for service areas with several break distances) may be derived from these, so that
+    only one search is required from each origin for all break distances.  The settled nodes of
+    an existing search from the origin (bounded at the cutoff) may be supplied, so that these 
+    may also be used for other purposes (e.g. evaluating destinations with reachable()).
+
+    output: list of (edge id, distance to u, distance to v, origin offset), where the distance to
+            an end node not reached within the cutoff is None; the edge on which the origin is
+            located is included with its offset along the edge (from u), and None distances, 
+            as it may be traversed directly from the origin in both directions
+    '''
+    indptr  = network._indptr
+    edges   = network._edges
+    forward = network._forward
+    if settled is None:
+        settled = search(network, origin_seeds(origin), cutoff)
+    reached = {}
+    for node, d in settled.items():
+        for i in range(indptr[node], indptr[node + 1]):
+            distances = reached.setdefault(edges[i], [None, None])
+            if forward[i]:
+                distances[0] = d
+            else:
+                distances[1] = d
+    result = [(edge, d[0], d[1], None) for edge, d in reached.items()]
+    # the origin's own edge (a parallel edge of equal length is equivalent)
+    u, v = int(origin.u), int(origin.v)
+    for i in range(indptr[u], indptr[u + 1]):
+        if network._indices[i] == v and forward[i] and abs(network._weights[i] - origin.length) < 0.001:
+            result.append((edges[i], None, None, origin.edge_offset))
+            break
+    return result
+
+def label_nearest(network, destinations):
+    '''
+    Region-wide reverse search: a single multi-source Dijkstra search seeded from all
+    destinations in the index labels every network node with the distance to, and id of,
+    its nearest destination.
+
+    output: tuple of (array of distances, with inf for nodes from which no destination can be reached,
+                      list of nearest destination ids, with None for such nodes)
+    '''
+    indptr  = network._indptr
+    indices = network._indices
+    weights = network._weights
+    distance = [inf] * len(network)
+    nearest  = [None] * len(network)
+    settled  = [False] * len(network)
+    heap = []
+    for node, dests in destinations.nodes.items():
+        for id, extra in dests:
+            if extra < distance[node]:
+                distance[node] = extra
+                heap.append((extra, node, id))
+    heapq.heapify(heap)
+    while heap:
+        d, node, id = heapq.heappop(heap)
+        if settled[node]:
+            continue
+        settled[node] = True
+        nearest[node] = id
+        for i in range(indptr[node], indptr[node + 1]):
+            next_node = indices[i]
+            next_d = d + weights[i]
+            if next_d < distance[next_node]:
+                distance[next_node] = next_d
+                heapq.heappush(heap, (next_d, next_node, id))
+    return np.array(distance), nearest
+
+def closest_labelled(labels, origin, destinations):
+    '''
+    The closest destination to a located origin, read from the nearest destination
+    labels of its edge's end nodes (see label_nearest)
+
+    output: tuple of (destination id, distance), or (None, inf) if no destination can be reached
+    '''
+    distance, nearest = labels
+    u, v = int(origin.u), int(origin.v)
+    best = min([(distance[u] + origin.edge_offset, u),
+                (distance[v] + origin.length - origin.edge_offset, v)])
+    best = [nearest[best[1]], float(best[0])]
+    key, position = edge_key(u, v, origin.length, origin.edge_offset)
+    for id, dest_position in destinations.edges.get(key, []):
+        if abs(position - dest_position) < best[1]:
+            best = [id, abs(position - dest_position)]
+    if best[1] == inf:
+        return (None, inf)
+    return tuple(best)
+
+def closest_destinations(engine, network, destinations, table, id, where = '', tolerance = 500, network_schema = 'network', edges = 'edges'):
+    '''
+    The closest destination for each point in a table, using a single region-wide reverse search
+    (rather than a search from each point); this is suited to evaluating the closest destination
+    for large numbers of points, such as those with no destination within some distance.
+
+    input: destinations (LocationIndex), and point table, id and optional where clause as per locate()
+    output: a data frame of points with fields id, dest_id and distance, for located points
+            from which a destination can be reached
+    '''
+    records = []
+    origins = locate(engine, network, table, id, where, tolerance, network_schema, edges)
+    if len(origins) > 0 and len(destinations) > 0:
+        labels = label_nearest(network, destinations)
+        for origin in origins.itertuples():
+            dest_id, distance = closest_labelled(labels, origin, destinations)
+            if dest_id is not None:
+                records.append([origin.id, dest_id, distance])
+    return pandas.DataFrame(data = records, columns = ['id','dest_id','distance'])
+
+if __name__ == '__main__':
+    print("Example usage of network routing functions")
+    # a small network:  a square of 100m edges (nodes 1-4), with a 300m spur to node 5
+    #
+    #   1 ---- 2 ---------- 5
+    #   |      |
+    #   4 ---- 3
+    network = network_from_edges(u      = [1, 2, 3, 4, 2],
+                                 v      = [2, 3, 4, 1, 5],
+                                 length = [100, 100, 100, 100, 300])
+    # an origin 25m along edge 1-2, and destinations at node 3, and 50m from node 5 along the spur
+    origin = pandas.DataFrame({'id':['origin'],'u':[1],'v':[2],'length':[100.0],'edge_offset':[25.0]})
+    dests  = pandas.DataFrame({'id':['a','b'],'u':[3,2],'v':[4,5],'length':[100.0,300.0],'edge_offset':[0.0,250.0]})
+    for df in [origin, dests]:
+        df['u'] = network.node_index(df.u.values)
+        df['v'] = network.node_index(df.v.values)
+    destinations = LocationIndex(dests)
+    origin = next(origin.itertuples())
+    print('''
+    distances_within(network, origin, destinations, 400)
+    {}
+    '''.format(sorted(distances_within(network, origin, destinations, 400).items())))
+    print('''
+    distances_within(network, origin, destinations, 100)
+    {}
+    '''.format(sorted(distances_within(network, origin, destinations, 100).items())))
+    print('''
+    closest(network, origin, destinations)
+    {}
+    '''.format(closest(network, origin, destinations)))
+    labels = label_nearest(network, destinations)
+    print('''
+    closest_labelled(label_nearest(network, destinations), origin, destinations)
+    {}
+    '''.format(closest_labelled(labels, origin, destinations)))
+    # destinations of several types may be evaluated using a single search from the origin
+    all_destinations = LocationIndex()
+    all_destinations.add(dests.iloc[[0]], label = 'type_1')
+    all_destinations.add(dests, label = 'type_2')
+    settled = search(network, origin_seeds(origin), 400)
+    print('''
+    distances_by_label(reachable(settled, origin, all_destinations, 400))
+    {}
+    '''.format(sorted(distances_by_label(reachable(settled, origin, all_destinations, 400)).items())))
+    # reachable edges (by position in the edge arrays) for service areas of up to 150m
+    print('''
+    service_area(network, origin, 150)
+    {}
+    '''.format(sorted(service_area(network, origin, 150), key = lambda x: (x[0], x[3] is not None))))
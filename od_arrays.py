@@ -0,0 +1,101 @@
+# Script:  od_arrays.py
+# Purpose: Typed array storage of OD results with destination attributes
+#
+#          Results of OD analyses for which the identity of destinations is retained
+#          (ie. od_aos_3200m_cl, recorded by 16_od_aos.py, and od_pt_800m_cl_<destination>,
+#          recorded by 14_od_pt_800m_cl.py) are stored with a row for each origin point,
+#          with parallel arrays of destination ids and distances, sorted by distance:
+#            ({points_id}, dest_ids int[], distances int[])
+#          Points with no destination located are recorded with empty arrays.
+#
+#          These are read as a long (point, destination, distance) relation using
+#            FROM <table> r, unnest(r.dest_ids, r.distances) o(dest_id, distance)
+#          in place of decoding JSONB lists of {dest_id, distance} records.
+#
+#          Distances are stored as int rather than smallint, as distances to closest
+#          destination recorded for points with none within threshold may be long.
+#
+#          Tables in the previous JSONB layout (an attributes column) are converted in
+#          place by migrate(), which is run by the scripts reading and writing these tables.
+
+import numpy
+import pandas
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.types import Integer
+
+def create_table(engine, schema, table, points_id, points_id_type):
+    ''' Create a result table in the array layout (if not exists) '''
+    sql = '''
+    CREATE TABLE IF NOT EXISTS {schema}.{table}
+    ({points_id} {points_id_type} NOT NULL,
+     dest_ids int[] NOT NULL DEFAULT '{{}}',
+     distances int[] NOT NULL DEFAULT '{{}}'
+    );
+    '''.format(schema = schema,
+               table = table,
+               points_id = points_id,
+               points_id_type = points_id_type)
+    engine.execute(sql)
+
+def migrate(engine, schema, table, points_id, dest_id):
+    '''
+    Convert a result table recording JSONB lists of {dest_id, distance} records (an attributes
+    column) to the array layout, in place, within a single transaction.
+
+    output: True if the table was converted
+    '''
+    sql = '''
+    SELECT 1
+      FROM information_schema.columns
+     WHERE table_schema = %(schema)s
+       AND table_name = %(table)s
+       AND column_name = 'attributes';
+    '''
+    if engine.execute(sql, {'schema':schema, 'table':table}).fetchone() is None:
+        return False
+    sql = '''
+    ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS dest_ids int[] NOT NULL DEFAULT '{{}}',
+                                 ADD COLUMN IF NOT EXISTS distances int[] NOT NULL DEFAULT '{{}}';
+    UPDATE {schema}.{table} t
+       SET dest_ids  = a.dest_ids,
+           distances = a.distances
+      FROM (SELECT r.{points_id},
+                   array_agg((obj->>'{dest_id}')::int ORDER BY (obj->>'distance')::int, (obj->>'{dest_id}')::int) AS dest_ids,
+                   array_agg((obj->>'distance')::int ORDER BY (obj->>'distance')::int, (obj->>'{dest_id}')::int) AS distances
+              FROM {schema}.{table} r,
+                   jsonb_array_elements(r.attributes) obj
+             WHERE jsonb_typeof(r.attributes) = 'array'
+             GROUP BY r.{points_id}) a
+     WHERE t.{points_id} = a.{points_id};
+    -- (expression indexes on attributes are dropped with the column)
+    ALTER TABLE {schema}.{table} DROP COLUMN attributes;
+    '''.format(schema = schema,
+               table = table,
+               points_id = points_id,
+               dest_id = dest_id)
+    with engine.begin() as connection:
+        connection.execute(sql)
+    engine.execute('VACUUM ANALYZE {schema}.{table};'.format(schema = schema, table = table))
+    return True
+
+def encode(df, points_id, dest_id):
+    '''
+    Encode a long DataFrame of (point, destination, distance) results as a DataFrame with a
+    row for each point, and parallel lists of destination ids and distances (sorted by distance)
+    '''
+    if len(df) == 0:
+        return pandas.DataFrame(columns = [points_id, 'dest_ids', 'distances'])
+    df = df.sort_values([points_id, 'distance', dest_id])
+    ids = df[points_id].values
+    starts = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]])
+    dest_ids = numpy.split(df[dest_id].values.astype(int), starts[1:])
+    distances = numpy.split(df['distance'].values.astype(int), starts[1:])
+    return pandas.DataFrame({points_id:  ids[starts],
+                             'dest_ids':  [x.tolist() for x in dest_ids],
+                             'distances': [x.tolist() for x in distances]},
+                            columns = [points_id, 'dest_ids', 'distances'])
+
+def write(engine, df, schema, table):
+    ''' Append encoded results to a result table (engine may also be a connection, in a transaction) '''
+    df.to_sql(table, con = engine, schema = schema, index = False, if_exists = 'append',
+              dtype = {'dest_ids': ARRAY(Integer), 'distances': ARRAY(Integer)})
@@ -0,0 +1,161 @@
+# Script:  od_store.py
+# Purpose: Columnar store of OD distances, as an alternative to one table per destination
+#
+#          Distances recorded by 13_od_distances_3200m_cl.py in one table per destination
+#          (in the d_3200m_cl schema) may also be kept in a single long table, list
+#          partitioned by destination class, in the same schema:
+#            - od_points:    dictionary of point ids, encoded as an integer origin index
+#            - od_classes:   dictionary of destination classes, encoded as a smallint code
+#            - od_distances: (origin_idx, class_code, distances) with sorted distance arrays;
+#                            each destination class is stored in its own partition
+#                            (od_distances_<class_code>), ordered by origin index
+#
+#          Queries for particular destination classes scan only the partitions for those
+#          classes (partitions are pruned by class code), with narrow integer keys in place
+#          of point id strings, which are joined back to point ids once as required.
+#
+#          The distance to the closest destination of each class is also kept in a wide
+#          closest_distance table (one column per destination class, keyed by point id),
+#          which is updated as each destination is processed.  Indicators based on distance
+#          to closest destination read this narrow, indexed table, in place of evaluating
+#          the minimum of distance arrays across many joined tables.
+#
+#          Example usage:
+#            load_destination(engine, 'd_3200m_cl', 'supermarket_osm', sample_point_feature, points_id, points_id_type)
+#            sql = '''SELECT ... FROM {} s'''.format(destination_sql(engine, 'd_3200m_cl', 'supermarket_osm', points_id))
+
+def create_store(engine, schema, sample_point_feature, points_id, points_id_type = 'text'):
+    ''' Create the store tables (if not exists), and encode any new point ids '''
+    sql = '''
+    CREATE TABLE IF NOT EXISTS {schema}.od_points
+    (origin_idx integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+     {points_id} {points_id_type} NOT NULL UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS {schema}.od_classes
+    (class_code smallint PRIMARY KEY,
+     destination text NOT NULL UNIQUE,
+     updated timestamp
+    );
+    CREATE TABLE IF NOT EXISTS {schema}.od_distances
+    (origin_idx integer NOT NULL,
+     class_code smallint NOT NULL,
+     distances int[] NOT NULL
+    ) PARTITION BY LIST (class_code);
+    INSERT INTO {schema}.od_points ({points_id})
+    SELECT p.{points_id}
+      FROM {sample_point_feature} p
+     ORDER BY p.{points_id}
+        ON CONFLICT DO NOTHING;
+    '''.format(schema = schema,
+               sample_point_feature = sample_point_feature,
+               points_id = points_id,
+               points_id_type = points_id_type)
+    engine.execute(sql)
+
+def class_code(engine, schema, destination):
+    ''' The code for a destination class, which is registered (with its partition) if required '''
+    sql = '''
+    INSERT INTO {schema}.od_classes (class_code, destination)
+    SELECT COALESCE(MAX(class_code), 0) + 1, %(destination)s
+      FROM {schema}.od_classes
+        ON CONFLICT (destination) DO NOTHING;
+    '''.format(schema = schema)
+    engine.execute(sql, {'destination':destination})
+    sql = '''SELECT class_code FROM {schema}.od_classes WHERE destination = %(destination)s;'''.format(schema = schema)
+    code = engine.execute(sql, {'destination':destination}).fetchone()[0]
+    sql = '''
+    CREATE TABLE IF NOT EXISTS {schema}.od_distances_{code}
+      PARTITION OF {schema}.od_distances FOR VALUES IN ({code});
+    '''.format(schema = schema, code = code)
+    engine.execute(sql)
+    return code
+
+def load_destination(engine, schema, destination, sample_point_feature, points_id, points_id_type = 'text'):
+    '''
+    (Re)load the distances for a destination class from its result table into the store;
+    the partition for the class is replaced in a single transaction.
+    '''
+    create_store(engine, schema, sample_point_feature, points_id, points_id_type)
+    code = class_code(engine, schema, destination)
+    sql = '''
+    TRUNCATE {schema}.od_distances_{code};
+    ALTER TABLE {schema}.od_distances_{code} DROP CONSTRAINT IF EXISTS od_distances_{code}_pkey;
+    INSERT INTO {schema}.od_distances_{code} (origin_idx, class_code, distances)
+    SELECT o.origin_idx, {code}, r.distances
+      FROM {schema}."{destination}" r
+      JOIN {schema}.od_points o ON o.{points_id} = r.{points_id}
+     ORDER BY o.origin_idx;
+    ALTER TABLE {schema}.od_distances_{code} ADD PRIMARY KEY (origin_idx);
+    UPDATE {schema}.od_classes SET updated = now() WHERE class_code = {code};
+    '''.format(schema = schema,
+               code = code,
+               destination = destination,
+               points_id = points_id)
+    with engine.begin() as connection:
+        connection.execute(sql)
+    engine.execute('ANALYZE {schema}.od_distances_{code};'.format(schema = schema, code = code))
+    return code
+
+def stored_destinations(engine, schema):
+    ''' Destination classes loaded to the store (if it exists) '''
+    sql = '''SELECT to_regclass('{schema}.od_classes') IS NOT NULL;'''.format(schema = schema)
+    if not engine.execute(sql).fetchone()[0]:
+        return []
+    sql = '''SELECT destination FROM {schema}.od_classes WHERE updated IS NOT NULL ORDER BY destination;'''.format(schema = schema)
+    return [x[0] for x in engine.execute(sql)]
+
+def destination_sql(engine, schema, destination, points_id):
+    '''
+    A sub-query of the distances for a destination class, with fields as per its result
+    table (ie. point id and distances), which reads only the partition for this class
+    '''
+    sql = '''SELECT class_code FROM {schema}.od_classes WHERE destination = %(destination)s;'''.format(schema = schema)
+    code = engine.execute(sql, {'destination':destination}).fetchone()[0]
+    return '''
+    (SELECT o.{points_id}, d.distances
+       FROM {schema}.od_distances d
+       JOIN {schema}.od_points o USING (origin_idx)
+      WHERE d.class_code = {code})'''.format(schema = schema,
+                                             code = code,
+                                             points_id = points_id)
+
+def update_closest_distance(engine, schema, destination, sample_point_feature, points_id, points_id_type = 'text'):
+    '''
+    Record the distance to closest destination for a destination class (ie. the first 
+    element of its sorted distance arrays) in the closest_distance table, which is 
+    created if not exists (with a row for each point)
+    '''
+    sql = '''
+    CREATE TABLE IF NOT EXISTS {schema}.closest_distance AS
+    SELECT {points_id}::{points_id_type} AS {points_id}
+      FROM {sample_point_feature}
+     ORDER BY {points_id};
+    CREATE UNIQUE INDEX IF NOT EXISTS closest_distance_idx ON {schema}.closest_distance ({points_id});
+    INSERT INTO {schema}.closest_distance ({points_id})
+    SELECT {points_id}
+      FROM {sample_point_feature}
+        ON CONFLICT DO NOTHING;
+    ALTER TABLE {schema}.closest_distance ADD COLUMN IF NOT EXISTS "{destination}" int;
+    UPDATE {schema}.closest_distance c
+       SET "{destination}" = r.distances[1]
+      FROM {schema}."{destination}" r
+     WHERE c.{points_id} = r.{points_id}
+       AND c."{destination}" IS DISTINCT FROM r.distances[1];
+    '''.format(schema = schema,
+               destination = destination,
+               sample_point_feature = sample_point_feature,
+               points_id = points_id,
+               points_id_type = points_id_type)
+    with engine.begin() as connection:
+        connection.execute(sql)
+
+def closest_distance_destinations(engine, schema):
+    ''' Destination classes recorded in the closest_distance table (if it exists) '''
+    sql = '''
+    SELECT column_name
+      FROM information_schema.columns
+     WHERE table_schema = %(schema)s
+       AND table_name = 'closest_distance'
+       AND ordinal_position > 1;
+    '''
+    return [x[0] for x in engine.execute(sql, {'schema':schema})]
@@ -0,0 +1,117 @@
+# Script:  polygon_scheduler.py
+# Purpose: Cost-aware scheduling of polygons for parallel processing
+#
+#          Polygons are processed by worker processes in order of estimated cost
+#          (longest first), so that the largest tasks are not left until the end of a run
+#          while other workers sit idle.  The cost of a polygon is estimated from its count
+#          of points (as recorded in poly_points by 03_count_points_in_polys.py), and
+#          optionally the number of candidate destinations within the analysis distance.
+#
+#          Polygons with more than a given number of points are split into origin batches,
+#          each processed as a separate task.  Points are assigned to batches using a hash
+#          of their identifier, so that batch membership is stable across runs (ie. when
+#          resuming processing).
+#
+#          Tasks are (polygon, batch, batches) tuples; polygons which are not split have a
+#          single batch (0, 1).  Origins in a batch are selected using batch_filter(), and the
+#          ids of those remaining to be processed may be listed for arcpy using id_list().
+#
+#          Example usage:
+#            tasks = polygon_tasks(engine, polygon_id, max_points = 5000)
+#            pool = multiprocessing.Pool(processes = nWorkers, maxtasksperchild = worker_max_tasks or None)
+#            r = list(pool.imap(worker, tasks))
+#            completed = completed_polygons(tasks, r)
+
+import math
+import pandas
+
+def polygon_costs(engine, polygon_id, sample_point_feature = None, destinations = None, distance = 0):
+    '''
+    Estimated cost of processing polygons with points (as recorded in poly_points).
+
+    If a destinations table (or sub-query) with a geom field is supplied, the count of
+    destinations within distance of the extent of each polygon's points is recorded,
+    and the cost is estimated as points * (1 + destinations); otherwise, cost is
+    estimated by points.
+
+    output: DataFrame with fields polygon, points, destinations, and cost
+    '''
+    if destinations is None:
+        sql = '''
+        SELECT {polygon_id} AS polygon,
+               count AS points,
+               0 AS destinations
+          FROM poly_points
+         WHERE count > 0;
+        '''.format(polygon_id = polygon_id)
+    else:
+        sql = '''
+        WITH extents AS (
+            SELECT {polygon_id} AS polygon,
+                   ST_Expand(ST_Extent(geom)::geometry, {distance}) AS geom
+              FROM {sample_point_feature}
+             GROUP BY {polygon_id})
+        SELECT pp.{polygon_id} AS polygon,
+               pp.count AS points,
+               (SELECT COUNT(*)
+                  FROM {destinations} d
+                 WHERE d.geom && e.geom) AS destinations
+          FROM poly_points pp
+          LEFT JOIN extents e ON pp.{polygon_id} = e.polygon
+         WHERE pp.count > 0;
+        '''.format(polygon_id = polygon_id,
+                   sample_point_feature = sample_point_feature,
+                   destinations = destinations,
+                   distance = distance)
+    costs = pandas.read_sql(sql, engine)
+    costs['cost'] = costs['points'] * (1 + costs['destinations'])
+    return costs
+
+def polygon_tasks(engine, polygon_id, max_points = None, polygons = None, **kwargs):
+    '''
+    List of (polygon, batch, batches) tasks, ordered by estimated cost (longest first).
+
+    Polygons with more than max_points points are split into origin batches of up to
+    max_points; the list of tasks may optionally be restricted to a list of polygons.
+    Other keyword arguments are passed to polygon_costs.
+    '''
+    costs = polygon_costs(engine, polygon_id, **kwargs)
+    if polygons is not None:
+        costs = costs[costs.polygon.isin(polygons)]
+    tasks = []
+    for polygon, points, cost in costs[['polygon','points','cost']].itertuples(index = False):
+        batches = 1
+        if max_points is not None and max_points > 0:
+            batches = max(1, int(math.ceil(points / float(max_points))))
+        for batch in range(batches):
+            tasks.append((cost / float(batches), (int(polygon), batch, batches)))
+    tasks.sort(key = lambda x: x[0], reverse = True)
+    return [task for cost, task in tasks]
+
+def batch_filter(points_id, batch, batches, alias = 'p'):
+    ''' SQL condition selecting points in an origin batch (or all points, if not split) '''
+    if batches == 1:
+        return 'TRUE'
+    # (hash is cast to bigint, as abs() of the least int4 value, -2147483648, is out of range)
+    return '''mod(abs(hashtext({alias}.{points_id}::text)::bigint), {batches}) = {batch}'''.format(alias = alias,
+                                                                                              points_id = points_id,
+                                                                                              batch = batch,
+                                                                                              batches = batches)
+
+def id_list(ids, id_type):
+    '''
+    SQL list of point ids (e.g. remaining points in an origin batch, as read from the database)
+    for an IN clause; ids are quoted unless the id type is an integer type
+    '''
+    ids = [str(x) for x in ids]
+    if 'int' in id_type:
+        return ','.join(ids)
+    return ','.join(["'{}'".format(x.replace("'", "''")) for x in ids])
+
+def completed_polygons(tasks, results, success = (0, 2)):
+    ''' Polygons for which all tasks returned a successful result '''
+    status = {}
+    for task, result in zip(tasks, results):
+        polygon = task[0]
+        status[polygon] = status.get(polygon, True) and result in success
+    return [polygon for polygon in status if status[polygon]]
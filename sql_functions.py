@@ -0,0 +1,154 @@
+# Script:  sql_functions.py
+# Purpose: Versioned library of SQL functions used by indicator scripts
+#
+#          Functions are installed in the study region database by 00_create_database.py
+#          (and may be re-installed by running this script).  The installed version is
+#          recorded in the function_library table; the library is only re-installed if
+#          its version has changed, unless forced.
+#
+#          Functions are defined as single expression SQL functions where possible, so that
+#          they may be inlined by the query planner, and are marked IMMUTABLE, STRICT
+#          (ie. NULL on NULL input) and PARALLEL SAFE.
+#
+#          OD distance arrays (e.g. in the d_3200m_cl schema) are recorded sorted in
+#          ascending order; so, the closest distance is the first element of the array
+#          (array_first), and the count of distances within a threshold is found by binary
+#          search (using the built-in width_bucket function).  These functions require sorted
+#          arrays; array_min returns the minimum of any array (sorted or not).
+#
+#          Micro-benchmarks comparing these with the equivalent unnest based definitions,
+#          over a synthetic table of sorted distance arrays, may be run using
+#            python sql_functions.py <locale> benchmark [rows]
+
+import time
+
+library_version = 2
+
+functions = '''
+-- indicator of a distance being within threshold (1) or not (0)
+CREATE OR REPLACE FUNCTION threshold_hard(int, int)
+    RETURNS int
+    LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE
+    AS $$ SELECT ($1 < $2)::int $$;
+
+-- logistic decay of access with distance, being 0.5 at the threshold
+CREATE OR REPLACE FUNCTION threshold_soft(int, int)
+    RETURNS double precision
+    LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE
+    AS $$ SELECT 1 - 1/(1+exp(-5*($1-$2)/($2::float))) $$;
+
+-- minimum of a distance array (NULL if empty)
+CREATE OR REPLACE FUNCTION array_min(int[])
+    RETURNS int
+    LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE
+    AS $$ SELECT min(x) FROM unnest($1) x $$;
+
+-- minimum of an array of any other type
+CREATE OR REPLACE FUNCTION array_min(anyarray)
+    RETURNS anyelement
+    LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE
+    AS $$ SELECT min(x) FROM unnest($1) x $$;
+
+-- minimum of a distance array sorted in ascending order, being its first element (NULL if empty)
+-- (the array must be sorted, as for OD distance arrays; otherwise, use array_min)
+CREATE OR REPLACE FUNCTION array_first(int[])
+    RETURNS int
+    LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE
+    AS $$ SELECT $1[array_lower($1, 1)] $$;
+
+-- count of distances in a distance array sorted in ascending order within (ie. less than) threshold
+CREATE OR REPLACE FUNCTION count_in_threshold(int[], int)
+    RETURNS int
+    LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE
+    AS $$ SELECT width_bucket($2 - 1, $1) $$;
+'''
+
+def installed_version(engine):
+    ''' The installed version of the function library (None if not installed) '''
+    sql = '''SELECT to_regclass('function_library') IS NOT NULL;'''
+    if not engine.execute(sql).fetchone()[0]:
+        return None
+    return engine.execute('''SELECT MAX(version) FROM function_library;''').fetchone()[0]
+
+def install(engine, force = False):
+    ''' Install the function library, if not already installed at the current version '''
+    if not force and installed_version(engine) == library_version:
+        return False
+    sql = '''
+    {functions}
+    CREATE TABLE IF NOT EXISTS function_library
+    (version integer PRIMARY KEY,
+     installed timestamp DEFAULT now()
+    );
+    INSERT INTO function_library (version) VALUES ({version})
+        ON CONFLICT (version) DO UPDATE SET installed = now();
+    '''.format(functions = functions, version = library_version)
+    with engine.begin() as connection:
+        connection.execute(sql)
+    return True
+
+benchmarks = [('closest distance',
+               'SELECT SUM(array_first(distances)) FROM {table}',
+               'SELECT SUM((SELECT min(x) FROM unnest(distances) x)) FROM {table}'),
+              ('count within 800m',
+               'SELECT SUM(count_in_threshold(distances, 800)) FROM {table}',
+               'SELECT SUM((SELECT COUNT(*) FROM unnest(distances) x WHERE x < 800)) FROM {table}'),
+              ('soft threshold of closest distance',
+               'SELECT SUM(threshold_soft(array_first(distances), 1000)) FROM {table}',
+               'SELECT SUM(1 - 1/(1+exp(-5*((SELECT min(x) FROM unnest(distances) x)-1000)/(1000::float)))) FROM {table}')]
+
+def benchmark(engine, rows = 1000000, repeats = 3):
+    '''
+    Time queries using the function library against equivalent unnest based queries,
+    over a synthetic table of sorted distance arrays (of up to 40 distances within 3200m).
+
+    output: list of (benchmark, library seconds, unnest seconds) tuples (best of repeats)
+    '''
+    table = 'function_library_benchmark'
+    # (the array sub-query refers to id, so that it is evaluated for each row)
+    sql = '''
+    DROP TABLE IF EXISTS {table};
+    CREATE UNLOGGED TABLE {table} AS
+    SELECT id,
+           ARRAY(SELECT (random()*3200)::int
+                   FROM generate_series(1, (random()*40)::int + id*0)
+                  ORDER BY 1) AS distances
+      FROM generate_series(1, {rows}) id;
+    ANALYZE {table};
+    '''.format(table = table, rows = rows)
+    engine.execute(sql)
+    results = []
+    try:
+        for name, library_sql, unnest_sql in benchmarks:
+            timings = []
+            for sql in [library_sql, unnest_sql]:
+                best = None
+                for i in range(repeats):
+                    query_start = time.time()
+                    engine.execute(sql.format(table = table)).fetchone()
+                    duration = time.time() - query_start
+                    if best is None or duration < best:
+                        best = duration
+                timings.append(best)
+            results.append((name, timings[0], timings[1]))
+    finally:
+        engine.execute('DROP TABLE IF EXISTS {table};'.format(table = table))
+    return results
+
+if __name__ == '__main__':
+    from sqlalchemy import create_engine
+    from _project_setup import *
+    engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
+                                                                          pwd  = db_pwd,
+                                                                          host = db_host,
+                                                                          db   = db),
+                           use_native_hstore=False)
+    if install(engine, force = True):
+        print("Installed function library (version {}).".format(library_version))
+    if len(sys.argv) >= 3 and sys.argv[2] == 'benchmark':
+        rows = int(sys.argv[3]) if len(sys.argv) >= 4 else 1000000
+        print("\nBenchmarking function library over {} synthetic distance arrays (best of 3, seconds)...".format(rows))
+        print("{:<40}{:>12}{:>12}{:>10}".format('benchmark','library','unnest','speed-up'))
+        for name, library_time, unnest_time in benchmark(engine, rows):
+            print("{:<40}{:>12.2f}{:>12.2f}{:>10.1f}".format(name, library_time, unnest_time, unnest_time/library_time))
+    engine.dispose()
@@ -0,0 +1,8 @@
+# Script:  conftest.py
+# Purpose: pytest configuration; modules at the repository root are imported by the tests
+#          (the numbered scripts are not imported, as they require the project database)
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
@@ -0,0 +1,192 @@
+# Script:  test_network_routing.py
+# Purpose: Tests of in-process network routing on small hand-built networks
+#          python -m pytest tests
+
+import pandas
+import pytest
+
+import network_routing
+from network_routing import inf
+
+def square_network():
+    '''
+    A square of 100m edges (nodes 1-4), with a 300m spur to node 5 (edges are 
+    identified by position: 0: 1-2, 1: 2-3, 2: 3-4, 3: 4-1, 4: 2-5)
+
+      1 ---- 2 ---------- 5
+      |      |
+      4 ---- 3
+    '''
+    return network_routing.network_from_edges(u      = [1, 2, 3, 4, 2],
+                                              v      = [2, 3, 4, 1, 5],
+                                              length = [100, 100, 100, 100, 300])
+
+def located(network, id, u, v, length, edge_offset):
+    ''' Locations as returned by network_routing.locate(), for lists of source node ids '''
+    df = pandas.DataFrame({'id':id,'u':u,'v':v,'length':length,'edge_offset':edge_offset})
+    df['u'] = network.node_index(df.u.values)
+    df['v'] = network.node_index(df.v.values)
+    return df
+
+def origin(network, u = 1, v = 2, length = 100.0, edge_offset = 25.0):
+    ''' A located origin (by default, 25m along edge 1-2) '''
+    return next(located(network, ['origin'], [u], [v], [length], [edge_offset]).itertuples())
+
+def destinations(network):
+    ''' Destination a at node 3, and b 50m from node 5 along the spur '''
+    return located(network, ['a','b'], [3,2], [4,5], [100.0,300.0], [0.0,250.0])
+
+def test_node_index():
+    network = square_network()
+    assert list(network.node_index([1, 5, 3])) == [0, 4, 2]
+    with pytest.raises(ValueError):
+        network.node_index([6])
+
+def test_search_cutoff():
+    network = square_network()
+    n = network.node_index([1, 2, 3, 4, 5])
+    settled = network_routing.search(network, network_routing.origin_seeds(origin(network)), 150)
+    assert settled == {n[0]: 25.0, n[1]: 75.0, n[3]: 125.0}
+    # nodes at exactly the cutoff distance are settled
+    settled = network_routing.search(network, network_routing.origin_seeds(origin(network)), 175)
+    assert settled[n[2]] == 175.0
+    assert n[4] not in settled
+    # with no cutoff, all nodes are settled at their shortest distance
+    settled = network_routing.search(network, network_routing.origin_seeds(origin(network)))
+    assert settled == {n[0]: 25.0, n[1]: 75.0, n[2]: 175.0, n[3]: 125.0, n[4]: 375.0}
+
+def test_search_seeds_beyond_cutoff():
+    network = square_network()
+    n = network.node_index([1, 2])
+    settled = network_routing.search(network, network_routing.origin_seeds(origin(network)), 50)
+    assert settled == {n[0]: 25.0}
+
+def test_reachable():
+    network = square_network()
+    o = origin(network)
+    index = network_routing.LocationIndex(destinations(network))
+    assert network_routing.distances_within(network, o, index, 400) == {'a': 175.0, 'b': 325.0}
+    assert network_routing.distances_within(network, o, index, 200) == {'a': 175.0}
+    assert network_routing.distances_within(network, o, index, 100) == {}
+    # the settled nodes of a wider search are restricted to the cutoff distance
+    settled = network_routing.search(network, network_routing.origin_seeds(o), 400)
+    assert network_routing.reachable(settled, o, index, 200) == {'a': 175.0}
+
+def test_reachable_same_edge():
+    network = square_network()
+    # an origin 10m from node 5 is 40m from b directly along the spur (rather than 540m via node 2)
+    o = origin(network, u = 2, v = 5, length = 300.0, edge_offset = 290.0)
+    index = network_routing.LocationIndex(destinations(network))
+    assert network_routing.distances_within(network, o, index, 50) == {'b': 40.0}
+    # the edge key is independent of the direction in which the origin's edge was located
+    o = origin(network, u = 5, v = 2, length = 300.0, edge_offset = 10.0)
+    assert network_routing.distances_within(network, o, index, 50) == {'b': 40.0}
+
+def test_reachable_labelled():
+    network = square_network()
+    o = origin(network)
+    dests = destinations(network)
+    index = network_routing.LocationIndex()
+    index.add(dests.iloc[[0]], label = 'type_1')
+    index.add(dests, label = 'type_2')
+    settled = network_routing.search(network, network_routing.origin_seeds(o), 400)
+    result = network_routing.reachable(settled, o, index, 400)
+    assert result == {('type_1','a'): 175.0, ('type_2','a'): 175.0, ('type_2','b'): 325.0}
+    assert network_routing.distances_by_label(result) == {'type_1': [175.0], 'type_2': [175.0, 325.0]}
+
+def test_add_targets():
+    network = square_network()
+    o = origin(network)
+    # a park with entry points 40m along 2-3, 10m from node 1 along 4-1 and 10m from node 2 along 1-2,
+    # and a park with a single entry point on the spur
+    entries = located(network, ['park_1','park_1','park_1','park_2'], [2,4,1,2], [3,1,2,5], 
+                      [100.0,100.0,100.0,300.0], [40.0,90.0,90.0,250.0])
+    targets = network_routing.LocationIndex()
+    targets.add_targets(entries)
+    points = network_routing.LocationIndex(entries)
+    # distances are to the closest entry point of each target, as for the individual entry points
+    expected = {'park_1': 35.0, 'park_2': 325.0}
+    assert network_routing.distances_within(network, o, targets, 400) == expected
+    assert network_routing.distances_within(network, o, points, 400) == expected
+    # each node is recorded once for each target (node 2 is recorded once for park_1, at 10m)
+    assert sum([len(x) for x in targets.nodes.values()]) < sum([len(x) for x in points.nodes.values()])
+    for dests in targets.nodes.values():
+        ids = [id for id, extra in dests]
+        assert len(ids) == len(set(ids))
+    # an origin on the same edge as an entry point is evaluated directly
+    o = origin(network, u = 4, v = 1, length = 100.0, edge_offset = 95.0)
+    assert network_routing.distances_within(network, o, targets, 10) == {'park_1': 5.0}
+
+def test_add_targets_labelled():
+    network = square_network()
+    entries = located(network, ['park_1','park_1'], [2,4], [3,1], [100.0,100.0], [40.0,90.0])
+    targets = network_routing.LocationIndex()
+    targets.add_targets(entries, label = 'aos')
+    assert network_routing.distances_within(network, origin(network), targets, 400) == {('aos','park_1'): 35.0}
+
+def test_closest():
+    network = square_network()
+    o = origin(network)
+    index = network_routing.LocationIndex(destinations(network))
+    assert network_routing.closest(network, o, index) == ('a', 175.0)
+    # no destination can be reached
+    assert network_routing.closest(network, o, network_routing.LocationIndex()) == (None, inf)
+
+def test_label_nearest():
+    network = square_network()
+    index = network_routing.LocationIndex(destinations(network))
+    distance, nearest = network_routing.label_nearest(network, index)
+    n = network.node_index([1, 2, 3, 4, 5])
+    # node 2 is 100m from a (at node 3) and 250m from b; node 5 is 50m from b
+    assert list(distance[n]) == [200.0, 100.0, 0.0, 100.0, 50.0]
+    assert [nearest[i] for i in n] == ['a', 'a', 'a', 'a', 'b']
+
+def test_label_nearest_multi_source():
+    # two components; the nearest of several destinations labels each node, and nodes 
+    # of a component without destinations are unreachable
+    #   1 -- 2 -- 3 -- 4      6 -- 7
+    network = network_routing.network_from_edges(u = [1, 2, 3, 6], v = [2, 3, 4, 7], length = [100, 100, 100, 50])
+    dests = located(network, ['x','y'], [1,3], [2,4], [100.0,100.0], [10.0,80.0])
+    index = network_routing.LocationIndex(dests)
+    distance, nearest = network_routing.label_nearest(network, index)
+    n = network.node_index([1, 2, 3, 4, 6, 7])
+    assert list(distance[n]) == [10.0, 90.0, 80.0, 20.0, inf, inf]
+    assert [nearest[i] for i in n] == ['x', 'x', 'y', 'y', None, None]
+    # closest destinations read from the labels agree with a search from each origin
+    for u, v, offset in [(1, 2, 50.0), (2, 3, 5.0), (3, 4, 90.0), (6, 7, 25.0)]:
+        o = origin(network, u = u, v = v, length = 100.0 if u != 6 else 50.0, edge_offset = offset)
+        assert network_routing.closest_labelled((distance, nearest), o, index) == network_routing.closest(network, o, index)
+    o = origin(network, u = 1, v = 2, length = 100.0, edge_offset = 50.0)
+    assert network_routing.closest_labelled((distance, nearest), o, index) == ('x', 40.0)
+    o = origin(network, u = 6, v = 7, length = 50.0, edge_offset = 25.0)
+    assert network_routing.closest_labelled((distance, nearest), o, index) == (None, inf)
+
+def test_service_area():
+    network = square_network()
+    o = origin(network)
+    result = sorted(network_routing.service_area(network, o, 150), key = lambda x: (x[0], x[3] is not None))
+    # edges from nodes 1 (25m), 2 (75m) and 4 (125m); node 3 (175m) and 5 (375m) are beyond the cutoff,
+    # and the origin's own edge is recorded with its offset
+    assert result == [(0, 25.0, 75.0, None),
+                      (0, None, None, 25.0),
+                      (1, 75.0, None, None),
+                      (2, None, 125.0, None),
+                      (3, 125.0, 25.0, None),
+                      (4, 75.0, None, None)]
+
+def test_service_area_settled():
+    network = square_network()
+    o = origin(network)
+    settled = network_routing.search(network, network_routing.origin_seeds(o), 150)
+    assert sorted(network_routing.service_area(network, o, 150, settled), key = str) == \
+           sorted(network_routing.service_area(network, o, 150), key = str)
+
+def test_snap_table_name():
+    ''' Snapping index table names are distinct for long sources sharing a prefix, and fit PostgreSQL's limit '''
+    prefix = 'destinations."{}'.format('a_very_long_destination_name' * 3)
+    first  = network_routing.snap_table_name('{}_1".dest_oid'.format(prefix))
+    second = network_routing.snap_table_name('{}_2".dest_oid'.format(prefix))
+    assert first != second
+    assert len('{}_idx'.format(first)) <= 63
+    assert first.startswith('snap_destinations_a_very_long')
+    assert network_routing.snap_table_name('parcel_dwellings.gnaf_pid') == network_routing.snap_table_name('parcel_dwellings.gnaf_pid')
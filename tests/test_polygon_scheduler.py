@@ -0,0 +1,33 @@
+# Script:  test_polygon_scheduler.py
+# Purpose: Tests of origin batch selection for polygons split into several tasks
+#            python -m pytest tests
+
+import pandas
+import pytest
+
+import polygon_scheduler
+
+def test_batch_filter():
+    assert polygon_scheduler.batch_filter('gnaf_pid', 0, 1) == 'TRUE'
+    # the hash is cast to bigint before abs(), which is out of range for the least int4 value
+    assert polygon_scheduler.batch_filter('gnaf_pid', 2, 4) == 'mod(abs(hashtext(p.gnaf_pid::text)::bigint), 4) = 2'
+    assert polygon_scheduler.batch_filter('gnaf_pid', 0, 2, alias = 'o') == 'mod(abs(hashtext(o.gnaf_pid::text)::bigint), 2) = 0'
+
+@pytest.mark.parametrize('batches', [1, 3])
+def test_remaining_text_ids(batches):
+    # remaining points in a batch of a polygon, as read using pandas.read_sql (text ids, e.g. gnaf_pid)
+    tasks = [(polygon, batch, batches) for polygon in [101, 102] for batch in range(batches)]
+    for polygon, batch, batches in tasks:
+        remaining_points = pandas.DataFrame({'gnaf_pid':['GAVIC4117{}{}'.format(polygon, batch), "GAVIC'{}".format(batch)]})
+        points = polygon_scheduler.id_list(remaining_points['gnaf_pid'].values, 'varchar')
+        assert points == "'GAVIC4117{0}{1}','GAVIC''{1}'".format(polygon, batch)
+
+def test_remaining_integer_ids():
+    remaining_points = pandas.DataFrame({'id':[3, 10, 42]})
+    assert polygon_scheduler.id_list(remaining_points['id'].values, 'integer') == '3,10,42'
+    assert polygon_scheduler.id_list(['3', '10'], 'bigint') == '3,10'
+
+def test_completed_polygons():
+    tasks = [(101, 0, 2), (101, 1, 2), (102, 0, 1), (103, 0, 3), (103, 1, 3), (103, 2, 3)]
+    results = [0, 2, 0, 0, 1, 0]
+    assert sorted(polygon_scheduler.completed_polygons(tasks, results)) == [101, 102]
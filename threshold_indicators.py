@@ -0,0 +1,226 @@
+# Script:  threshold_indicators.py
+# Purpose: Vectorised evaluation of hard and soft threshold access indicators
+#
+#          Distances to closest destination are read once (in chunks of points) into
+#          NumPy arrays, and indicators for every combination of destination, threshold
+#          type and threshold distance are evaluated as array operations, in place of a
+#          scan of the distance table in SQL for each threshold type and distance.
+#          Results are streamed to a single wide table using binary COPY (see bulk_copy.py),
+#          with a column for each combination, named {destination}_{type}_{threshold}m.
+#
+#          The array formulae are equivalent to the threshold_hard and threshold_soft SQL
+#          functions (see sql_functions.py); this is tested against the formulae in
+#          tests/test_threshold_indicators.py, and may be confirmed against the installed
+#          functions using
+#            python threshold_indicators.py <locale> check
+#
+#          Views with the names and columns of the tables formerly created for each threshold
+#          type and distance (e.g. ind_point.nh_inds_soft_1000m) are created over this table,
+#          as these are referred to by indicator queries in the project configuration.
+#
+#          Example usage:
+#            write_threshold_indicators(engine, 'ind_point.nh_inds_threshold', sql,
+#                                       points_id, points_id_type, destinations)
+#            write_threshold_views(engine, 'ind_point', 'nh_inds_threshold', points_id, destinations)
+
+import numpy
+import pandas
+
+from bulk_copy import BinaryCopyWriter
+
+threshold_types = ['hard','soft']
+thresholds = [400,800,1000,1600]
+
+# destinations for which neighbourhood threshold indicators are evaluated (18_neighbourhood_indicators.py),
+# with distance to closest read from nh_inds_distance and d_3200m_cl.closest_distance respectively
+nh_inds_destinations = ['convenience_osm_2018',
+                        'supermarket_hlc_2017_osm_2018',
+                        'community_centre_hlc_2016_osm_2018',
+                        'food_fresh_specialty_osm_2018',
+                        'food_fast_hlc_2017_osm_2018',
+                        'food_dining_osm_2018',
+                        'culture_osm_2018',
+                        'gtfs_20191008_20191205_pt_any',
+                        'gtfs_20191008_20191205_pt_0020']
+local_living_destinations = ['libraries_2018',
+                             'childcare_all_meet_2019',
+                             'nhsd_2017_dentist',
+                             'nhsd_2017_gp',
+                             'nhsd_2017_pharmacy',
+                             'postoffice_osm']
+
+def threshold_hard(distances, threshold):
+    ''' Indicator of distances being within threshold (1) or not (0); NaN where distance is null '''
+    distances = numpy.asarray(distances, dtype = float)
+    return numpy.where(numpy.isnan(distances), numpy.nan, (distances < threshold).astype(float))
+
+def threshold_soft(distances, threshold):
+    ''' Logistic decay of access with distance, being 0.5 at the threshold; NaN where distance is null '''
+    distances = numpy.asarray(distances, dtype = float)
+    # (exponent is clipped to avoid overflow warnings for very distant points; result is unchanged)
+    exponent = numpy.clip(-5 * (distances - threshold) / float(threshold), -700, 700)
+    return 1 - 1 / (1 + numpy.exp(exponent))
+
+functions = {'hard': threshold_hard,
+             'soft': threshold_soft}
+
+column_types = {'hard': 'int4',
+                'soft': 'float8'}
+
+def indicator_columns(destinations, types = threshold_types, distances = thresholds):
+    ''' List of (column, destination, threshold type, threshold) tuples, in output order '''
+    return [('{}_{}_{}m'.format(destination, t, d), destination, t, d)
+            for t in types
+            for d in distances
+            for destination in destinations]
+
+def threshold_indicators(df, destinations, types = threshold_types, distances = thresholds):
+    '''
+    Evaluate threshold indicators for a DataFrame of distances to closest destination
+
+    input: DataFrame with a column of distances for each destination
+    output: dictionary of indicator arrays, keyed by column name
+    '''
+    values = dict((destination, df[destination].values.astype(float)) for destination in destinations)
+    return dict((column, functions[t](values[destination], d))
+                for column, destination, t, d in indicator_columns(destinations, types, distances))
+
+def write_threshold_indicators(engine, table, sql, points_id, points_id_type, destinations,
+                               types = threshold_types, distances = thresholds, chunksize = 100000):
+    '''
+    Create a wide table of threshold indicators, evaluated for points read using the
+    supplied query (which should return the point id and a distance column for each
+    destination); the table is replaced in a single transaction once loaded.
+
+    output: the number of points written
+    '''
+    columns = indicator_columns(destinations, types, distances)
+    staging_table = '{}_staging'.format(table)
+    definitions = ',\n'.join(['"{}" {}'.format(c[0], 'int' if c[2] == 'hard' else 'double precision') for c in columns])
+    conn = engine.raw_connection()
+    try:
+        curs = conn.cursor()
+        curs.execute('''
+          DROP TABLE IF EXISTS {staging_table};
+          CREATE UNLOGGED TABLE {staging_table} (id text, {definitions});
+          '''.format(staging_table = staging_table, definitions = definitions))
+        writer = BinaryCopyWriter(curs,
+                                  staging_table,
+                                  ['id'] + ['"{}"'.format(c[0]) for c in columns],
+                                  ['text'] + [column_types[c[2]] for c in columns])
+        for df in pandas.read_sql(sql, engine, chunksize = chunksize):
+            results = threshold_indicators(df, destinations, types, distances)
+            # indicators are cast to the output type, with null distances loaded as NULL
+            outputs = []
+            for column, destination, t, d in columns:
+                values = results[column]
+                if t == 'hard':
+                    outputs.append([None if numpy.isnan(x) else int(x) for x in values])
+                else:
+                    outputs.append([None if numpy.isnan(x) else float(x) for x in values])
+            for row in zip(df[points_id].astype(str).values, *outputs):
+                writer.write(row)
+        count = writer.close()
+        conn.commit()
+        curs.execute('''
+          DROP TABLE IF EXISTS {table} CASCADE;
+          CREATE TABLE {table} AS
+          SELECT id::{points_id_type} AS {points_id},
+                 {fields}
+            FROM {staging_table};
+          CREATE UNIQUE INDEX {index} ON {table} ({points_id});
+          DROP TABLE {staging_table};
+          '''.format(table = table,
+                     index = '{}_idx'.format(table.split('.')[-1]),
+                     points_id = points_id,
+                     points_id_type = points_id_type,
+                     fields = ',\n'.join(['"{}"'.format(c[0]) for c in columns]),
+                     staging_table = staging_table))
+        conn.commit()
+    finally:
+        conn.close()
+    return count
+
+def threshold_views(source, points_id, destinations, types = threshold_types, distances = thresholds, prefix = 'nh_inds'):
+    '''
+    Queries for views of a wide threshold indicator table as a table for each threshold type and
+    distance, named {prefix}_{type}_{distance}m with a column for each destination, as referred to 
+    by indicator queries in the project configuration (e.g. nh_inds_{threshold}_1000m.supermarket_hlc_2017_osm_2018)
+
+    output: list of (view name, SELECT query) tuples
+    '''
+    views = []
+    for t in types:
+        for d in distances:
+            columns = ',\n'.join(['"{}_{}_{}m" AS {}'.format(destination, t, d, destination) for destination in destinations])
+            views.append(('{}_{}_{}m'.format(prefix, t, d),
+                          '''SELECT {points_id},\n{columns}\nFROM {source}'''.format(points_id = points_id,
+                                                                                   columns = columns,
+                                                                                   source = source)))
+    return views
+
+def write_threshold_views(engine, schema, table, points_id, destinations, 
+                          types = threshold_types, distances = thresholds, prefix = 'nh_inds'):
+    '''
+    Create views of a wide threshold indicator table for each threshold type and distance (see
+    threshold_views), replacing tables of these names if present (as previously created for each
+    threshold type and distance).  The views are dropped with the table, when this is re-created.
+    '''
+    for view, query in threshold_views('{}.{}'.format(schema, table), points_id, destinations, types, distances, prefix):
+        sql = '''
+        DO $$
+        BEGIN
+          IF EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = '{schema}' AND tablename = '{view}') THEN
+            DROP TABLE {schema}.{view};
+          END IF;
+        END $$;
+        DROP VIEW IF EXISTS {schema}.{view};
+        CREATE VIEW {schema}.{view} AS 
+        {query};
+        '''.format(schema = schema,
+                   view = view,
+                   query = query)
+        engine.execute(sql)
+
+def check(engine, distances = range(0, 6401, 10), tolerance = 1e-9):
+    '''
+    Compare the array formulae with the threshold_hard and threshold_soft SQL functions,
+    for each threshold, over a series of distances (and null).
+
+    output: list of (threshold type, threshold, maximum absolute difference, mismatches) tuples
+    '''
+    distances = list(distances)
+    results = []
+    for t in threshold_types:
+        for d in thresholds:
+            sql = '''
+            SELECT x, threshold_{t}(x, {d}) AS sql_value
+              FROM unnest(%(distances)s::int[] || NULL::int) x;
+            '''.format(t = t, d = d)
+            df = pandas.read_sql(sql, engine, params = {'distances':distances})
+            sql_values = df['sql_value'].values.astype(float)
+            array_values = functions[t](df['x'].values.astype(float), d)
+            difference = numpy.abs(numpy.nan_to_num(sql_values - array_values, nan = 0))
+            nulls = numpy.isnan(sql_values) != numpy.isnan(array_values)
+            mismatches = int((difference > tolerance).sum() + nulls.sum())
+            results.append((t, d, float(difference.max()), mismatches))
+    return results
+
+if __name__ == '__main__':
+    import sys
+    from sqlalchemy import create_engine
+    from _project_setup import *
+    engine = create_engine("postgresql://{user}:{pwd}@{host}/{db}".format(user = db_user,
+                                                                          pwd  = db_pwd,
+                                                                          host = db_host,
+                                                                          db   = db),
+                           use_native_hstore=False)
+    if len(sys.argv) >= 3 and sys.argv[2] == 'check':
+        print("Comparing threshold indicator array formulae with SQL functions...")
+        print("{:<8}{:>10}{:>16}{:>12}".format('type','threshold','max difference','mismatches'))
+        failed = False
+        for t, d, difference, mismatches in check(engine):
+            print("{:<8}{:>10}{:>16.2e}{:>12}".format(t, d, difference, mismatches))
+            failed = failed or mismatches > 0
+        print("Failed." if failed else "Passed.")
+    engine.dispose()
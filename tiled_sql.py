@@ -0,0 +1,83 @@
+# Script:  tiled_sql.py
+# Purpose: Parallel execution of SQL statements by tile
+#
+#          Features of a table may be assigned to square tiles (by the centre of their
+#          bounding box), so that statements processing each feature (e.g. an UPDATE
+#          based on a spatial join) may be run for each tile separately, across a pool
+#          of worker processes, each with its own database connection.
+#
+#          Tiled statements contain a {tile} placeholder, which is replaced by the quoted
+#          tile identifier for each tile (e.g. "... WHERE o.tile = {tile}").  Each tile is
+#          processed in its own transaction; statements for a tile should only modify
+#          features of that tile, and should not depend on values modified by the same
+#          statement for other tiles.
+#
+#          Tiles are processed in order of their count of features (largest first).
+#
+#          Example usage:
+#            assign_tiles(engine, 'open_space.open_space', 3200)
+#            execute(engine, 'UPDATE open_space.open_space SET ... WHERE tile = {tile};',
+#                    tiles(engine, 'open_space.open_space'), processes = nWorkers)
+
+import functools
+import multiprocessing
+import sys
+from sqlalchemy import create_engine
+
+def tile_expression(size, geom = 'geom'):
+    ''' SQL expression for the identifier of the tile containing the centre of a geometry's bounding box '''
+    return '''floor((ST_XMin({geom}) + ST_XMax({geom}))/(2.0*{size}))::bigint::text || '_' ||
+              floor((ST_YMin({geom}) + ST_YMax({geom}))/(2.0*{size}))::bigint::text'''.format(geom = geom,
+                                                                                           size = size)
+
+def assign_tiles_sql(table, size, geom = 'geom', column = 'tile'):
+    ''' SQL to record the tile of features in a table (those not already assigned), and index this '''
+    return '''
+    ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} text;
+    UPDATE {table} SET {column} = {expression} WHERE {column} IS NULL;
+    CREATE INDEX IF NOT EXISTS {index} ON {table} ({column});
+    '''.format(table = table,
+               column = column,
+               expression = tile_expression(size, geom),
+               index = '{}_{}_idx'.format(table.split('.')[-1], column))
+
+def assign_tiles(engine, table, size, geom = 'geom', column = 'tile'):
+    ''' Record the tile of features in a table (those not already assigned), and index this '''
+    engine.execute(assign_tiles_sql(table, size, geom, column))
+
+def tiles(engine, table, column = 'tile'):
+    ''' List of tiles of features in a table, ordered by count of features (largest first) '''
+    sql = '''
+    SELECT {column}
+      FROM {table}
+     WHERE {column} IS NOT NULL
+     GROUP BY {column}
+     ORDER BY COUNT(*) DESC, {column};
+    '''.format(table = table, column = column)
+    return [x[0] for x in engine.execute(sql)]
+
+def execute_tile(tile, sql, db_url):
+    ''' Execute a tiled statement for a tile; returns 0 on success, 1 on error '''
+    engine = create_engine(db_url, use_native_hstore=False)
+    try:
+        with engine.begin() as connection:
+            connection.execute(sql.replace('{tile}', "'{}'".format(tile)))
+        return 0
+    except:
+        print("Error: {}\nTile: {}".format(sys.exc_info(), tile))
+        return 1
+    finally:
+        engine.dispose()
+
+def execute(engine, sql, tile_list, processes):
+    '''
+    Execute a tiled statement for each of a list of tiles, across a pool of processes
+
+    output: list of tiles for which the statement returned an error
+    '''
+    worker = functools.partial(execute_tile, sql = sql, db_url = engine.url)
+    pool = multiprocessing.Pool(processes = processes)
+    r = pool.map(worker, tile_list, chunksize = 1)
+    pool.close()
+    pool.join()
+    return [tile for tile, result in zip(tile_list, r) if result != 0]
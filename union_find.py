@@ -0,0 +1,66 @@
+# Script:  union_find.py
+# Purpose: Disjoint set (union-find) structure for clustering features from pairwise relations
+#
+#          Connected components of a set of items, given pairs of related items (e.g. features
+#          within some distance of each other, found using an indexed spatial self-join), are
+#          equivalent to the clusters returned by PostGIS ST_ClusterWithin, but may be found
+#          from pairs identified in parallel (e.g. by tile), with clusters which cross tile
+#          edges merged as pairs are added.
+#
+#          Example usage:
+#            clusters = components(ids, pairs)
+
+class UnionFind(object):
+    ''' Disjoint sets of items, with path compression and union by rank '''
+    def __init__(self, items = ()):
+        self.parent = {}
+        self.rank = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if item not in self.parent:
+            self.parent[item] = item
+            self.rank[item] = 0
+
+    def find(self, item):
+        ''' The representative item of the set containing item '''
+        self.add(item)
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # compress the path to the root
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        ''' Merge the sets containing a and b '''
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.rank[a] < self.rank[b]:
+            a, b = b, a
+        self.parent[b] = a
+        if self.rank[a] == self.rank[b]:
+            self.rank[a] += 1
+
+def components(ids, pairs):
+    '''
+    Connected components of items, given pairs of related items
+
+    output: dictionary of component number for each item; components are numbered
+            from 1, in order of their lowest item
+    '''
+    sets = UnionFind(ids)
+    for a, b in pairs:
+        sets.union(a, b)
+    numbers = {}
+    result = {}
+    for item in sorted(sets.parent):
+        root = sets.find(item)
+        if root not in numbers:
+            numbers[root] = len(numbers) + 1
+        result[item] = numbers[root]
+    return result
@@ -0,0 +1,153 @@
+# Script:  work_ledger.py
+# Purpose: Work ledger for resumable parallel processing of polygons
+#
+#          Worker processes record the outcome of each unit of work (a stage, destination,
+#          polygon and origin batch) in a ledger table in the study region database, with the number of
+#          points processed and duration.  Records are written atomically (upsert), so that
+#          resuming a run, and reporting on its progress, are indexed lookups on the ledger
+#          rather than counts over the result tables.
+#
+#          Polygons which are not split into origin batches (see polygon_scheduler.py) are
+#          recorded as batch 0.
+#
+#          Status values:
+#            - 'complete':  results recorded for all points in the polygon
+#            - 'no_points': no points to process in the polygon (considered complete)
+#            - 'error':     processing failed; the polygon will be processed again
+
+import pandas
+
+ledger_table = 'work_ledger'
+complete = ('complete', 'no_points')
+
+def create_ledger(engine):
+    ''' Create the work ledger table, if not exists '''
+    sql = '''
+    CREATE TABLE IF NOT EXISTS {ledger_table}
+    (stage text NOT NULL,
+     destination text NOT NULL,
+     polygon bigint NOT NULL,
+     batch integer NOT NULL DEFAULT 0,
+     status text NOT NULL,
+     n_points integer,
+     duration double precision,
+     updated timestamp DEFAULT now(),
+     PRIMARY KEY (stage, destination, polygon, batch)
+    );
+    CREATE INDEX IF NOT EXISTS {ledger_table}_polygon_idx ON {ledger_table} (stage, polygon);
+    '''.format(ledger_table = ledger_table)
+    engine.execute(sql)
+
+def record(engine, stage, destination, polygon, status, n_points = None, duration = None, batch = 0):
+    '''
+    Record the outcome of processing a destination for a polygon (or origin batch); engine may
+    also be a connection, to record this in the transaction recording results
+    '''
+    sql = '''
+    INSERT INTO {ledger_table} (stage, destination, polygon, batch, status, n_points, duration)
+    VALUES (%(stage)s, %(destination)s, %(polygon)s, %(batch)s, %(status)s, %(n_points)s, %(duration)s)
+    ON CONFLICT (stage, destination, polygon, batch) DO UPDATE
+       SET status   = EXCLUDED.status,
+           n_points = EXCLUDED.n_points,
+           duration = EXCLUDED.duration,
+           updated  = now();
+    '''.format(ledger_table = ledger_table)
+    engine.execute(sql, {'stage':stage,
+                         'destination':destination,
+                         'polygon':int(polygon),
+                         'batch':int(batch),
+                         'status':status,
+                         'n_points':n_points,
+                         'duration':duration})
+
+def record_polygons(engine, stage, destination, polygons, status, duration = None):
+    ''' Record the outcome of processing a destination for a list of polygons together '''
+    sql = '''
+    INSERT INTO {ledger_table} (stage, destination, polygon, status, duration)
+    SELECT %(stage)s, %(destination)s, polygon, %(status)s, %(duration)s
+      FROM unnest(%(polygons)s::bigint[]) polygon
+    ON CONFLICT (stage, destination, polygon, batch) DO UPDATE
+       SET status   = EXCLUDED.status,
+           duration = EXCLUDED.duration,
+           updated  = now();
+    '''.format(ledger_table = ledger_table)
+    engine.execute(sql, {'stage':stage,
+                         'destination':destination,
+                         'polygons':[int(p) for p in polygons],
+                         'status':status,
+                         'duration':duration})
+
+def completed_destinations(engine, stage, polygon, batch = 0):
+    ''' The set of destinations completed for a polygon (or origin batch) '''
+    sql = '''
+    SELECT destination
+      FROM {ledger_table}
+     WHERE stage = %(stage)s
+       AND polygon = %(polygon)s
+       AND batch = %(batch)s
+       AND status IN %(complete)s;
+    '''.format(ledger_table = ledger_table)
+    return set([x[0] for x in engine.execute(sql, {'stage':stage, 
+                                                   'polygon':int(polygon), 
+                                                   'batch':int(batch), 
+                                                   'complete':complete})])
+
+def completed_polygons(engine, stage, destination):
+    ''' The set of polygons (or origin batches of polygons) completed for a destination '''
+    sql = '''
+    SELECT DISTINCT polygon
+      FROM {ledger_table}
+     WHERE stage = %(stage)s
+       AND destination = %(destination)s
+       AND status IN %(complete)s;
+    '''.format(ledger_table = ledger_table)
+    return set([x[0] for x in engine.execute(sql, {'stage':stage, 'destination':destination, 'complete':complete})])
+
+def completed_task_polygons(engine, stage, destination, tasks):
+    ''' Polygons for which all of the listed (polygon, batch, batches) tasks are complete for a destination '''
+    sql = '''
+    SELECT polygon, batch
+      FROM {ledger_table}
+     WHERE stage = %(stage)s
+       AND destination = %(destination)s
+       AND status IN %(complete)s;
+    '''.format(ledger_table = ledger_table)
+    done = set([(int(x[0]), int(x[1])) for x in engine.execute(sql, {'stage':stage, 'destination':destination, 'complete':complete})])
+    status = {}
+    for task in tasks:
+        polygon = int(task[0])
+        status[polygon] = status.get(polygon, True) and (polygon, int(task[1])) in done
+    return [polygon for polygon in status if status[polygon]]
+
+def remaining_destinations(engine, stage, destinations, polygons):
+    ''' Destinations (of those listed) not yet completed for all of the listed polygons '''
+    sql = '''
+    SELECT destination
+      FROM {ledger_table}
+     WHERE stage = %(stage)s
+       AND status IN %(complete)s
+       AND polygon = ANY(%(polygons)s::bigint[])
+     GROUP BY destination
+    HAVING COUNT(DISTINCT polygon) = %(n)s;
+    '''.format(ledger_table = ledger_table)
+    polygons = [int(p) for p in polygons]
+    done = set([x[0] for x in engine.execute(sql, {'stage':stage,
+                                                   'complete':complete,
+                                                   'polygons':polygons,
+                                                   'n':len(polygons)})])
+    return [d for d in destinations if d not in done]
+
+def summary(engine, stage):
+    ''' Summary of progress by destination for a stage '''
+    sql = '''
+    SELECT destination,
+           COUNT(DISTINCT polygon) FILTER (WHERE status IN %(complete)s) AS polygons_complete,
+           COUNT(DISTINCT polygon) FILTER (WHERE status = 'error') AS polygons_error,
+           SUM(n_points) AS points,
+           ROUND(SUM(duration)::numeric/60, 2) AS minutes
+      FROM {ledger_table}
+     WHERE stage = %(stage)s
+     GROUP BY destination
+     ORDER BY destination;
+    '''.format(ledger_table = ledger_table)
+    return pandas.read_sql(sql, engine, params = {'stage':stage, 'complete':complete})
@@ -0,0 +1,401 @@
+# Script:  work_queue.py
+# Purpose: Work queue for distributed processing of polygon tasks across multiple machines
+#
+#          Tasks (see polygon_scheduler.py) are recorded in a work_queue table in the study
+#          region database.  Worker processes on any number of hosts connected to the same
+#          database claim tasks one at a time using SELECT ... FOR UPDATE SKIP LOCKED, so that
+#          each task is claimed by only one worker.  A claimed task is leased to its worker
+#          for a period of time; while the task is processed, a heartbeat thread extends the
+#          lease.  If a worker (or its host) dies, its lease expires and the task may be
+#          claimed by another worker.  Tasks which returned an error are retried, up to
+#          max_attempts times.
+#
+#          As a worker which has lost its lease (e.g. if heartbeats stalled) may still be
+#          processing a task which has been claimed by another worker, results are fenced:
+#          worker functions write their results within a transaction in which fence() 
+#          confirms (and locks) the lease held by the worker, so only the worker holding 
+#          the lease may record results for a task.
+#
+#          Once no tasks are available, each host waits for tasks leased by other workers;
+#          tasks whose lease expires meanwhile (e.g. of a host which died) are claimed and 
+#          processed by the waiting host.  Tasks not complete once max_attempts attempts
+#          have been made are reported as failed.
+#
+#          Task status values:
+#            - 'pending':  to be processed
+#            - 'claimed':  being processed by the worker recorded, until the lease expires
+#            - 'complete': processed successfully (or no points to process)
+#            - 'error':    processing failed (retried, while attempts < max_attempts)
+#
+#          Queues are named for the analysis and the configuration of the run (see queue_name),
+#          so that tasks completed for one set of destinations (or batching of polygons) are
+#          not taken to be complete for another.
+#
+#          Example usage (on each host):
+#            queue = queue_name('od_3200m', destination_list, od_batch_points)
+#            completed = process(engine, queue, tasks, worker, processes = nWorkers)
+#            # in the worker function, for results of the task being processed:
+#            with engine.begin() as connection:
+#                fence(connection)
+#                df.to_sql(table, con = connection, ...)
+#            connection = lock(engine, queue)
+#            # (work to be done once, for completed polygons)
+#            connection.close()
+
+import functools
+import hashlib
+import math
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import pandas
+from sqlalchemy import create_engine
+
+queue_table = 'work_queue'
+max_attempts = 3
+
+# (queue, task, worker) of the task being processed from a queue by this process (None if not consuming a queue)
+current = None
+
+# tasks available to be claimed: pending, leased to a worker whose lease has expired, or failed
+# (each, while fewer than max_attempts attempts have been made)
+available = '''
+    (status = 'pending'
+     OR (status = 'claimed' AND leased_until < now() AND attempts < %(max_attempts)s)
+     OR (status = 'error' AND attempts < %(max_attempts)s))
+'''
+
+class LeaseLost(Exception):
+    ''' The lease on a task is no longer held by the worker processing it '''
+    pass
+
+def queue_name(name, *keys):
+    '''
+    Name of a queue for an analysis and the configuration of a run (e.g. the list of
+    destinations processed, and the maximum points per task); hosts processing the same 
+    analysis and configuration share the queue
+    '''
+    key = hashlib.md5(repr(keys).encode('utf-8')).hexdigest()[:12]
+    return '{}_{}'.format(name, key)
+
+def create_queue(engine):
+    ''' Create the work queue table, if not exists '''
+    sql = '''
+    CREATE TABLE IF NOT EXISTS {queue_table}
+    (queue text NOT NULL,
+     polygon bigint NOT NULL,
+     batch integer NOT NULL DEFAULT 0,
+     batches integer NOT NULL DEFAULT 1,
+     priority double precision NOT NULL DEFAULT 0,
+     status text NOT NULL DEFAULT 'pending',
+     worker text,
+     attempts integer NOT NULL DEFAULT 0,
+     result integer,
+     leased_until timestamp,
+     updated timestamp DEFAULT now(),
+     PRIMARY KEY (queue, polygon, batch)
+    );
+    CREATE INDEX IF NOT EXISTS {queue_table}_claim_idx ON {queue_table} (queue, status, priority DESC);
+    '''.format(queue_table = queue_table)
+    engine.execute(sql)
+
+def enqueue(engine, queue, tasks):
+    '''
+    Add (polygon, batch, batches) tasks to a queue, with priority in order listed.
+
+    Tasks already queued are left as they are (so that any number of hosts may enqueue
+    the same tasks), except for those which previously failed, which are reset for retry.
+    '''
+    create_queue(engine)
+    sql = '''
+    INSERT INTO {queue_table} (queue, polygon, batch, batches, priority)
+    SELECT %(queue)s, polygon, batch, batches, priority
+      FROM unnest(%(polygons)s::bigint[],
+                  %(batch)s::integer[],
+                  %(batches)s::integer[],
+                  %(priority)s::double precision[]) t(polygon, batch, batches, priority)
+    ON CONFLICT (queue, polygon, batch) DO UPDATE
+       SET status   = 'pending',
+           attempts = 0,
+           updated  = now()
+     WHERE {queue_table}.status = 'error';
+    '''.format(queue_table = queue_table)
+    engine.execute(sql, {'queue':queue,
+                         'polygons':[int(t[0]) for t in tasks],
+                         'batch':[int(t[1]) for t in tasks],
+                         'batches':[int(t[2]) for t in tasks],
+                         'priority':[float(len(tasks) - i) for i in range(len(tasks))]})
+
+def worker_name():
+    ''' Identify a worker by host and process id '''
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def claim(engine, queue, worker, lease = 600):
+    ''' Claim the highest priority available task in a queue; returns None if none available '''
+    sql = '''
+    UPDATE {queue_table} q
+       SET status = 'claimed',
+           worker = %(worker)s,
+           attempts = q.attempts + 1,
+           leased_until = now() + %(lease)s * interval '1 second',
+           updated = now()
+      FROM (SELECT queue, polygon, batch
+              FROM {queue_table}
+             WHERE queue = %(queue)s
+               AND {available}
+             ORDER BY priority DESC
+             LIMIT 1
+               FOR UPDATE SKIP LOCKED) t
+     WHERE q.queue = t.queue
+       AND q.polygon = t.polygon
+       AND q.batch = t.batch
+    RETURNING q.polygon, q.batch, q.batches;
+    '''.format(queue_table = queue_table, available = available)
+    with engine.begin() as connection:
+        task = connection.execute(sql, {'queue':queue,
+                                        'worker':worker,
+                                        'lease':lease,
+                                        'max_attempts':max_attempts}).fetchone()
+    if task is None:
+        return None
+    return (int(task[0]), int(task[1]), int(task[2]))
+
+def heartbeat(engine, queue, task, worker, lease = 600):
+    ''' Extend the lease on a claimed task; returns False if the lease is no longer held '''
+    sql = '''
+    UPDATE {queue_table}
+       SET leased_until = now() + %(lease)s * interval '1 second'
+     WHERE queue = %(queue)s
+       AND polygon = %(polygon)s
+       AND batch = %(batch)s
+       AND status = 'claimed'
+       AND worker = %(worker)s;
+    '''.format(queue_table = queue_table)
+    result = engine.execute(sql, {'queue':queue,
+                                  'polygon':task[0],
+                                  'batch':task[1],
+                                  'worker':worker,
+                                  'lease':lease})
+    return result.rowcount == 1
+
+def fence(connection):
+    '''
+    Confirm that the lease on the task being processed from a queue by this process is still
+    held by its worker, within the transaction of a connection recording results for the task; 
+    the task is locked until the transaction ends, so that it may not be claimed by another
+    worker meanwhile.  Raises LeaseLost if the lease is no longer held (so that the transaction
+    is rolled back); has no effect for tasks not processed from a queue.
+    '''
+    if current is None:
+        return
+    queue, task, worker = current
+    sql = '''
+    UPDATE {queue_table}
+       SET updated = now()
+     WHERE queue = %(queue)s
+       AND polygon = %(polygon)s
+       AND batch = %(batch)s
+       AND status = 'claimed'
+       AND worker = %(worker)s
+       AND leased_until >= now()
+    RETURNING polygon;
+    '''.format(queue_table = queue_table)
+    held = connection.execute(sql, {'queue':queue,
+                                    'polygon':task[0],
+                                    'batch':task[1],
+                                    'worker':worker}).fetchone()
+    if held is None:
+        raise LeaseLost('Lease on task {} in queue {} is no longer held by {}'.format(task, queue, worker))
+
+def finish(engine, queue, task, worker, result, success = (0, 2)):
+    ''' Record the result of a claimed task (if the lease is still held by this worker) '''
+    sql = '''
+    UPDATE {queue_table}
+       SET status = %(status)s,
+           result = %(result)s,
+           leased_until = NULL,
+           updated = now()
+     WHERE queue = %(queue)s
+       AND polygon = %(polygon)s
+       AND batch = %(batch)s
+       AND status = 'claimed'
+       AND worker = %(worker)s;
+    '''.format(queue_table = queue_table)
+    engine.execute(sql, {'queue':queue,
+                         'polygon':task[0],
+                         'batch':task[1],
+                         'worker':worker,
+                         'status':'complete' if result in success else 'error',
+                         'result':result})
+
+class Heartbeat(threading.Thread):
+    ''' Background thread extending the lease on a task, while it is processed '''
+    def __init__(self, engine, queue, task, worker, lease = 600):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.engine = engine
+        self.queue = queue
+        self.task = task
+        self.worker = worker
+        self.lease = lease
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.lease / 4.0):
+            if not heartbeat(self.engine, self.queue, self.task, self.worker, self.lease):
+                print("Lease lost for task {} in queue {} ({})".format(self.task, self.queue, self.worker))
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def consume(index, queue, worker, db_url, extra = (), lease = 600, max_tasks = None):
+    '''
+    Claim and process tasks from a queue until none remain available (or max_tasks 
+    tasks have been processed).
+
+    input: index of the consuming process (unused; allows use with Pool.map), queue name,
+           worker function (called with the task tuple, followed by any extra arguments),
+           and database connection url
+    output: list of (task, result) tuples processed by this consumer
+    '''
+    global current
+    engine = create_engine(db_url, use_native_hstore=False)
+    name = worker_name()
+    processed = []
+    try:
+        while max_tasks is None or len(processed) < max_tasks:
+            task = claim(engine, queue, name, lease)
+            if task is None:
+                break
+            beat = Heartbeat(engine, queue, task, name, lease)
+            beat.start()
+            current = (queue, task, name)
+            try:
+                result = worker(task + tuple(extra))
+            except:
+                result = 1
+            finally:
+                current = None
+                beat.stop()
+            finish(engine, queue, task, name, result)
+            processed.append((task, result))
+    finally:
+        engine.dispose()
+    return processed
+
+def process(engine, queue, tasks, worker, processes, extra = (), lease = 600, max_tasks = None):
+    '''
+    Enqueue tasks, and process tasks from the queue using a pool of worker processes 
+    on this host, alongside those of any other hosts working on the same queue.  
+    Once no tasks remain available, waits for other workers' tasks to finish, processing
+    any which become available again meanwhile (ie. whose lease expired, or to be retried).
+
+    If max_tasks is specified, worker processes are recycled after processing 
+    this many tasks, to cap memory use.
+
+    output: list of polygons for which all tasks are complete
+    '''
+    enqueue(engine, queue, tasks)
+    consumer = functools.partial(consume, 
+                                 queue = queue, 
+                                 worker = worker, 
+                                 db_url = engine.url, 
+                                 extra = tuple(extra), 
+                                 lease = lease, 
+                                 max_tasks = max_tasks or None)
+    processed = 0
+    remaining = len(tasks)
+    while remaining > 0:
+        consumers = processes
+        maxtasksperchild = None
+        if max_tasks:
+            consumers = processes + int(math.ceil(remaining / float(max_tasks)))
+            maxtasksperchild = 1
+        pool = multiprocessing.Pool(processes = processes, maxtasksperchild = maxtasksperchild)
+        for result in pool.imap_unordered(consumer, range(consumers)):
+            processed += len(result)
+        pool.close()
+        pool.join()
+        print("{} tasks processed by {} (queue {}); waiting for any other workers to finish...".format(processed, socket.gethostname(), queue))
+        wait(engine, queue)
+        remaining = available_tasks(engine, queue)
+        if remaining > 0:
+            print("{} tasks available again (expired lease, or to be retried); processing...".format(remaining))
+    failed = failed_tasks(engine, queue)
+    if len(failed) > 0:
+        print("Tasks not completed after {} attempts (polygon, batch): {}".format(max_attempts, ', '.join([str(x) for x in failed])))
+    return completed_polygons(engine, queue)
+
+def wait(engine, queue, interval = 30):
+    ''' Wait until no tasks in a queue are leased to (ie. being processed by) other workers '''
+    sql = '''
+    SELECT COUNT(*)
+      FROM {queue_table}
+     WHERE queue = %(queue)s
+       AND status = 'claimed' 
+       AND leased_until >= now();
+    '''.format(queue_table = queue_table)
+    while engine.execute(sql, {'queue':queue}).fetchone()[0] > 0:
+        time.sleep(interval)
+
+def available_tasks(engine, queue):
+    ''' Count of tasks in a queue available to be claimed '''
+    sql = '''
+    SELECT COUNT(*)
+      FROM {queue_table}
+     WHERE queue = %(queue)s
+       AND {available};
+    '''.format(queue_table = queue_table, available = available)
+    return engine.execute(sql, {'queue':queue, 'max_attempts':max_attempts}).fetchone()[0]
+
+def failed_tasks(engine, queue):
+    ''' (polygon, batch) of tasks in a queue which are not complete, and are not available to be claimed '''
+    sql = '''
+    SELECT polygon, batch
+      FROM {queue_table}
+     WHERE queue = %(queue)s
+       AND status != 'complete'
+       AND NOT {available}
+       AND NOT (status = 'claimed' AND leased_until >= now())
+     ORDER BY polygon, batch;
+    '''.format(queue_table = queue_table, available = available)
+    return [(x[0], x[1]) for x in engine.execute(sql, {'queue':queue, 'max_attempts':max_attempts})]
+
+def completed_polygons(engine, queue):
+    ''' Polygons for which all queued tasks are complete '''
+    sql = '''
+    SELECT polygon
+      FROM {queue_table}
+     WHERE queue = %(queue)s
+     GROUP BY polygon
+    HAVING bool_and(status = 'complete');
+    '''.format(queue_table = queue_table)
+    return [x[0] for x in engine.execute(sql, {'queue':queue})]
+
+def lock(engine, queue):
+    '''
+    Take a session level advisory lock for a queue, for work to be done by only one host
+    at a time (e.g. a final pass once all tasks are complete); returns the connection
+    holding the lock, to be closed once done.
+    '''
+    connection = engine.connect()
+    connection.execute("SELECT pg_advisory_lock(hashtext(%(queue)s));", {'queue':queue})
+    return connection
+
+def summary(engine, queue):
+    ''' Summary of task status for a queue '''
+    sql = '''
+    SELECT status,
+           COUNT(*) AS tasks,
+           COUNT(DISTINCT worker) AS workers,
+           MAX(updated) AS updated
+      FROM {queue_table}
+     WHERE queue = %(queue)s
+     GROUP BY status
+     ORDER BY status;
+    '''.format(queue_table = queue_table)
+    return pandas.read_sql(sql, engine, params = {'queue':queue})